@@ -1,8 +1,18 @@
-from typing import Iterable, Tuple, Union, Dict, TextIO
+from typing import TYPE_CHECKING, BinaryIO, Iterable, List, Optional, Tuple, Union, Dict, TextIO
 from collections.abc import Iterable as Iter
-import requests as req
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+import codecs
+import io
+import json
+import re
+import time
+from catalog import CatalogStore, OptionIndex
+from cache import ResponseCache
+from metrics import Event, Metrics, registry, track
+import jsf
+# O requests (importado pelo transport) é a maior parte do tempo de import
+# do módulo; ele só é carregado quando a sessão faz a primeira requisição
+if TYPE_CHECKING:
+    from transport import Transport
 
 
 def must_set(*options):
@@ -16,24 +26,376 @@ def must_set(*options):
     return wrapper
 
 
+def transitions(
+    active: Dict[str, str],
+    area: str,
+    state=None,
+    states: Optional[OptionIndex] = None
+) -> Tuple[str, ...]:  # {{{
+    """Atualizações (requisições AJAX) necessárias antes de exportar a área. {{{
+
+        @param active
+                Seleções já ativas no ViewState do servidor ({'area', 'state'})
+        @param area
+                Nível de visualização da exportação
+        @param state
+                Estado dos municípios (somente para a área 'ibge')
+        @param states
+                Opções de estado do nível 'ibge'; com elas o estado pode vir
+                como nos setters (código, posição, nome ou código IBGE) e é
+                comparado pelo código
+                }}} """
+    if states is not None and state is not None:
+        try:
+            state = choose(states, state, 'estado')
+        except (ValueError, IndexError, TypeError):
+            pass  # O setter do estado levanta o erro
+    steps: Tuple[str, ...] = ()
+    if area == 'regiao' and active.get('area') != area:
+        steps = ('update_region',)
+    elif area == 'uf' and active.get('area') != area:
+        steps = ('update_state',)
+    elif area == 'ibge':
+        if active.get('area') != area:
+            steps = ('update_state', 'update_municipality')
+        elif active.get('state') != state:
+            steps = ('update_municipality',)
+    return steps
+    # }}}
+
+
+def request_kind(form: dict) -> str:  # {{{
+    """Tipo da requisição, usado nas métricas. }}} """
+    if 'j_idt84' in form:
+        return 'export'
+    return {'selectLinha': 'area', 'estadoMunicipio': 'state'}.get(
+        form.get('javax.faces.source', ''), 'form')
+    # }}}
+
+
+def request_state(form: dict) -> str:  # {{{
+    """Estado selecionado na requisição, ou '' se houver mais de um. }}} """
+    state = form.get('estadoMunicipio') or form.get('estados') or ''
+    if isinstance(state, (tuple, list)):
+        return str(state[0]) if len(state) == 1 else ''
+    return str(state)
+    # }}}
+
+
+def choose(
+    options: OptionIndex,
+    value: Union[str, int, Iterable[Union[str, int]]],
+    name: str,
+    multiple: bool = False
+) -> Union[str, Tuple[str, ...]]:  # {{{
+    """Código (ou códigos, se multiple) escolhido nas opções. }}} """
+    if isinstance(value, str):
+        code = options.find(value)
+        if code is None:
+            raise ValueError('Valor inválido para {}'.format(name))
+        return code
+    if isinstance(value, int) and not isinstance(value, bool):
+        try:
+            return options.code(value)
+        except IndexError:
+            raise IndexError(
+                'Opção de índice {} não existe para {}'.format(value, name))
+    if multiple and isinstance(value, Iter):
+        try:
+            return options.select(value)
+        except KeyError:
+            raise ValueError('Valor inválido para {}'.format(name))
+        except IndexError:
+            raise IndexError('Indíce inválido para {}'.format(name))
+    raise TypeError('Tipo inválido para {}'.format(name))
+    # }}}
+
+
+def strip_sections(sections: List[str], strip: Union[bool, List[bool]]) -> str:  # {{{
+    """Seleciona as seções (cabeçalho, dados, rodapé) do CSV exportado. {{{
+
+        @param strip
+                Booleano: somente as linhas de dados, sem a linha das colunas
+                Lista: as seções marcadas como verdadeiras
+                }}} """
+    if isinstance(strip, bool):
+        _, text, _ = sections
+        _, text = text.split('\n', maxsplit=1)
+        return text
+    strip = [i for i, s in enumerate(strip) if s]
+    return '\n'.join([t for i, t in enumerate(sections) if i in strip])
+    # }}}
+
+
+XML_ENCODING = re.compile(rb'\s*<\?xml[^>]*encoding=["\']([\w.-]+)')
+
+
+def charset(content_type: str, default: str) -> str:  # {{{
+    """Codificação declarada no Content-Type, ou a padrão se não houver. }}} """
+    for part in content_type.split(';')[1:]:
+        key, _, value = part.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return value.strip('"\'')
+    return default
+    # }}}
+
+
+def decode(content: bytes, content_type: str) -> str:  # {{{
+    """Decodifica a resposta de uma vez só, sem detecção de charset. {{{
+
+        Usa o charset do Content-Type; na falta dele, a declaração do XML
+        e, por fim, UTF-8. Nunca cai na detecção (lenta) do requests.
+        }}} """
+    default = 'utf-8'
+    m = XML_ENCODING.match(content)
+    if m is not None:
+        default = m.group(1).decode('ascii')
+    return content.decode(charset(content_type, default), 'replace')
+    # }}}
+
+
+def is_binary(output) -> bool:  # {{{
+    return isinstance(output, (io.RawIOBase, io.BufferedIOBase)) \
+        or 'b' in getattr(output, 'mode', '')
+    # }}}
+
+
+class SectionWriter:  # {{{
+    """Escreve o CSV exportado à medida que ele é baixado. {{{
+
+        Recebe a resposta em pedaços (bytes), encontra as divisas entre as
+        seções (cabeçalho, dados e rodapé) nos próprios bytes, sem juntar a
+        resposta inteira, e escreve direto na saída somente as seções
+        pedidas. O resultado é o mesmo de strip_sections(texto.split(
+        '\\n\\n\\n'), strip) + '\\n'.
+
+        A divisa é ASCII, então pode ser procurada nos bytes de qualquer
+        codificação compatível (ISO-8859-1, UTF-8). Os bytes escolhidos são
+        decodificados uma vez só: para arquivos de texto viram str; para
+        arquivos binários (ou nomes de arquivo) são transcodificados para
+        output_encoding, ou copiados como estão se a codificação for a mesma.
+
+        @param output
+                Arquivo (nome ou objeto) onde o CSV é escrito
+        @param strip
+                Seções que são escritas (veja strip_sections)
+                None escreve a resposta sem alterações
+        @param encoding
+                Codificação da resposta
+        @param output_encoding
+                Codificação dos arquivos binários e dos nomes de arquivo
+                }}} """
+
+    SEPARATOR = b'\n\n\n'
+
+    def __init__(
+        self,
+        output: Union[str, TextIO, BinaryIO, None],
+        strip: Union[bool, List[bool], None],
+        encoding: str = 'ISO-8859-1',
+        output_encoding: str = 'utf-8'
+    ):  # {{{
+        self.__file__ = open(output, 'wb') if isinstance(output, str) else None
+        self.output = self.__file__ if self.__file__ is not None else output
+        self.strip = strip
+        self.__binary__ = is_binary(self.output)
+        self.__output_encoding__ = output_encoding
+        # Mesma codificação na entrada e na saída: copia os bytes
+        self.__copy__ = self.__binary__ and \
+            codecs.lookup(encoding).name == codecs.lookup(output_encoding).name
+        self.__decoder__ = codecs.getincrementaldecoder(encoding)('replace')
+        self.__section__ = 0
+        self.__pending__ = b''
+        self.__started__ = False  # Alguma seção já foi escrita
+        self.__skip_line__ = isinstance(strip, bool)  # Linha das colunas
+        self.__start__()
+        # }}}
+
+    def __selected__(self) -> bool:  # {{{
+        if self.strip is None:
+            return True
+        if isinstance(self.strip, bool):
+            return self.__section__ == 1
+        return self.__section__ < len(self.strip) and bool(self.strip[self.__section__])
+        # }}}
+
+    def __write__(self, data):  # {{{
+        if self.output is None or len(data) == 0:
+            return
+        if self.__copy__:
+            self.output.write(data)
+            return
+        text = self.__decoder__.decode(data)
+        if self.__binary__:
+            self.output.write(text.encode(self.__output_encoding__))
+        elif text:
+            self.output.write(text)
+        # }}}
+
+    def __start__(self):  # {{{
+        # Separa as seções escolhidas como o '\\n'.join de strip_sections
+        if self.strip is not None and self.__selected__() \
+                and not isinstance(self.strip, bool):
+            if self.__started__:
+                self.__write__(b'\n')
+            self.__started__ = True
+        # }}}
+
+    def __emit__(self, buffer: bytes, start: int, end: int):  # {{{
+        if start >= end or not self.__selected__():
+            return
+        if self.__skip_line__ and self.__section__ == 1:
+            i = buffer.find(b'\n', start, end)
+            if i < 0:
+                return
+            start = i + 1
+            self.__skip_line__ = False
+        self.__write__(memoryview(buffer)[start:end])
+        # }}}
+
+    def feed(self, chunk: bytes):  # {{{
+        buffer = self.__pending__ + chunk if self.__pending__ else chunk
+        if self.strip is None:
+            self.__write__(buffer)
+            return
+        start = 0
+        while True:
+            i = buffer.find(SectionWriter.SEPARATOR, start)
+            if i < 0:
+                break
+            self.__emit__(buffer, start, i)
+            start = i + len(SectionWriter.SEPARATOR)
+            self.__section__ += 1
+            self.__start__()
+        # Segura as quebras de linha finais, que podem ser o começo de uma divisa
+        end = len(buffer)
+        while end > start and end > len(buffer) - 2 and buffer[end - 1] == 10:
+            end -= 1
+        self.__emit__(buffer, start, end)
+        self.__pending__ = bytes(buffer[end:])
+        # }}}
+
+    def close(self):  # {{{
+        try:
+            tail, self.__pending__ = self.__pending__, b''
+            if self.strip is None:
+                self.__write__(tail)
+            else:
+                self.__emit__(tail, 0, len(tail))
+            if isinstance(self.strip, bool) and self.__section__ != 2:
+                raise ValueError('O CSV não tem as três seções esperadas')
+            if not self.__copy__:
+                # Esvazia o decodificador (sequência multibyte incompleta)
+                text = self.__decoder__.decode(b'', final=True)
+                if text and self.output is not None:
+                    self.output.write(text.encode(self.__output_encoding__)
+                                      if self.__binary__ else text)
+            self.__write__(b'\n')
+        finally:
+            if self.__file__ is not None:
+                self.__file__.close()
+        # }}}
+    # }}}
+
+
+class ViewStateError(ValueError):
+    """O servidor não devolveu um ViewState válido (sessão ou visão vencida)."""
+
+
+class IncompleteResponse(IOError):
+    """A conexão caiu enquanto o corpo da resposta era lido."""
+
+
 class Sisab:  # {{{
     HOST = "https://sisab.saude.gov.br"
     URL = HOST + "/paginas/acessoRestrito/relatorio/federal/indicadores/indicadorPainel.xhtml"
 
-    def __init__(self):  # {{{
+    def __init__(
+        self,
+        transport: Optional['Transport'] = None,
+        catalog: Optional[CatalogStore] = None,
+        cache: Optional[ResponseCache] = None,
+        metrics: Optional[Metrics] = None,
+        lazy: bool = False,
+        session: Optional[str] = None
+    ):  # {{{
+        """Abre uma sessão no painel de indicadores do Sisab. {{{
+
+            @param transport
+                    Sessão HTTP a ser usada (padrão: uma nova, criada na
+                    primeira requisição)
+            @param catalog
+                    Catálogo de opções em disco. Se estiver válido, as opções
+                    vêm dele e a sessão só é aberta na primeira requisição
+            @param cache
+                    Cache das exportações CSV; exportações já guardadas não
+                    vão para a rede
+            @param metrics
+                    Onde os tempos das requisições são publicados
+                    (padrão: metrics.registry)
+            @param lazy
+                    Não faz requisições no construtor: a página inicial e as
+                    opções são buscadas no primeiro uso
+            @param session
+                    Arquivo salvo com save_session; a sessão (cookies,
+                    ViewState, seleções e opções) continua de onde parou,
+                    sem requisições
+                    }}} """
         super().__init__()
+        # Sessão persistente: reaproveita conexões e guarda os cookies
+        self.__transport__ = transport
+        self.__cache__ = cache
+        self.__metrics__ = metrics if metrics is not None else registry
+        self.__init_state__()
+
+        if session is not None:
+            self.load_session(session)
+            return
+
+        data = catalog.load() if catalog is not None else None
+        if data is not None:
+            self.__load_catalog__(data)
+            return
+
+        self.__pending__ = True
+        if not lazy:
+            self.__ensure__()
+        # }}}
+
+    def __ensure__(self):  # {{{
+        # Abre a sessão e carrega as opções iniciais (GET + POST), uma vez
+        if not self.__pending__:
+            return
+        self.__pending__ = False
+        try:
+            self.__get_cookies__()
+            self.post()
+            self.__parse_area_options__()
+        except BaseException:
+            self.__pending__ = True
+            raise
+        # }}}
+
+    def __init_state__(self):  # {{{
         self.__view_state__ = ''
         self.__last_request__ = ''
+        self.__page__ = jsf.Page(None, dict(), set())
+        self.__ready__ = False  # Já tem cookies e ViewState
+        self.__pending__ = False  # Opções iniciais ainda não foram buscadas
+        self.__cookies__: List[dict] = []  # Cookies salvos, para o transporte
+        self.__recovering__ = False
+        # Seleções já feitas no servidor dentro do ViewState atual
+        self.__active__: Dict[str, str] = dict()
         self.__option_key__ = ''
 
-        self.__area_options__: Dict[str, str] = dict()
-        self.__national_options__: Dict[str, str] = dict()
-        self.__region_options__: Dict[str, str] = dict()
-        self.__state_options__: Dict[str, str] = dict()
-        self.__municipality_options__: Dict[str, str] = dict()
-        self.__index_options__: Dict[str, str] = dict()
-        self.__period_options__: Dict[str, str] = dict()
-        self.__view_options__: Dict[str, str] = dict()
+        self.__area_options__ = OptionIndex()
+        self.__national_options__ = OptionIndex()
+        self.__region_options__ = OptionIndex()
+        self.__state_options__ = OptionIndex()
+        self.__municipality_options__ = OptionIndex()
+        self.__index_options__ = OptionIndex()
+        self.__period_options__ = OptionIndex()
+        self.__view_options__ = OptionIndex()
 
         self.__index__ = ''  # Indicador
         self.__period__ = ''  # Período da pesquisa (precisa ser configurado)
@@ -43,50 +405,52 @@ class Sisab:  # {{{
         self.__region__: Union[str, Tuple[str, ...]] = ''
         self.__state__: Union[str, Tuple[str, ...]] = ''
         self.__municipality__: Union[str, Tuple[str, ...]] = ''
+        # }}}
 
-        self.__cookies__ = []
-        self.__get_cookies__()
-
-        self.post()
-        soup = BeautifulSoup(self.__last_request__, 'html.parser')
-        self.__area_options__ = {k: v for k, v in map(
-            lambda o: (o.attrs['value'], o.get_text()),
-            soup.select('select#selectLinha option')
-        )}
+    def __load_catalog__(self, data: dict):  # {{{
+        self.__area_options__ = OptionIndex(data['area'])
+        self.__period_options__ = OptionIndex(data['period'])
+        self.__index_options__ = OptionIndex(data['index'])
+        self.__view_options__ = OptionIndex(data['view'])
+        self.__region_options__ = OptionIndex(data['region'])
+        self.__state_options__ = OptionIndex(data['state'])
         # }}}
 
     # {{{ Getters
+    # As opções são OptionIndex: somente leitura, sem cópias a cada acesso.
+    # Com lazy, o primeiro acesso abre a sessão
     @property
-    def area_options(self) -> Dict[str,
-                                   str]: return self.__area_options__.copy()
-
+    def area_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__area_options__
     @property
-    def national_options(
-        self) -> Dict[str, str]: return self.__national_options__.copy()
-
+    def national_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__national_options__
     @property
-    def region_options(
-        self) -> Dict[str, str]: return self.__region_options__.copy()
-
+    def region_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__region_options__
     @property
-    def state_options(self) -> Dict[str,
-                                    str]: return self.__state_options__.copy()
-
+    def state_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__state_options__
     @property
-    def municipality_options(
-        self) -> Dict[str, str]: return self.__municipality_options__.copy()
-
+    def municipality_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__municipality_options__
     @property
-    def index_options(self) -> Dict[str,
-                                    str]: return self.__index_options__.copy()
-
+    def index_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__index_options__
     @property
-    def period_options(
-        self) -> Dict[str, str]: return self.__period_options__.copy()
-
+    def period_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__period_options__
     @property
-    def view_options(self) -> Dict[str,
-                                   str]: return self.__view_options__.copy()
+    def view_options(self) -> OptionIndex:
+        self.__ensure__()
+        return self.__view_options__
 
     @property
     def area(self): return self.__area__
@@ -104,128 +468,87 @@ class Sisab:  # {{{
     def view(self): return self.__view__
     # }}}
     # {{{ Setters
+    # Aceitam o código, a posição ou, como em OptionIndex.find, o nome ou
+    # o código IBGE; região, estado e município aceitam também vários
 
     @area.setter
     def area(self, value: Union[str, int]):
-        if isinstance(value, str):
-            if value not in self.area_options:
-                raise ValueError('Valor inválido para área')
-            self.__area__ = value
-        elif isinstance(value, int):
-            try:
-                self.__area__ = list(self.area_options.keys())[value]
-            except IndexError:
-                raise IndexError('Indíce inválido para área')
-        else:
-            raise TypeError('Tipo inválido para área')
+        self.__area__ = choose(self.area_options, value, 'área')
 
     @region.setter
     def region(self, value: Union[str, Iterable[str], Iterable[int]]):
-        if isinstance(value, str):
-            if value not in self.region_options:
-                raise ValueError('Valor inválido para região')
-            self.__region__ = value
-        elif isinstance(value, Iter):
-            if all(map(lambda v: type(v) == int, value)):
-                try:
-                    self.__region__ = tuple([k for i, k in enumerate(
-                        self.region_options.keys()) if i in value])  # type: ignore
-                except IndexError:
-                    raise IndexError('Indíce inválido para região')
-            else:
-                if any(map(lambda o: o not in self.region_options, value)):
-                    raise ValueError('Valor inválido para região')
-                self.__region__ = tuple(value)  # type: ignore
-        else:
-            raise TypeError('Tipo inválido para região')
+        self.__region__ = choose(self.region_options, value, 'região', True)
 
     @state.setter
     def state(self, value: Union[str, Iterable[str], Iterable[int]]):
-        if isinstance(value, str):
-            if value not in self.state_options:
-                raise ValueError('Valor inválido para estado')
-            self.__state__ = value
-        elif isinstance(value, Iter):
-            if all(map(lambda v: type(v) == int, value)):
-                try:
-                    self.__state__ = tuple([k for i, k in enumerate(
-                        self.state_options.keys()) if i in value])  # type: ignore
-                except IndexError:
-                    raise IndexError('Indíce inválido para estado')
-            else:
-                if any(map(lambda o: o not in self.state_options, value)):
-                    raise ValueError('Valor inválido para estado')
-                self.__state__ = tuple(value)  # type: ignore
-        else:
-            raise TypeError('Tipo inválido para estado')
+        self.__state__ = choose(self.state_options, value, 'estado', True)
 
     @municipality.setter
     def municipality(self, value: Union[str, Iterable[str], Iterable[int]]):
-        if isinstance(value, str):
-            if value not in self.municipality_options:
-                raise ValueError('Valor inválido para município')
-            self.__municipality__ = value
-        elif isinstance(value, Iter):
-            if all(map(lambda v: type(v) == int, value)):
-                try:
-                    self.__municipality__ = tuple([k for i, k in enumerate(
-                        self.municipality_options.keys()) if i in value])  # type: ignore
-                except IndexError:
-                    raise IndexError('Indíce inválido para município')
-            else:
-                if any(map(lambda o: o not in self.municipality_options, value)):
-                    raise ValueError('Valor inválido para município')
-                self.__municipality__ = tuple(value)  # type: ignore
-        else:
-            raise TypeError('Tipo inválido para município')
+        self.__municipality__ = choose(
+            self.municipality_options, value, 'município', True)
 
     @period.setter
     def period(self, value: Union[str, int]):
-        if isinstance(value, str):
-            if value not in self.period_options:
-                raise ValueError('Valor inválido para período')
-            self.__period__ = value
-        elif isinstance(value, int):
-            try:
-                self.__period__ = list(self.period_options.keys())[value]
-            except IndexError:
-                raise IndexError(
-                    'Opção de índice {} não existe para período'.format(value))
-        else:
-            raise TypeError('Tipo não suportado para configurar período')
+        self.__period__ = choose(self.period_options, value, 'período')
 
     @index.setter
     def index(self, value: Union[str, int]):
-        if isinstance(value, str):
-            if value not in self.index_options:
-                raise ValueError('Valor inválido para índice')
-            self.__index__ = value
-        elif isinstance(value, int):
-            try:
-                self.__index__ = list(self.index_options.keys())[value]
-            except IndexError:
-                raise IndexError(
-                    'Opção de índice {} não existe para índice'.format(value))
-        else:
-            raise TypeError('Tipo não suportado para configurar índice')
+        self.__index__ = choose(self.index_options, value, 'índice')
 
     @view.setter
     def view(self, value: Union[str, int]):
-        if isinstance(value, str):
-            if value not in self.view_options:
-                raise ValueError('Valor inválido para visão de equipe')
-            self.__view__ = value
-        elif isinstance(value, int):
-            try:
-                self.__view__ = list(self.view_options.keys())[value]
-            except IndexError:
-                raise IndexError(
-                    'Opção de índice {} não existe para visão de equipe'.format(value))
-        else:
-            raise TypeError('Tipo não suportado para configurar índice')
+        self.__view__ = choose(self.view_options, value, 'visão de equipe')
 
     # }}}
 
+    # Tamanho dos pedaços lidos da resposta ao baixar um CSV
+    CHUNK_SIZE = 64 * 1024
+    # Codificação do CSV quando o Content-Type não informa o charset
+    CSV_ENCODING = 'ISO-8859-1'
+
+    # Cabeçalhos enviados em todo POST (os demais vêm da sessão)
+    HEADERS = {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Origin": HOST,
+        "Referer": URL,
+        "Upgrade-Insecure-Requests": "1",
+        "Sec-Fetch-Dest": "document",
+        "Sec-Fetch-Mode": "navigate",
+        "Sec-Fetch-Site": "same-origin",
+        "Sec-Fetch-User": "?1",
+    }
+
+    # Parâmetros AJAX do evento "change" de cada select
+    AREA_CHANGE = {
+        'javax.faces.source': 'selectLinha',
+        'javax.faces.partial.event': 'change',
+        'javax.faces.partial.execute': 'selectLinha selectLinha',
+        'javax.faces.partial.render': 'regioes script',
+        'javax.faces.behavior.event': 'valueChange',
+        'javax.faces.partial.ajax': 'true'
+    }
+    STATE_CHANGE = {
+        'javax.faces.source': 'estadoMunicipio',
+        'javax.faces.partial.event': 'change',
+        'javax.faces.partial.execute': 'estadoMunicipio estadoMunicipio',
+        'javax.faces.partial.render': 'regioes script',
+        'javax.faces.behavior.event': 'valueChange',
+        'javax.faces.partial.ajax': 'true'
+    }
+
+    def __form__(self, params: dict) -> dict:  # {{{
+        default = {
+            "j_idt50": "j_idt50",
+            "javax.faces.ViewState": self.__view_state__,
+            "coIndicador": self.index,
+            "quadrimestre": self.period,
+            "visaoEquipe": self.view
+        }
+        default.update(params)
+        return default
+        # }}}
+
     def post(  # {{{
         self,
         params: dict = dict(),
@@ -240,343 +563,609 @@ class Sisab:  # {{{
             @param output
                     O nome do arquivo para salvar a resposta da requisição
                     Quando não é passado, a resposta não é salva
+            @param strip
+                    Seções do CSV que são salvas (veja strip_sections)
+                    None salva a resposta sem alterações
                     }}} """
 
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Host": "sisab.saude.gov.br",
-            "User-Agent":
-                "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:91.0)" +
-                " Gecko/20100101 Firefox/91.0",
-            "Accept":
-                "text/html,application/xhtml+xml,application/xml;" +
-                "q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Language": "pt-BR,en-US;q=0.8,en;q=0.5,pt;q=0.3",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Origin": "https://sisab.saude.gov.br",
-            "Connection": "keep-alive",
-            "Referer":
-                "https://sisab.saude.gov.br/paginas/acessoRestrito/" +
-                "relatorio/federal/indicadores/indicadorPainel.xhtml",
-            "Upgrade-Insecure-Requests": "1",
-            "Sec-Fetch-Dest": "document",
-            "Sec-Fetch-Mode": "navigate",
-            "Sec-Fetch-Site": "same-origin",
-            "Sec-Fetch-User": "?1",
-            "Cookie": ';'.join(self.__cookies__),
-        }
+        # Uma resposta interrompida é pedida de novo (voltando a saída para
+        # onde estava) e um ViewState perdido abre uma nova sessão no
+        # servidor, refazendo as seleções ativas antes de repetir. Uma
+        # requisição que falhou depois de enviada (que o transporte não
+        # repete) também pode ter mudado o ViewState, então é repetida do
+        # mesmo jeito, numa sessão nova
+        self.__ensure__()
+        import requests as req  # Já carregado pelo transport
+        retry = self.transport.retry
+        attempts = retry.attempts if retry is not None else 1
+        position = output.tell() if not isinstance(output, str) \
+            and output is not None and output.seekable() else None
+        recovered = False
+        resync = False
+        attempt = 0
+        while True:
+            try:
+                if resync:
+                    resync = False
+                    self.__recover__()
+                return self.__post__(params, output, strip)
+            except ViewStateError:
+                if recovered or self.__recovering__:
+                    raise
+                recovered = True
+                resync = True
+            except IncompleteResponse:
+                if attempt + 1 >= attempts or (
+                        output is not None and not isinstance(output, str)
+                        and position is None):
+                    raise
+                if position is not None:
+                    output.seek(position)  # type: ignore
+                    output.truncate()  # type: ignore
+                time.sleep(retry.delay(attempt))  # type: ignore
+                attempt += 1
+            except (req.ConnectionError, req.Timeout, req.HTTPError):
+                if self.__recovering__ or attempt + 1 >= attempts:
+                    raise
+                time.sleep(retry.delay(attempt))  # type: ignore
+                attempt += 1
+                resync = True
+            if position is not None:
+                output.seek(position)  # type: ignore
+                output.truncate()  # type: ignore
+        # }}}
 
-        default = {
-            "j_idt50": "j_idt50",
-            "javax.faces.ViewState": self.__view_state__,
-            "coIndicador": self.index,
-            "quadrimestre": self.period,
-            "visaoEquipe": self.view
-        }
-        default.update(params)
+    def __post__(self, params, output, strip):  # {{{
+        import requests as req  # Já carregado pelo transport
+        form = self.__form__(params)
+        kind, state = request_kind(form), request_state(form)
+        key = ResponseCache.key(form) if self.__cache__ is not None else None
+        if key is not None:
+            cached = self.__cache__.get(key)  # type: ignore
+            if cached is not None:
+                try:
+                    with self.__metrics__.timer('request', 'cache', state):
+                        self.__write_csv__(cached[0], cached[1], output, strip, 'cache', state)
+                except Exception:
+                    # Uma resposta ruim no cache não pode falhar para sempre
+                    self.__cache__.remove(key)  # type: ignore
+                    raise
+                return
+
+        if not self.__ready__:
+            self.__get_cookies__()
+            form = self.__form__(params)
+        with self.__metrics__.timer('request', kind, state), \
+                self.transport.post(
+                    Sisab.URL, headers=Sisab.HEADERS,
+                    params=form, stream=True) as res:
+            self.__emit_timing__(kind, state)
+            content_type = res.headers['Content-Type']
+            if Sisab.is_csv(content_type):
+                chunks = res.iter_content(Sisab.CHUNK_SIZE)
+                # A resposta só entra no cache depois que o SectionWriter a
+                # aceitou (veja cache.Entry)
+                entry = self.__cache__.begin(key, content_type) \
+                    if key is not None else None  # type: ignore
+                try:
+                    self.__write_csv__(content_type, entry.tee(chunks) if entry else chunks,
+                                       output, strip, kind, state)
+                except BaseException as e:
+                    if entry is not None:
+                        entry.abort()
+                    if isinstance(e, (req.ConnectionError, req.Timeout,
+                                      req.exceptions.ChunkedEncodingError)):
+                        raise IncompleteResponse(str(e)) from e
+                    raise
+                if entry is not None:
+                    entry.commit()
+            elif 'j_idt84' in form:
+                # A exportação volta como página quando a visão venceu
+                raise ViewStateError('A exportação não devolveu um CSV')
+            else:
+                with self.__metrics__.timer('transfer', kind, state) as t:
+                    content = res.content
+                    t['size'] = len(content)
+                self.__handle_response__(
+                    content_type, decode(content, content_type), output, strip,
+                    kind, state)
+        # }}}
+
+    def __emit_timing__(self, kind: str, state: str):  # {{{
+        connect, wait = self.transport.timing
+        self.__metrics__.emit(Event('connect', kind, state, connect))
+        self.__metrics__.emit(Event('wait', kind, state, wait))
+        # }}}
 
-        res = req.post(Sisab.URL, headers=headers, params=default)
-        content_type, _ = res.headers['Content-Type'].split(';')
+    def __write_csv__(self, content_type, chunks, output, strip,
+                      kind='export', state=''):  # {{{
+        # O CSV é escrito enquanto é baixado, sem ficar todo na memória.
+        # O tempo esperando cada pedaço conta como transferência e o tempo
+        # separando as seções e escrevendo, como escrita.
+        writer = SectionWriter(
+            output, strip, charset(content_type, Sisab.CSV_ENCODING))
+        chunks = iter(chunks)
+        transfer = write = 0.0
+        size = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                middle = time.perf_counter()
+                transfer += middle - start
+                if chunk is None:
+                    break
+                size += len(chunk)
+                writer.feed(chunk)
+                write += time.perf_counter() - middle
+        finally:
+            start = time.perf_counter()
+            writer.close()
+            write += time.perf_counter() - start
+            self.__metrics__.emit(Event('transfer', kind, state, transfer, size))
+            self.__metrics__.emit(Event('write', kind, state, write))
+        # }}}
+
+    @staticmethod
+    def is_csv(content_type: str) -> bool:  # {{{
+        return content_type.split(';')[0].strip() == 'text/csv'
+        # }}}
+
+    def __handle_response__(self, content_type, text, output, strip,
+                            kind='form', state=''):  # {{{
+        content_type, _ = content_type.split(';')
 
         # Somente faz o parse do HTML se a resposta for xml
-        text = res.text
         if content_type == 'text/xml':
-            # FIXME: A resposta vem no encoding ISO-8859-1, não UTF-8
-            # self.__last_request__ = bytes(res.text, encoding=encoding.split('=')[1]).decode('utf-8')
             self.__last_request__ = text
-            self.__update_view_state__(text)
-        elif content_type == 'text/csv':
-            if isinstance(strip, bool):
-                _, text, _ = text.split('\n\n\n')
-                _, text = text.split('\n', maxsplit=1)
-            else:
-                text = text.split('\n\n\n')
-                strip = [i for i, s in enumerate(strip) if s]
-                text = '\n'.join([t for i, t in enumerate(text) if i in strip])
+            with self.__metrics__.timer('parse', kind, state) as t:
+                self.__page__ = jsf.parse(text)
+                t['size'] = len(text)
+            with self.__metrics__.timer('view_state', kind, state):
+                self.__update_view_state__()
+        elif content_type == 'text/csv' and strip is not None:
+            text = strip_sections(text.split('\n\n\n'), strip)
 
         if output is not None:
-            if isinstance(output, str):
-                with open(output, 'w') as f:
-                    f.write(text + '\n')
-            else:
-                output.write(text + '\n')
-        # }}}
-
-    def __update_view_state__(self, data):  # {{{
-        soup = BeautifulSoup(data, 'html.parser')
-        el = soup.find('input', id='javax.faces.ViewState')
-        if isinstance(el, Tag):
-            self.__view_state__ = el.attrs.get('value', '')
-        else:
-            el = soup.find('update', id='javax.faces.ViewState')
-            if isinstance(el, Tag):
-                self.__view_state__ = el.text
-            else:
-                raise ValueError('Não foi possível encontrar o ViewState')
+            with self.__metrics__.timer('write', kind, state) as t:
+                if isinstance(output, str):
+                    with open(output, 'w') as f:
+                        f.write(text + '\n')
+                else:
+                    output.write(text + '\n')
+                t['size'] = len(text) + 1
+        # }}}
+
+    def __update_view_state__(self):  # {{{
+        if self.__page__.view_state is None:
+            raise ViewStateError('Não foi possível encontrar o ViewState')
+        self.__view_state__ = self.__page__.view_state
+        # }}}
+
+    def __recover__(self):  # {{{
+        # Abre uma nova sessão e refaz a cadeia de seleções ativas
+        active = self.__active__
+        self.__recovering__ = True
+        try:
+            self.transport.cookies.clear()
+            self.__get_cookies__()
+            if 'area' in active:
+                self.post({'selectLinha': active['area'], **Sisab.AREA_CHANGE})
+                self.__active__ = {'area': active['area']}
+            if 'state' in active:
+                self.post({
+                    'selectLinha': active['area'],
+                    'estadoMunicipio': active['state'],
+                    **Sisab.STATE_CHANGE
+                })
+                self.__active__ = dict(active)
+        finally:
+            self.__recovering__ = False
         # }}}
 
     def __get_cookies__(self):  # {{{
-        res = req.get(Sisab.URL)
-        self.__cookies__ = list(map(
-            lambda c: c.split(';')[0],
-            res.headers['Set-Cookie'].split(', ')
-        ))
-        self.__last_request__ = res.text
-        self.__update_view_state__(res.text)
-        soup = BeautifulSoup(res.text, 'html.parser')
-
-        el = soup.find('select', id='quadrimestre')
-        if isinstance(el, Tag):
-            el = el.findAll('option')
-            self.__period_options__ = {
-                o.get('value'): o.text
-                for o in el
-                if isinstance(o, Tag) and o.get('value') != ''
-            }  # type: ignore
-
-        el = soup.find('select', id='coIndicador')
-        if isinstance(el, Tag):
-            el = el.findAll('option')
-            self.__index_options__ = {
-                o.get('value'): o.text
-                for o in el
-                if isinstance(o, Tag) and o.get('value') != ''
-            }  # type: ignore
-
-        el = soup.find('select', id='visaoEquipe')
-        if isinstance(el, Tag):
-            el = el.findAll('option')
-            self.__view_options__ = {
-                o.get('value'): o.text
-                for o in el
-                if isinstance(o, Tag) and o.get('value') != ''
-            }  # type: ignore
+        # Os cookies da resposta ficam guardados no cookie jar da sessão
+        with self.__metrics__.timer('request', 'page'):
+            res = self.transport.get(Sisab.URL)
+            self.__emit_timing__('page', '')
+            with self.__metrics__.timer('transfer', 'page') as t:
+                content = res.content
+                t['size'] = len(content)
+            text = decode(content, res.headers.get('Content-Type', ''))
+            with self.__metrics__.timer('parse', 'page') as t:
+                self.__parse_page__(text)
+                t['size'] = len(text)
+        self.__ready__ = True
+        self.__active__ = dict()
+        # }}}
+
+    def __parse_page__(self, text):  # {{{
+        # A página inicial já traz os selects fixos e o ViewState
+        self.__last_request__ = text
+        self.__page__ = jsf.parse(text)
+        self.__update_view_state__()
+
+        if 'quadrimestre' in self.__page__.selects:
+            self.__period_options__ = OptionIndex(jsf.options(self.__page__, 'quadrimestre'))
+        if 'coIndicador' in self.__page__.selects:
+            self.__index_options__ = OptionIndex(jsf.options(self.__page__, 'coIndicador'))
+        if 'visaoEquipe' in self.__page__.selects:
+            self.__view_options__ = OptionIndex(jsf.options(self.__page__, 'visaoEquipe'))
+        # }}}
+
+    def __parse_area_options__(self):  # {{{
+        self.__area_options__ = OptionIndex(
+            self.__page__.selects.get('selectLinha', dict()))
+        # }}}
+
+    def __check_regions__(self):  # {{{
+        if 'regioes' not in self.__page__.updates:
+            raise TypeError('Não foi possível encontrar a Tag de id "regioes"')
+        # }}}
+
+    def __parse_regions__(self):  # {{{
+        self.__check_regions__()
+        self.__active__ = {'area': self.area}
+        # O update "regioes" contém somente o select das regiões
+        self.__region_options__ = OptionIndex({
+            k: v
+            for options in self.__page__.selects.values()
+            for k, v in options.items() if k != ''
+        })
+        # }}}
+
+    def __parse_states__(self, look_into='estados'):  # {{{
+        self.__check_regions__()
+        self.__active__ = {'area': self.area}
+        self.__state_options__ = OptionIndex(jsf.options(self.__page__, look_into))
+        # }}}
+
+    def __parse_municipalities__(self):  # {{{
+        self.__check_regions__()
+        self.__active__ = {'area': self.area, 'state': self.state}
+        self.__municipality_options__ = OptionIndex(jsf.options(self.__page__, 'municipios'))
+        # }}}
+
+    @property
+    def transport(self) -> 'Transport':
+        if self.__transport__ is None:
+            from transport import Transport
+            self.__transport__ = Transport()
+        if self.__cookies__:
+            for c in self.__cookies__:
+                self.__transport__.cookies.set(
+                    c['name'], c['value'], domain=c['domain'], path=c['path'])
+            self.__cookies__ = []
+        return self.__transport__
+
+    @property
+    def active(self) -> Dict[str, str]: return self.__active__.copy()
+
+    # Opções guardadas por save_session
+    OPTIONS = ('area', 'national', 'region', 'state', 'municipality', 'index', 'period', 'view')
+
+    def save_session(self, path: str):  # {{{
+        """Salva a sessão (cookies, ViewState, seleções e opções) em JSON,
+        para load_session ou Sisab(session=path) continuarem sem
+        requisições. }}} """
+        self.__ensure__()
+        data = {
+            'url': Sisab.URL,
+            'saved': time.time(),
+            'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain,
+                         'path': c.path} for c in self.transport.cookies],
+            'view_state': self.__view_state__ if self.__ready__ else None,
+            'active': self.__active__,
+            'options': {k: dict(getattr(self, '__{}_options__'.format(k)))
+                        for k in Sisab.OPTIONS},
+            'selected': {k: getattr(self, '__{}__'.format(k))
+                         for k in ('area', 'region', 'state', 'municipality',
+                                   'index', 'period', 'view')},
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, ensure_ascii=False)
+        # }}}
+
+    def load_session(self, path: str):  # {{{
+        """Restaura uma sessão salva com save_session. Se o ViewState tiver
+        vencido no servidor, a primeira requisição abre uma sessão nova e
+        refaz as seleções (veja post). }}} """
+        with open(path) as f:
+            data = json.load(f)
+        if data['url'] != Sisab.URL:
+            raise ValueError('A sessão salva é de outro endereço: {}'.format(data['url']))
+        self.__init_state__()
+        for k in Sisab.OPTIONS:
+            setattr(self, '__{}_options__'.format(k), OptionIndex(data['options'][k]))
+        for k, v in data['selected'].items():
+            setattr(self, '__{}__'.format(k), tuple(v) if isinstance(v, list) else v)
+        if data['view_state'] is not None:
+            # Os cookies vão para o transporte quando ele for usado
+            if self.__transport__ is not None:
+                self.__transport__.cookies.clear()
+            self.__cookies__ = list(data['cookies'])
+            self.__view_state__ = data['view_state']
+            self.__active__ = dict(data['active'])
+            self.__ready__ = True
+        # }}}
+
+    def close(self):  # {{{
+        if self.__transport__ is not None:
+            self.__transport__.close()
+        # }}}
+
+    def __enter__(self): return self
+    def __exit__(self, *_): self.close()
+
+    # {{{ Parâmetros das requisições
+    def __area_params__(self) -> dict:  # {{{
+        return {'selectLinha': self.area, **Sisab.AREA_CHANGE}
+        # }}}
+
+    def __municipality_params__(self) -> dict:  # {{{
+        return {
+            'selectLinha': self.area,
+            'estadoMunicipio': self.state,
+            **Sisab.STATE_CHANGE
+        }
+        # }}}
+
+    def __export_params__(self, area: str) -> dict:  # {{{
+        params = {
+            'selectLinha': self.area,
+            'j_idt84': 'j_idt84'
+        }
+        if area == 'regiao':
+            params['regiao'] = self.region
+        elif area == 'uf':
+            if len(self.state) > 0:
+                params['estados'] = self.state  # type: ignore
+        elif area == 'ibge':
+            params['estadoMunicipio'] = self.state
+            if len(self.municipality) > 0:
+                params['municipios'] = self.municipality
+        return params
+        # }}}
+
+    def __configure__(self, area, options: dict):  # {{{
+        self.area = area
+        if 'period' in options:
+            self.period = options['period']
+        if 'index' in options:
+            self.index = options['index']
+        if 'view' in options:
+            self.view = options['view']
         # }}}
+    # }}}
 
     @must_set('area')
     def update_area(self):  # {{{
-        self.post({
-            'selectLinha': self.area,
-            'javax.faces.source': 'selectLinha',
-            'javax.faces.partial.event': 'change',
-            'javax.faces.partial.execute': 'selectLinha selectLinha',
-            'javax.faces.partial.render': 'regioes script',
-            'javax.faces.behavior.event': 'valueChange',
-            'javax.faces.partial.ajax': 'true'
-        })
+        with self.__metrics__.timer('update', 'area'):
+            self.post(self.__area_params__())
+        self.__active__ = {'area': self.area}
         # }}}
 
     @must_set('area')
     def get_area(self, file: str, strip: bool = False):  # {{{
-        s.post({
-            'selectLinha': self.area,
-            'j_idt84': 'j_idt84'
-        }, file, strip)
+        self.post(self.__export_params__('nacional'), file, strip)
         # }}}
 
     @must_set('area')
     def update_region(self):  # {{{
-        self.post({
-            'selectLinha': self.area,
-            'javax.faces.source': 'selectLinha',
-            'javax.faces.partial.event': 'change',
-            'javax.faces.partial.execute': 'selectLinha selectLinha',
-            'javax.faces.partial.render': 'regioes script',
-            'javax.faces.behavior.event': 'valueChange',
-            'javax.faces.partial.ajax': 'true'
-        })
-        soup = BeautifulSoup(self.__last_request__, 'html.parser')
-        el = soup.find('update', id='regioes')
-        if isinstance(el, Tag):
-            soup = BeautifulSoup(el.text, 'html.parser').findAll('option')
-            self.__region_options__ = {o.get('value'): o.text for o in soup if isinstance(
-                o, Tag) and o.get('value') != ''}  # type: ignore
-        else:
-            raise TypeError('Não foi possível encontrar a Tag de id "regioes"')
+        with self.__metrics__.timer('update', 'area'):
+            self.post(self.__area_params__())
+            self.__parse_regions__()
         # }}}
 
     @must_set('area', 'region')
     def get_region(self, file: str, strip: bool = False):  # {{{
-        s.post({
-            'selectLinha': self.area,
-            'regiao': self.region,
-            'j_idt84': 'j_idt84'
-        }, file, strip)
+        self.post(self.__export_params__('regiao'), file, strip)
         # }}}
 
     @must_set('area')
     def update_state(self, look_into='estados'):  # {{{
-        self.post({
-            'selectLinha': self.area,
-            'javax.faces.source': 'selectLinha',
-            'javax.faces.partial.event': 'change',
-            'javax.faces.partial.execute': 'selectLinha selectLinha',
-            'javax.faces.partial.render': 'regioes script',
-            'javax.faces.behavior.event': 'valueChange',
-            'javax.faces.partial.ajax': 'true'
-        })
-        soup = BeautifulSoup(self.__last_request__, 'html.parser')
-        el = soup.find('update', id='regioes')
-        if isinstance(el, Tag):
-            soup = BeautifulSoup(el.text, 'html.parser').find(
-                'select', id=look_into)
-            if isinstance(soup, Tag):
-                soup = soup.findAll('option')
-                self.__state_options__ = {o.get('value'): o.text for o in soup if isinstance(
-                    o, Tag) and o.get('value') != ''}  # type: ignore
-            else:
-                raise TypeError(
-                    'Não foi possível encontrar a Tag de id', look_into)
-        else:
-            raise TypeError('Não foi possível encontrar a Tag de id "regioes"')
+        with self.__metrics__.timer('update', 'area'):
+            self.post(self.__area_params__())
+            self.__parse_states__(look_into)
         # }}}
 
     @must_set('area')
     def get_state(self, file: str, strip: bool = False):  # {{{
-        params = {
-            'selectLinha': self.area,
-            'j_idt84': 'j_idt84'
-        }
-        if len(self.state) > 0:
-            params['estados'] = self.state  # type: ignore
-
-        s.post(params, file, strip)
+        self.post(self.__export_params__('uf'), file, strip)
         # }}}
 
     @must_set('area', 'state')
     def update_municipality(self):  # {{{
-        self.post({
-            'selectLinha': self.area,
-            'estadoMunicipio': self.state,
-            'javax.faces.source': 'estadoMunicipio',
-            'javax.faces.partial.event': 'change',
-            'javax.faces.partial.execute': 'estadoMunicipio estadoMunicipio',
-            'javax.faces.partial.render': 'regioes script',
-            'javax.faces.behavior.event': 'valueChange',
-            'javax.faces.partial.ajax': 'true'
-        })
-        soup = BeautifulSoup(self.__last_request__, 'html.parser')
-        el = soup.find('update', id='regioes')
-        if isinstance(el, Tag):
-            soup = BeautifulSoup(el.text, 'html.parser').find(
-                'select', id='municipios')
-            if isinstance(soup, Tag):
-                soup = soup.findAll('option')
-                self.__municipality_options__ = {o.get('value'): o.text for o in soup if isinstance(
-                    o, Tag) and o.get('value') != ''}  # type: ignore
-            else:
-                raise TypeError(
-                    'Não foi possível encontrar a Tag de id "municipios"')
-        else:
-            raise TypeError('Não foi possível encontrar a Tag de id "regioes"')
+        with self.__metrics__.timer('update', 'state', str(self.state)):
+            self.post(self.__municipality_params__())
+            self.__parse_municipalities__()
         # }}}
 
     @must_set('area', 'state')
     def get_municipality(self, file: str, strip: bool = False):  # {{{
-        params = {
-            'selectLinha': self.area,
-            'estadoMunicipio': self.state,
-            'j_idt84': 'j_idt84'
-        }
-        if len(self.municipality) > 0:
-            params['municipios'] = self.municipality
-
-        s.post(params, file, strip=strip)
+        self.post(self.__export_params__('ibge'), file, strip=strip)
         # }}}
     # }}}
 
     def get_data(self, area, file, strip=True, **options):
-        # Faz as requisições desde o começo até o fim
-        self.area = area
-        if 'period' in options:
-            self.period = options['period']
-        if 'index' in options:
-            self.index = options['index']
-        if 'view' in options:
-            self.view = options['view']
+        # Faz as requisições desde o começo até o fim, pulando as
+        # atualizações cujas seleções já estão ativas no servidor
+        self.__configure__(area, options)
+        steps = transitions(self.__active__, self.area, options.get('state'),
+                            self.__state_options__)
         if self.area == 'nacional':
             self.get_area(file, strip=strip)
         elif self.area == 'regiao':
-            self.update_region()
+            if 'update_region' in steps:
+                self.update_region()
             self.region = options['region']
             self.get_region(file, strip=strip)
         elif self.area == 'uf':
-            self.update_state()
+            if 'update_state' in steps:
+                self.update_state()
             if 'state' in options:
                 self.state = options['state']
             self.get_state(file, strip=strip)
         elif self.area == 'ibge':
-            self.update_state(look_into='estadoMunicipio')
+            if 'update_state' in steps:
+                self.update_state(look_into='estadoMunicipio')
             self.state = options['state']
-            self.update_municipality()
+            if 'update_municipality' in steps:
+                self.update_municipality()
             if 'municipality' in options:
                 self.municipality = options['municipality']
             self.get_municipality(file, strip=strip)
 
 
+def arguments(task: dict) -> Tuple[str, dict]:  # {{{
+    """Nível e argumentos de get_data de uma tarefa (sem 'file', que só
+    nomeia a saída). }}} """
+    options = {k: v for k, v in task.items() if k != 'file'}
+    return str(options.pop('area')), options
+    # }}}
+
+
+def run_task(sisab: Sisab, task: dict) -> str:  # {{{
+    """Texto da exportação de uma tarefa (argumentos de get_data), como o
+    Crawler, o Planner e o Batcher a executam. }}} """
+    area, options = arguments(task)
+    buffer = io.StringIO()
+    sisab.get_data(area, buffer, **options)
+    return buffer.getvalue()
+    # }}}
+
+
+def slices(sisab: Sisab, views: Optional[Iterable[str]] = None) -> List[dict]:  # {{{
+    """Tarefas (argumentos de get_data) das opções do script: todos os
+    estados, quadrimestres, indicadores e visões no nível de municípios. {{{
+
+        O estado fica no laço de fora: com uma sessão só, exportações
+        seguidas do mesmo estado não refazem as atualizações AJAX.
+
+        @param views
+                Visões exportadas (padrão: todas)
+                }}} """
+    from storage import STRIP
+    views = list(sisab.view_options if views is None else views)
+    return [{
+        'area': 'ibge', 'state': uf, 'period': p, 'index': i, 'view': view,
+        'strip': STRIP
+    } for uf in sisab.state_options for p in sisab.period_options
+        for i in sisab.index_options for view in views]
+    # }}}
+
+
+def export(crawler, tasks: List[dict], manifest, writer, refresh: Iterable[dict] = ()):  # {{{
+    """Baixa as fatias que faltam no manifesto e escreve todas no destino
+    (PartitionedWriter ou SQLiteSink), publicando um evento 'task' por
+    fatia (veja metrics.track). }}} """
+    for task, text in track(manifest.map(crawler, tasks, refresh)):
+        writer.write(task, text)
+    # }}}
+
+
 if __name__ == '__main__':
     import shutil
+    from crawler import Crawler
+    from manifest import Manifest
+    from incremental import select
+    from storage import PartitionedWriter
     # view_options = Visao, period_options = Quadrimestres, state_options = Estados, area_options = Nivel de Visualizacao, Indicador
     s = Sisab()
     s.area = 'ibge'
     s.view = 0
     s.update_state(look_into='estadoMunicipio')
-    print('1) ARQUIVO GLOBAL CSV', '2) PEQUENOS ARQUIVOS', sep='\n')
+    print('1) CSV POR PERÍODO E INDICADOR', '2) CSV POR PERÍODO, INDICADOR E VISÃO',
+          '3) BANCO SQLITE',
+          sep='\n')
     resposta = int(input())
+    print('Downloads simultâneos (padrão 4):')
+    workers = int(input() or 4)
+    print('Quadrimestres recentes para baixar de novo (padrão 1):')
+    window = int(input() or 1)
     print('\033[2J')
 
     tc, tl = shutil.get_terminal_size()
+    crawler = Crawler(workers, sessions=[s])
+
+    def status(event: Event):
+        # Uma linha com a fatia que acabou de chegar
+        if event.name != 'task':
+            return
+        task = event.data['task']  # type: ignore
+        print("\033[2K\r BAIXANDO",
+              s.state_options[task['state']],
+              s.period_options[task['period']],
+              s.index_options[task['index']],
+              s.view_options[task['view']],
+              end='')
+
     if resposta == 1:
         max_bar = tc - 9
-        with open('out.csv', 'w') as file:
-            # for p, i, view in [(p, i, view) for p in s.period_options for i in s.index_options for view in s.view_options]:
-            for p, i in [(p, i) for p in s.period_options for i in s.index_options]:
-                strip = [True, True, False]
-                file.write('\n')
+        # Fatias de cada estado: a barra mostra o progresso dentro dele
+        per_state = len(s.period_options) * len(s.index_options)
+
+        def progress(event: Event):
+            # Barra de progresso de cada estado
+            if event.name != 'task':
+                return
+            task = event.data['task']  # type: ignore
+            p, i, uf = task['period'], task['index'], task['state']
+            idx = event.data['position'] % per_state  # type: ignore
+            if idx == 0:
                 print()  # Texto "Baixando ..."
-                print('Período:'.ljust(15), s.period_options[p][:tc - 16])
-                print('Indicador:'.ljust(15), s.index_options[i][:tc - 16])
+                print('Estado:'.ljust(15), s.state_options[uf][:tc - 16])
                 print('Visualização:'.ljust(15),
                       s.view_options[s.view][:tc - 16])
                 print()  # Barra de progresso
-                print('\033[5A', end='')
-                for idx, uf in enumerate(s.state_options):
-                    s.state = uf
-                    s.update_municipality()
-                    s.get_data(s.area, file, state=uf,
-                               period=p, index=i, view=s.view, strip=strip)
-                    strip = True
-                    print('\033[2K\r\033[1mBAIXANDO\033[31m',
-                          s.state_options[uf], '\033[0m\033[4B', end='')
-                    pct = (idx * max_bar) / len(s.state_options)
-                    pct_str = '{:3.2f}%'.format(pct)
-                    pct_str = pct_str.rjust(7)
-                    decimal = pct - int(pct)
-                    pct_half = '▌' if decimal > 0.5 else ''
-                    print(
-                        # Limpa a linha e imprime a porcentagem
-                        '\033[2K\r{}'.format(pct_str),
-                        # Imprime a barra de progresso
-                        '█' * int(pct) + pct_half + '_' * \
-                        (max_bar - int(pct) - len(pct_half)),
-                        '\033[4A', end='')  # Volta para a linha "BAIXANDO ..."
-                print('\033[2K\r\033[1mFINALIZADO!!\033[0m\033[4B', end='')
+                print('\033[4A', end='')
+            print('\033[2K\r\033[1mBAIXANDO\033[31m',
+                  s.period_options[p], s.index_options[i][:tc - 30],
+                  '\033[0m\033[3B', end='')
+            pct = (idx * max_bar) / per_state
+            pct_str = '{:3.2f}%'.format(pct)
+            pct_str = pct_str.rjust(7)
+            decimal = pct - int(pct)
+            pct_half = '▌' if decimal > 0.5 else ''
+            print(
+                # Limpa a linha e imprime a porcentagem
+                '\033[2K\r{}'.format(pct_str),
+                # Imprime a barra de progresso
+                '█' * int(pct) + pct_half + '_' * \
+                (max_bar - int(pct) - len(pct_half)),
+                '\033[3A', end='')  # Volta para a linha "BAIXANDO ..."
+            if idx == per_state - 1:
+                print('\033[2K\r\033[1mFINALIZADO!!\033[0m\033[3B', end='')
                 print('\033[2K\r100.00% ' + '█' * max_bar)
                 print()
+
+        registry.subscribe(progress)
+        # for p, i, view in [(p, i, view) for p in s.period_options for i in s.index_options for view in s.view_options]:
+        tasks = slices(s, [s.view])
+        # As fatias ficam no manifesto e a saída é remontada a partir dele,
+        # em out/period=.../indicator=.../ibge.csv.gz
+        manifest = Manifest('out.manifest')
+        refresh = select(tasks, manifest, window)
+        with PartitionedWriter('out', keys=('period', 'index')) as writer:
+            export(crawler, tasks, manifest, writer, refresh)
     elif resposta == 2:
-        for uf, p, i, view in [(uf, p, i, view) for uf in s.state_options for p in s.period_options for i in s.index_options for view in s.view_options]:
-            s.state = uf
-            s.update_municipality()
-            s.get_data(s.area, '{}{}{}{}.csv'.format(
-                s.state_options[uf],
-                s.period_options[p],
-                s.index_options[i],
-                s.view_options[view]),
-                state=uf,
-                period=p, index=i, view=view)
-            print("\033[2K\r BAIXANDO",
-                  s.state_options[uf],
-                  s.period_options[p],
-                  s.index_options[i],
-                  s.view_options[view],
-                  end='')
+        # Um arquivo por período, indicador e visão, com todos os estados:
+        # arquivos/period=.../indicator=.../view=.../ibge.csv.gz
+        tasks = slices(s)
+        manifest = Manifest('arquivos.manifest')
+        refresh = select(tasks, manifest, window)
+        registry.subscribe(status)
+        with PartitionedWriter('arquivos') as writer:
+            export(crawler, tasks, manifest, writer, refresh)
+    elif resposta == 3:
+        from storage import SQLiteSink
+        tasks = slices(s)
+        manifest = Manifest('sisab.db.manifest')
+        refresh = select(tasks, manifest, window)
+        registry.subscribe(status)
+        with SQLiteSink('sisab.db') as sink:
+            export(crawler, tasks, manifest, sink, refresh)
+    crawler.close()
+    # Tempos de cada fase por tipo de requisição e estado
+    with open('sisab.metrics.json', 'w') as f:
+        f.write(registry.to_json())
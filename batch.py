@@ -0,0 +1,186 @@
+from typing import Dict, Hashable, Iterable, Iterator, List, Tuple
+from SISAB import Sisab, run_task, strip_sections
+from catalog import normalize
+
+
+Task = Dict[str, object]
+
+
+def key_column(columns: List[str], area: str) -> int:  # {{{
+    """Posição da coluna que identifica a entidade de cada linha. }}} """
+    wanted = 'ibge' if area == 'ibge' else 'uf'
+    for i, c in enumerate(columns):
+        if normalize(c) == wanted:
+            return i
+    raise ValueError('Coluna "{}" não encontrada no CSV'.format(wanted))
+    # }}}
+
+
+class Batcher:  # {{{
+    """Agrupa várias exportações de estados ou municípios em uma só. {{{
+
+        Tarefas que diferem somente no estado (nível 'uf') ou no município
+        (nível 'ibge', dentro do mesmo estado) são exportadas juntas, em
+        lotes de até batch_size entidades por (período, indicador, visão).
+        O CSV de cada lote é separado de volta por entidade. Se a requisição
+        de um lote falhar ou alguma entidade vier sem linhas (resposta
+        truncada), as entidades que faltam são divididas ao meio e
+        exportadas de novo, até chegar em uma por exportação.
+
+        O campo 'municipios' só aceita municípios do 'estadoMunicipio'
+        selecionado, então no nível 'ibge' os lotes nunca juntam estados.
+        Tarefas que não exportam uma entidade só (veja batchable) são
+        exportadas sozinhas, como no Planner.
+
+        @param sisab
+                Sessão usada nas exportações
+        @param batch_size
+                Quantidade máxima de entidades por exportação
+                }}} """
+
+    def __init__(self, sisab: Sisab, batch_size: int = 27):  # {{{
+        if batch_size < 1:
+            raise ValueError('O tamanho do lote deve ser positivo')
+        self.sisab = sisab
+        self.batch_size = batch_size
+        # }}}
+
+    @staticmethod
+    def batchable(task: Task) -> bool:  # {{{
+        """Se a tarefa exporta um estado (nível 'uf') ou um município
+        (nível 'ibge') só, e pode entrar num lote. }}} """
+        if task.get('area') == 'uf':
+            return isinstance(task.get('state'), str)
+        if task.get('area') == 'ibge':
+            return isinstance(task.get('municipality'), str)
+        return False
+        # }}}
+
+    @staticmethod
+    def entity(task: Task) -> str:  # {{{
+        return str(task['municipality'] if task['area'] == 'ibge' else task['state'])
+        # }}}
+
+    @staticmethod
+    def group(task: Task) -> Tuple[Hashable, ...]:  # {{{
+        rest = {k: v for k, v in task.items()
+                if k not in ('municipality', 'file', 'strip')
+                and not (k == 'state' and task['area'] == 'uf')}
+        return tuple(sorted((k, repr(v)) for k, v in rest.items()))
+        # }}}
+
+    def __names__(self, area: str) -> Dict[str, str]:  # {{{
+        options = self.sisab.municipality_options if area == 'ibge' \
+            else self.sisab.state_options
+        return options.normalized
+        # }}}
+
+    def __export__(
+        self, task: Task, entities: List[str]
+    ) -> Tuple[Dict[str, List[str]], List[str]]:  # {{{
+        """Exporta um lote e devolve as seções do CSV de cada entidade
+        encontrada e as seções do lote sem nenhuma linha. }}} """
+        area = str(task['area'])
+        entity = 'municipality' if area == 'ibge' else 'state'
+        text = run_task(self.sisab, dict(task, strip=None, **{entity: tuple(entities)}))
+        header, data, footer = text.rstrip('\n').split('\n\n\n')
+        columns, *rows = data.split('\n')
+        key = key_column(columns.split(';'), area)
+
+        # A coluna pode trazer o código (IBGE com ou sem dígito
+        # verificador) ou o nome da entidade
+        names = self.__names__(area)
+        lookup: Dict[str, str] = dict()
+        for e in entities:
+            lookup[normalize(e)] = e
+            if e in names:
+                lookup[names[e]] = e
+        found: Dict[str, List[str]] = {e: [] for e in entities}
+        for row in rows:
+            value = normalize(row.split(';')[key])
+            e = lookup.get(value) or lookup.get(value[:6])
+            if e is not None:
+                found[e].append(row)
+
+        return {
+            e: [header, '\n'.join([columns] + found[e]), footer]
+            for e in entities if found[e]
+        }, [header, columns, footer]
+        # }}}
+
+    def fetch(self, task: Task, entities: List[str]) -> Dict[str, List[str]]:  # {{{
+        """Exporta as entidades em lotes, dividindo os que falharem. }}} """
+        result: Dict[str, List[str]] = dict()
+        pending = [entities[i:i + self.batch_size]
+                   for i in range(0, len(entities), self.batch_size)]
+        while pending:
+            batch = pending.pop()
+            try:
+                sections, empty = self.__export__(task, batch)
+            except Exception:
+                if len(batch) == 1:
+                    raise
+                sections, empty = dict(), []
+            result.update(sections)
+            missing = [e for e in batch if e not in sections]
+            if missing and len(batch) > 1:
+                half = (len(missing) + 1) // 2
+                pending += [b for b in (missing[:half], missing[half:]) if b]
+            elif missing:
+                # Exportada sozinha e mesmo assim sem linhas: não há dados
+                result[batch[0]] = empty
+        return result
+        # }}}
+
+    def __single__(self, task: Task) -> str:  # {{{
+        return run_task(self.sisab, task)
+        # }}}
+
+    def run(self, tasks: Iterable[Task]) -> Iterator[Tuple[Task, str]]:  # {{{
+        """Executa as tarefas em lotes e devolve (tarefa, texto) de cada uma,
+        com o mesmo texto que ela teria se fosse exportada sozinha. {{{
+
+            Os resultados saem conforme cada lote termina: as tarefas de um
+            grupo juntas, na ordem em que os grupos aparecem nas tarefas.
+            }}} """
+        units: Dict[Hashable, List[Task]] = dict()
+        for i, task in enumerate(tasks):
+            key = Batcher.group(task) if Batcher.batchable(task) else i
+            units.setdefault(key, []).append(task)
+
+        for key, group in units.items():
+            if isinstance(key, int):
+                yield group[0], self.__single__(group[0])
+                continue
+            entities = list(dict.fromkeys(Batcher.entity(t) for t in group))
+            sections = self.fetch(group[0], entities)
+            for t in group:
+                strip = t.get('strip', True)
+                found = sections[Batcher.entity(t)]
+                text = '\n\n\n'.join(found) if strip is None \
+                    else strip_sections(found, strip)  # type: ignore
+                yield t, text + '\n'
+        # }}}
+    # }}}
+
+
+def batches(tasks: Iterable[Task], batch_size: int) -> List[List[Task]]:  # {{{
+    """Tarefas de cada exportação feita pelo Batcher. {{{
+
+        As tarefas que diferem só na entidade vão juntas, até batch_size
+        entidades por exportação; as demais ficam sozinhas.
+        }}} """
+    result: List[List[Task]] = []
+    groups: Dict[Tuple[Hashable, ...], Dict[str, List[Task]]] = dict()
+    for task in tasks:
+        if Batcher.batchable(task):
+            groups.setdefault(Batcher.group(task), dict()) \
+                .setdefault(Batcher.entity(task), []).append(task)
+        else:
+            result.append([task])
+    for entities in groups.values():
+        chunks = list(entities.values())
+        for i in range(0, len(chunks), batch_size):
+            result.append([t for c in chunks[i:i + batch_size] for t in c])
+    return result
+    # }}}
@@ -0,0 +1,214 @@
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import requests as req
+import jsf
+from SISAB import Sisab, SectionWriter, export, slices
+from crawler import Crawler
+from manifest import Manifest
+from storage import PartitionedWriter
+
+
+class Result(NamedTuple):
+    name: str
+    seconds: float
+    requests: int  # Requisições atendidas pelo servidor
+    bytes: int  # Bytes enviados pelo servidor
+    peak: Optional[int]  # Pico de memória alocada (tracemalloc)
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.seconds if self.seconds > 0 else 0.0
+
+
+def serve(*args: str) -> Tuple[subprocess.Popen, str]:  # {{{
+    """Abre o fake_server em outro processo e devolve o processo e a URL. {{{
+
+        O servidor fica fora do processo medido para que as alocações e a
+        disputa pelo GIL dele não entrem nos números do cliente.
+        }}} """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_server.py')
+    process = subprocess.Popen(
+        [sys.executable, script, '--port', '0', *args],
+        stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()  # type: ignore
+    if not url:
+        process.kill()
+        raise RuntimeError('Não foi possível abrir o servidor local')
+    return process, url
+    # }}}
+
+
+def stats(url: str) -> Dict[str, int]:  # {{{
+    host = url.split('/paginas/')[0]
+    return req.get(host + '/stats').json()
+    # }}}
+
+
+def measure(name: str, url: str, fn: Callable[[], None], memory: bool = True) -> Result:  # {{{
+    """Mede fn duas vezes: o tempo sem o tracemalloc e, se memory, o pico
+    de memória com ele (que deixa o código bem mais lento). }}} """
+    before = stats(url)
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    after = stats(url)
+    requests = sum(after[k] - before[k] for k in ('page', 'area', 'state', 'export'))
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return Result(name, seconds, requests, after['bytes'] - before['bytes'], peak)
+    # }}}
+
+
+def bootstrap(url: str) -> Callable[[], None]:  # {{{
+    def run():
+        Sisab().close()
+    return run
+    # }}}
+
+
+def get_data(url: str, count: int) -> Callable[[], None]:  # {{{
+    """count exportações de municípios, trocando de estado a cada uma. """
+    s = Sisab()
+    s.area = 'ibge'
+    s.update_state(look_into='estadoMunicipio')
+    states = list(s.state_options)
+    period, index, view = list(s.period_options)[0], list(s.index_options)[0], \
+        list(s.view_options)[0]
+
+    def run():
+        for i in range(count):
+            s.get_data('ibge', io.StringIO(), state=states[i % len(states)],
+                       period=period, index=index, view=view)
+    return run
+    # }}}
+
+
+def parse(url: str, repeat: int) -> Callable[[], None]:  # {{{
+    """Somente o parse: página inicial, resposta parcial e CSV, já baixados. """
+    s = Sisab()
+    s.area = 'ibge'
+    s.update_state(look_into='estadoMunicipio')
+    state = list(s.state_options)[0]
+    transport = s.transport
+    page = transport.get(Sisab.URL).text
+    form = {
+        'j_idt50': 'j_idt50', 'javax.faces.ViewState': jsf.parse(page).view_state,
+        'selectLinha': 'ibge', 'estadoMunicipio': state,
+    }
+    partial = transport.post(Sisab.URL, headers=Sisab.HEADERS,
+                             params={**form, **Sisab.STATE_CHANGE}).text
+    csv = transport.post(Sisab.URL, headers=Sisab.HEADERS, params={
+        **form, 'coIndicador': list(s.index_options)[0],
+        'quadrimestre': list(s.period_options)[0],
+        'visaoEquipe': list(s.view_options)[0], 'j_idt84': 'j_idt84'}).content
+    s.close()
+
+    def run():
+        for _ in range(repeat):
+            jsf.parse(page)
+            jsf.parse(partial)
+            writer = SectionWriter(io.StringIO(), True)
+            for i in range(0, len(csv), Sisab.CHUNK_SIZE):
+                writer.feed(csv[i:i + Sisab.CHUNK_SIZE])
+            writer.close()
+    return run
+    # }}}
+
+
+def matrix(url: str, workers: int) -> Callable[[], None]:  # {{{
+    """A opção 1 do __main__: todos os estados, quadrimestres e indicadores
+    no nível de municípios, com o mesmo manifesto e a mesma saída
+    particionada, num diretório temporário (sempre uma extração do zero). """
+    def run():
+        s = Sisab()
+        s.area = 'ibge'
+        s.view = 0
+        s.update_state(look_into='estadoMunicipio')
+        tasks = slices(s, [s.view])
+        with tempfile.TemporaryDirectory() as root, \
+                Crawler(workers, sessions=[s]) as crawler:
+            manifest = Manifest(os.path.join(root, 'out.manifest'))
+            with PartitionedWriter(os.path.join(root, 'out'), keys=('period', 'index')) as writer:
+                export(crawler, tasks, manifest, writer)
+    return run
+    # }}}
+
+
+def report(results: List[Result]) -> str:  # {{{
+    lines = ['{:<12} {:>10} {:>8} {:>10} {:>12} {:>12}'.format(
+        'benchmark', 'tempo (s)', 'req', 'req/s', 'MB servidos', 'pico (MB)')]
+    for r in results:
+        lines.append('{:<12} {:>10.3f} {:>8} {:>10.1f} {:>12.2f} {:>12}'.format(
+            r.name, r.seconds, r.requests, r.rate, r.bytes / 1024 ** 2,
+            '-' if r.peak is None else '{:.2f}'.format(r.peak / 1024 ** 2)))
+    return '\n'.join(lines)
+    # }}}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks do Sisab contra um servidor local (fake_server.py)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='espera do servidor em cada resposta, em segundos')
+    parser.add_argument('--export-latency', type=float, default=None,
+                        help='espera das exportações (padrão: --latency)')
+    parser.add_argument('--municipalities', type=int, default=50,
+                        help='municípios por estado')
+    parser.add_argument('--periods', type=int, default=3)
+    parser.add_argument('--columns', type=int, default=0,
+                        help='colunas extras nos CSVs')
+    parser.add_argument('--exports', type=int, default=50,
+                        help='exportações do benchmark get_data')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='repetições do benchmark de parse')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='não mede o pico de memória')
+    parser.add_argument('--only', nargs='*',
+                        choices=['bootstrap', 'get_data', 'parse', 'matrix'])
+    parser.add_argument('--json', help='salva os resultados neste arquivo')
+    args = parser.parse_args()
+
+    server_args = ['--latency', str(args.latency), '--municipalities', str(args.municipalities),
+                   '--periods', str(args.periods), '--columns', str(args.columns)]
+    if args.export_latency is not None:
+        server_args += ['--export-latency', str(args.export_latency)]
+    process, url = serve(*server_args)
+    Sisab.URL = url
+    try:
+        benchmarks = {
+            'bootstrap': lambda: bootstrap(url),
+            'get_data': lambda: get_data(url, args.exports),
+            'parse': lambda: parse(url, args.repeat),
+            'matrix': lambda: matrix(url, args.workers),
+        }
+        results = []
+        for name, prepare in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            results.append(measure(name, url, prepare(), not args.no_memory))
+            print(results[-1].name, '{:.3f}s'.format(results[-1].seconds),
+                  file=sys.stderr)
+        print(report(results))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump([dict(r._asdict(), rate=r.rate) for r in results], f, indent=2)
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,238 @@
+from typing import Iterable, Iterator, Optional, Tuple
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+# Campos do formulário que definem o conteúdo de uma exportação. O
+# ViewState (e o resto do formulário) muda a cada sessão e fica de fora.
+KEY_FIELDS = (
+    'selectLinha', 'regiao', 'estados', 'estadoMunicipio', 'municipios',
+    'coIndicador', 'quadrimestre', 'visaoEquipe'
+)
+
+
+class Entry:  # {{{
+    """Resposta sendo gravada no cache (veja ResponseCache.begin). {{{
+
+        Nada entra no cache até commit, que só deve ser chamado depois que
+        a resposta foi lida e conferida (o CSV tem as três seções...), para
+        que uma resposta ruim não seja servida do cache nas próximas vezes.
+
+            entry = cache.begin(key, content_type)
+            try:
+                write_csv(entry.tee(chunks))
+            except BaseException:
+                entry.abort()
+                raise
+            entry.commit()
+            }}} """
+
+    def __init__(self, cache: 'ResponseCache', key: str, content_type: str):  # {{{
+        self.cache = cache
+        self.key = key
+        self.content_type = content_type
+        self.__digest__ = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        raw = os.fdopen(fd, 'wb')
+        self.__file__ = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=cache.level) \
+            if cache.compress else raw
+        self.__raw__ = raw
+        # }}}
+
+    def write(self, chunk: bytes):  # {{{
+        self.__digest__.update(chunk)
+        self.__file__.write(chunk)
+        # }}}
+
+    def tee(self, chunks: Iterable[bytes]) -> Iterator[bytes]:  # {{{
+        """Devolve os pedaços da resposta, gravando cada um. }}} """
+        for chunk in chunks:
+            self.write(chunk)
+            yield chunk
+        # }}}
+
+    def commit(self):  # {{{
+        self.__file__.close()
+        self.__raw__.close()
+        self.cache.__store__(self.key, self.content_type,
+                             self.__digest__.hexdigest(), self.path)
+        # }}}
+
+    def abort(self):  # {{{
+        self.__file__.close()
+        self.__raw__.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        # }}}
+    # }}}
+
+
+class ResponseCache:  # {{{
+    """Cache em disco das exportações CSV, endereçado pelo conteúdo. {{{
+
+        A chave de cada exportação é o SHA-256 dos campos do formulário que
+        definem o conteúdo (KEY_FIELDS), sem o ViewState. O corpo da
+        resposta é guardado em objects/ com o nome igual ao SHA-256 do
+        próprio conteúdo, então exportações iguais ocupam um só arquivo.
+        Quando o tamanho total passa de max_size, os objetos usados há
+        mais tempo são removidos (LRU).
+
+        @param directory
+                Diretório do cache
+        @param max_size
+                Tamanho máximo em bytes dos objetos guardados (já comprimidos)
+        @param compress
+                Comprime os objetos com gzip
+        @param level
+                Nível de compressão do gzip
+                }}} """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS objects (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            digest TEXT NOT NULL REFERENCES objects (digest),
+            content_type TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS objects_accessed ON objects (accessed);
+    '''
+
+    def __init__(
+        self,
+        directory: str = '.sisab-cache',
+        max_size: int = 1024 ** 3,
+        compress: bool = True,
+        level: int = 6
+    ):  # {{{
+        self.directory = directory
+        self.max_size = max_size
+        self.compress = compress
+        self.level = level
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        # As sessões do crawler usam o mesmo cache em threads diferentes
+        self.__lock__ = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.connection.executescript(ResponseCache.SCHEMA)
+        # }}}
+
+    @staticmethod
+    def key(form: dict) -> Optional[str]:  # {{{
+        """Chave da exportação, ou None se o formulário não é de exportação. }}} """
+        if 'j_idt84' not in form:
+            return None
+        fields = []
+        for k in KEY_FIELDS:
+            v = form.get(k)
+            if v is None or len(v) == 0:
+                continue
+            fields.append((k, [str(i) for i in v] if isinstance(v, (tuple, list)) else str(v)))
+        return hashlib.sha256(json.dumps(fields).encode('utf-8')).hexdigest()
+        # }}}
+
+    def __object__(self, digest: str) -> str:  # {{{
+        return os.path.join(self.directory, 'objects', digest)
+        # }}}
+
+    def get(self, key: str) -> Optional[Tuple[str, Iterator[bytes]]]:  # {{{
+        """Content-Type e os pedaços da resposta guardada, se houver. }}} """
+        with self.__lock__:
+            row = self.connection.execute(
+                'SELECT digest, content_type FROM entries WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            digest, content_type = row
+            # O objeto é aberto com o lock, antes que outra thread o remova
+            # do cache (__evict__); depois de aberto ele pode ser lido mesmo
+            # se for removido
+            path = self.__object__(digest)
+            try:
+                f = gzip.open(path, 'rb') if self.compress else open(path, 'rb')
+            except FileNotFoundError:
+                with self.connection:
+                    self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE objects SET accessed = ? WHERE digest = ?',
+                    (time.time(), digest))
+        return content_type, self.__read__(f)
+        # }}}
+
+    def __read__(self, f, chunk_size: int = 64 * 1024) -> Iterator[bytes]:  # {{{
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        # }}}
+
+    def begin(self, key: str, content_type: str) -> Entry:  # {{{
+        return Entry(self, key, content_type)
+        # }}}
+
+    def __store__(self, key: str, content_type: str, digest: str, tmp: str):  # {{{
+        path = self.__object__(digest)
+        with self.__lock__:
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, path)
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                    (digest, os.path.getsize(path), time.time()))
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                    (key, digest, content_type))
+            self.__evict__()
+        # }}}
+
+    def __evict__(self):  # {{{
+        total, = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()
+        while total > self.max_size:
+            row = self.connection.execute(
+                'SELECT digest, size FROM objects ORDER BY accessed LIMIT 1').fetchone()
+            if row is None:
+                break
+            digest, size = row
+            with self.connection:
+                self.connection.execute('DELETE FROM entries WHERE digest = ?', (digest,))
+                self.connection.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+            try:
+                os.remove(self.__object__(digest))
+            except OSError:
+                pass  # Já removido, ou aberto por um get no Windows
+            total -= size
+        # }}}
+
+    def remove(self, key: str):  # {{{
+        with self.__lock__, self.connection:
+            self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+        # }}}
+
+    def size(self) -> int:  # {{{
+        with self.__lock__:
+            return self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        # }}}
+
+    def close(self):  # {{{
+        self.connection.close()
+        # }}}
+    # }}}
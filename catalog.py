@@ -0,0 +1,220 @@
+from typing import Dict, Iterable, Iterator, Mapping, Optional, Tuple, Union
+import json
+import os
+import time
+import unicodedata
+
+
+Options = Dict[str, str]
+
+
+def normalize(text: str) -> str:  # {{{
+    """Texto em minúsculas e sem acentos, para comparar nomes. }}} """
+    text = unicodedata.normalize('NFKD', text.strip())
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    # }}}
+
+
+class OptionIndex(Mapping[str, str]):  # {{{
+    """Opções de um select (código -> nome), imutáveis e indexadas. {{{
+
+        Além de ser um Mapping somente leitura (sem cópias a cada acesso),
+        guarda a posição de cada código e, montados no primeiro uso, os
+        índices de nome normalizado -> código e de prefixo IBGE -> código.
+        Assim escolher uma opção por código, posição, nome ou código IBGE
+        com ou sem o dígito verificador custa O(1), e escolher k opções,
+        O(k) (mais a ordenação das posições).
+
+            options = OptionIndex({'120001': 'Acrelândia', ...})
+            options.find('acrelandia')  # '120001'
+            options.find('1200013')     # '120001' (IBGE com dígito)
+            options.select([0, 2])      # ('120001', '120020')
+            }}} """
+
+    def __init__(self, options: Mapping[str, str] = dict()):  # {{{
+        self.__options__: Dict[str, str] = dict(options)
+        self.__codes__: Tuple[str, ...] = tuple(self.__options__)
+        self.__positions__ = {c: i for i, c in enumerate(self.__codes__)}
+        self.__normalized__: Optional[Dict[str, str]] = None
+        self.__names__: Optional[Dict[str, str]] = None
+        self.__prefixes__: Optional[Dict[str, str]] = None
+        # }}}
+
+    def __getitem__(self, code: str) -> str: return self.__options__[code]
+    def __iter__(self) -> Iterator[str]: return iter(self.__codes__)
+    def __len__(self) -> int: return len(self.__codes__)
+    def __contains__(self, code) -> bool: return code in self.__options__
+    def __repr__(self): return 'OptionIndex({!r})'.format(self.__options__)
+
+    @property
+    def codes(self) -> Tuple[str, ...]: return self.__codes__
+
+    def code(self, position: int) -> str:  # {{{
+        return self.__codes__[position]
+        # }}}
+
+    def position(self, code: str) -> int:  # {{{
+        return self.__positions__[code]
+        # }}}
+
+    @property
+    def normalized(self) -> Dict[str, str]:  # {{{
+        """Nome normalizado (veja normalize) de cada código. }}} """
+        if self.__normalized__ is None:
+            self.__normalized__ = {
+                c: normalize(n) for c, n in self.__options__.items()}
+        return self.__normalized__
+        # }}}
+
+    def __name_index__(self) -> Dict[str, str]:  # {{{
+        if self.__names__ is None:
+            names: Dict[str, str] = dict()
+            for c, n in self.normalized.items():
+                names.setdefault(n, c)
+            self.__names__ = names
+        return self.__names__
+        # }}}
+
+    def __prefix_index__(self) -> Dict[str, str]:  # {{{
+        # Códigos IBGE de 7 dígitos (com o verificador) pelos 6 primeiros
+        if self.__prefixes__ is None:
+            self.__prefixes__ = {
+                c[:6]: c for c in self.__codes__ if len(c) == 7 and c.isdigit()}
+        return self.__prefixes__
+        # }}}
+
+    def find(self, value: str) -> Optional[str]:  # {{{
+        """Código da opção pelo código, pelo código IBGE com ou sem o dígito
+        verificador ou pelo nome (sem diferenciar acentos e maiúsculas). }}} """
+        if value in self.__options__:
+            return value
+        if value.isdigit():
+            if len(value) == 7 and value[:6] in self.__options__:
+                return value[:6]
+            if len(value) == 6:
+                return self.__prefix_index__().get(value)
+            return None
+        return self.__name_index__().get(normalize(value))
+        # }}}
+
+    def select(self, values: Iterable[Union[str, int]]) -> Tuple[str, ...]:  # {{{
+        """Códigos de várias opções, por posição ou como em find. {{{
+
+            Posições são devolvidas na ordem das opções (sem repetições),
+            como o select do navegador envia. Levanta IndexError para uma
+            posição inexistente e KeyError para um valor não encontrado.
+            }}} """
+        values = tuple(values)
+        if all(type(v) == int for v in values):
+            positions = sorted(set(values))  # type: ignore
+            if positions and (positions[0] < 0 or positions[-1] >= len(self.__codes__)):
+                raise IndexError(positions[0] if positions[0] < 0 else positions[-1])
+            return tuple(self.__codes__[i] for i in positions)
+        codes = []
+        for v in values:
+            code = self.find(v) if isinstance(v, str) else None
+            if code is None:
+                raise KeyError(v)
+            codes.append(code)
+        return tuple(codes)
+        # }}}
+    # }}}
+
+
+class CatalogStore:  # {{{
+    """Catálogo em disco com todas as opções do painel do Sisab. {{{
+
+        As opções (quadrimestres, indicadores, visões, níveis, regiões,
+        estados e municípios de cada estado) mudam poucas vezes por ano,
+        então são salvas em JSON e reaproveitadas enquanto estiverem dentro
+        do prazo de validade. Um Sisab criado com um catálogo válido não
+        precisa buscar as opções no servidor.
+
+        @param path
+                Caminho do arquivo JSON do catálogo
+        @param ttl
+                Validade do catálogo em segundos
+                }}} """
+
+    # 2: os estados dos níveis uf e ibge ficam separados
+    VERSION = 2
+    TTL = 7 * 24 * 60 * 60
+
+    def __init__(self, path: str = 'catalog.json', ttl: float = TTL):  # {{{
+        self.path = path
+        self.ttl = ttl
+        # }}}
+
+    def load(self) -> Optional[dict]:  # {{{
+        """Lê o catálogo. Devolve None se ele não existe, é de outra versão
+        ou está vencido. }}} """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != CatalogStore.VERSION:
+            return None
+        if time.time() - data.get('created', 0) > self.ttl:
+            return None
+        return data
+        # }}}
+
+    def save(self, data: dict) -> dict:  # {{{
+        data = dict(data, version=CatalogStore.VERSION, created=time.time())
+        # Escreve em um arquivo temporário para não corromper o catálogo
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        return data
+        # }}}
+
+    def refresh(self, sisab) -> dict:  # {{{
+        """Busca todas as opções no servidor usando a sessão passada e
+        salva o catálogo. São 3 + (quantidade de estados) requisições. {{{
+
+            Os estados do nível uf (select "estados") ficam em 'state' e os
+            do nível ibge (select "estadoMunicipio"), que são as chaves de
+            'municipality', em 'municipality_state': o servidor não garante
+            que as duas listas sejam iguais.
+            }}} """
+        data = {
+            'area': {k: v for k, v in sisab.area_options.items() if k != ''},
+            'period': dict(sisab.period_options),
+            'index': dict(sisab.index_options),
+            'view': dict(sisab.view_options),
+        }
+        sisab.area = 'regiao'
+        sisab.update_region()
+        data['region'] = dict(sisab.region_options)
+        sisab.area = 'uf'
+        sisab.update_state()
+        data['state'] = dict(sisab.state_options)
+
+        sisab.area = 'ibge'
+        sisab.update_state(look_into='estadoMunicipio')
+        data['municipality_state'] = dict(sisab.state_options)
+        municipality: Dict[str, Options] = dict()
+        for uf in sisab.state_options:
+            sisab.state = uf
+            sisab.update_municipality()
+            municipality[uf] = dict(sisab.municipality_options)
+        data['municipality'] = municipality
+
+        return self.save(data)
+        # }}}
+
+    def ensure(self, sisab) -> dict:  # {{{
+        """Devolve o catálogo salvo ou o atualiza se estiver vencido. }}} """
+        data = self.load()
+        return data if data is not None else self.refresh(sisab)
+        # }}}
+
+    def clear(self):  # {{{
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        # }}}
+    # }}}
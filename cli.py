@@ -0,0 +1,546 @@
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import fnmatch
+import os
+import queue
+import random
+import sys
+import threading
+from SISAB import Sisab
+from batch import Batcher, batches
+from cache import ResponseCache
+from catalog import CatalogStore, OptionIndex, normalize
+from metrics import registry, track
+from pipeline import Pipeline, default_processes, to_csv, to_rows
+from planner import Planner, selection
+from rollup import LEVELS, REGIONS, Rollup, sources
+from storage import STRIP, PartitionedWriter, Row, SQLiteSink
+from transport import AdaptiveLimiter, Transport
+from workqueue import DONE, Worker, WorkQueue
+
+
+Task = Dict[str, object]
+
+AREAS = ('nacional', 'regiao', 'uf', 'ibge')
+FORMATS = ('csv', 'files', 'partitioned', 'sqlite')
+COMPRESSIONS = ('gzip', 'zstd', 'none')
+
+
+def match(
+    options: Mapping[str, str],
+    patterns: Optional[Sequence[str]],
+    name: str,
+    strict: bool = True
+) -> List[str]:  # {{{
+    """Códigos das opções escolhidas pelos padrões, na ordem das opções. {{{
+
+        Cada padrão é um código, um nome ou um código IBGE (como em
+        OptionIndex.find) ou, se tiver *, ? ou [, um padrão do fnmatch
+        comparado com o código e com o nome, sem diferenciar acentos e
+        maiúsculas. Sem padrões, todas as opções são escolhidas. Se strict,
+        um padrão que não escolhe nenhuma opção é um erro (ValueError).
+        }}} """
+    if not patterns:
+        return list(options)
+    index = options if isinstance(options, OptionIndex) else OptionIndex(options)
+    chosen = set()
+    for pattern in patterns:
+        if not any(c in pattern for c in '*?['):
+            code = index.find(pattern)
+            found = [code] if code is not None else []
+        else:
+            p = normalize(pattern)
+            found = [c for c, n in index.normalized.items()
+                     if fnmatch.fnmatchcase(c.lower(), p) or fnmatch.fnmatchcase(n, p)]
+        if not found and strict:
+            raise ValueError('Nenhuma opção de {} corresponde a "{}"'.format(name, pattern))
+        chosen.update(found)
+    return [c for c in index if c in chosen]
+    # }}}
+
+
+def build(data: dict, args: argparse.Namespace) -> List[Task]:  # {{{
+    """Tarefas (argumentos de get_data) da matriz filtrada. {{{
+
+        Uma exportação por nível, entidade (região, estado ou, no nível
+        de municípios, estado com os municípios escolhidos), período,
+        indicador e visão.
+        }}} """
+    periods = match(data['period'], args.period, 'período')
+    indexes = match(data['index'], args.index, 'indicador')
+    views = match(data['view'], args.view, 'visão')
+
+    def states(area: str) -> List[str]:
+        # Os níveis uf e ibge têm selects de estados próprios
+        key = 'municipality_state' if area == 'ibge' else 'state'
+        return match(data[key], args.state, 'estado')
+
+    entities: List[Task] = []
+    for area in args.area:
+        if area == 'nacional':
+            entities.append({'area': area})
+        elif area == 'regiao':
+            entities += [{'area': area, 'region': r}
+                         for r in match(data['region'], args.region, 'região')]
+        elif area == 'uf':
+            entities += [{'area': area, 'state': uf} for uf in states(area)]
+        elif args.municipality:
+            # Cada padrão precisa escolher municípios em algum dos estados
+            municipalities = {uf: OptionIndex(data['municipality'].get(uf, dict()))
+                              for uf in states(area)}
+            for pattern in args.municipality:
+                if not any(match(m, [pattern], 'município', False)
+                           for m in municipalities.values()):
+                    raise ValueError(
+                        'Nenhuma opção de município corresponde a "{}"'.format(pattern))
+            for uf, m in municipalities.items():
+                chosen = match(m, args.municipality, 'município', False)
+                if chosen:
+                    entities.append({'area': area, 'state': uf, 'municipality': tuple(chosen)})
+        else:
+            entities += [{'area': area, 'state': uf} for uf in states(area)]
+
+    return [dict(e, period=p, index=i, view=v)
+            for p in periods for i in indexes for v in views for e in entities]
+    # }}}
+
+
+def identity(task: Task) -> Tuple:  # {{{
+    return tuple(task.get(k) for k in ('area', 'region', 'state', 'period', 'index', 'view'))
+    # }}}
+
+
+def name_key(name: str) -> str:  # {{{
+    # Nome normalizado e só com letras e dígitos ("Centro Oeste" = "Centro-Oeste")
+    return ''.join(c for c in normalize(name) if c.isalnum())
+    # }}}
+
+
+def derive(tasks: List[Task], data: dict) -> Tuple[List[Task], List[Tuple[Task, Task]]]:  # {{{
+    """Troca as tarefas uf, regiao e nacional pelas exportações de
+    municípios de que elas precisam (veja rollup.sources). {{{
+
+        Os selects de estados dos níveis uf e ibge e o de regiões não têm
+        necessariamente os mesmos códigos, então cada tarefa derivada é
+        traduzida pelo nome para os códigos IBGE (o estado do select do
+        nível ibge e o primeiro dígito dele para a região), que são os que
+        o Rollup usa. Devolve (tarefas para o servidor, [(tarefa derivada,
+        tarefa com os códigos IBGE)]).
+        }}} """
+    fetch = [t for t in tasks if t['area'] not in LEVELS]
+    derived = [t for t in tasks if t['area'] in LEVELS]
+    known = set(identity(t) for t in fetch)
+    states = OptionIndex(data['municipality_state'])
+    if derived and not all(c.isdigit() for c in states):
+        raise ValueError('--derive precisa dos códigos IBGE no select de estados do nível ibge')
+    regions = {name_key(n): str(c) for c, n in REGIONS.items()}
+    targets = []
+    for task in derived:
+        target = task
+        if task['area'] == 'uf':
+            # O estado vem do select do nível uf; as exportações de
+            # municípios usam o código do select do nível ibge
+            code = states.find(data['state'].get(task['state'], str(task['state'])))
+            if code is None and task['state'] in states:
+                code = task['state']
+            if code is None:
+                raise ValueError('Estado {} não existe no nível ibge'.format(task['state']))
+            target = dict(task, state=code)
+        elif task['area'] == 'regiao':
+            code = regions.get(name_key(data['region'].get(task['region'], '')))
+            if code is None:
+                raise ValueError('Região {} não corresponde a uma região do IBGE ({})'
+                                 .format(task['region'], ', '.join(REGIONS.values())))
+            target = dict(task, region=code)
+        targets.append((task, target))
+        for source in sources(target, states):
+            if identity(source) not in known:
+                known.add(identity(source))
+                fetch.append(source)
+    return fetch, targets
+    # }}}
+
+
+def exports(tasks: List[Task], batch_size: int = 1) -> List[List[Task]]:  # {{{
+    """Tarefas de cada exportação: uma por tarefa ou, com batch_size > 1,
+    os lotes do Batcher. """
+    if batch_size > 1:
+        return batches(tasks, batch_size)
+    return [[t] for t in tasks]
+    # }}}
+
+
+def partition(tasks: List[Task], workers: int, batch_size: int = 1) -> List[List[Task]]:  # {{{
+    """Divide as tarefas entre as sessões, mantendo juntas as que precisam
+    da mesma seleção no servidor (e as de um mesmo lote). Grupos maiores
+    que a parte de cada sessão são quebrados para que todas trabalhem. }}} """
+    units = exports(tasks, batch_size)
+    groups: Dict[Tuple, List[List[Task]]] = dict()
+    for unit in units:
+        groups.setdefault(selection(unit[0]), []).append(unit)
+    size = max(1, -(-len(units) // workers))
+    chunks = [[t for unit in g[i:i + size] for t in unit]
+              for g in groups.values() for i in range(0, len(g), size)]
+    chunks.sort(key=len, reverse=True)
+    parts: List[List[Task]] = [[] for _ in range(min(workers, len(chunks)))]
+    for chunk in chunks:
+        min(parts, key=len).extend(chunk)
+    return parts
+    # }}}
+
+
+def cost(parts: List[List[Task]], batch_size: int = 1) -> Dict[str, int]:  # {{{
+    """Requisições HTTP de cada tipo que as partes vão fazer. {{{
+
+        Cada sessão criada com um catálogo válido faz só o GET inicial, e
+        depois as atualizações e exportações do seu plano. Repetições de
+        requisições que falharem (e lotes divididos de novo) não entram na
+        conta, e exportações que já estiverem no cache não vão para a rede.
+        }}} """
+    result = {'sessions': len(parts), 'bootstrap': len(parts), 'updates': 0, 'exports': 0}
+    for part in parts:
+        for step, _ in Planner(part).plan():
+            if step != 'export':
+                result['updates'] += 1
+        result['exports'] += len(exports(part, batch_size))
+    result['total'] = result['bootstrap'] + result['updates'] + result['exports']
+    return result
+    # }}}
+
+
+def filename(task: Task) -> str:  # {{{
+    entity = task.get('region') or task.get('state') or 'BR'
+    if task.get('municipality'):
+        entity = '{}-{}'.format(entity, '+'.join(task['municipality'])  # type: ignore
+                                if len(task['municipality']) <= 3  # type: ignore
+                                else '{}mun'.format(len(task['municipality'])))  # type: ignore
+    return '{}_{}_{}_{}_{}.csv'.format(
+        task['area'], entity, task['period'], task['index'], task['view'])
+    # }}}
+
+
+def crawl(
+    parts: List[List[Task]],
+    catalog: CatalogStore,
+    cache: Optional[ResponseCache],
+    workers: int,
+    batch_size: int = 1
+):  # {{{
+    """Executa cada parte na sua sessão e devolve (tarefa, texto) conforme
+    as fatias ficam prontas. No máximo 2 * workers fatias esperam para
+    serem escritas. Com batch_size > 1, as exportações vão em lotes (veja
+    batch.Batcher). """
+    transport = Transport(pool_size=workers, limiter=AdaptiveLimiter(maximum=workers))
+    results: 'queue.Queue' = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def work(part: List[Task]):
+        try:
+            with Sisab(transport.fork(), catalog, cache) as s:
+                planner = Planner(part)
+                items = Batcher(s, batch_size).run(planner.order(s.active)) \
+                    if batch_size > 1 else planner.run(s)
+                for item in items:
+                    if stop.is_set():
+                        return
+                    put(item)
+        finally:
+            put(done)
+
+    with ThreadPoolExecutor(max(1, len(parts))) as executor:
+        futures = [executor.submit(work, part) for part in parts]
+        try:
+            finished = 0
+            while finished < len(parts):
+                item = results.get()
+                if item is done:
+                    finished += 1
+                else:
+                    yield item
+        finally:
+            stop.set()
+        for f in futures:
+            f.result()
+    transport.close()
+    # }}}
+
+
+def parser() -> argparse.ArgumentParser:  # {{{
+    p = argparse.ArgumentParser(
+        prog='cli.py',
+        description='Extrai os indicadores do Sisab sem interação. Os filtros '
+        'aceitam códigos, nomes ou padrões com * e ?; sem filtro, todas as opções.')
+    p.add_argument('--area', nargs='+', choices=AREAS, default=['ibge'],
+                   help='níveis de visualização (padrão: ibge)')
+    p.add_argument('--region', nargs='+', metavar='REGIAO')
+    p.add_argument('--state', nargs='+', metavar='UF')
+    p.add_argument('--municipality', nargs='+', metavar='MUNICIPIO',
+                   help='municípios (nível ibge), por código, código IBGE ou nome')
+    p.add_argument('--period', nargs='+', metavar='QUADRIMESTRE')
+    p.add_argument('--index', nargs='+', metavar='INDICADOR')
+    p.add_argument('--view', nargs='+', metavar='VISAO')
+    p.add_argument('--format', choices=FORMATS, default='csv',
+                   help='csv: uma tabela só; files: um CSV por exportação; '
+                   'partitioned: um CSV comprimido por período, indicador e visão; '
+                   'sqlite: banco de dados (padrão: csv)')
+    p.add_argument('--compression', choices=COMPRESSIONS, default='gzip',
+                   help='compressão do formato partitioned (padrão: gzip)')
+    p.add_argument('-o', '--output', help='arquivo ou diretório de saída '
+                   '(padrão: out.csv, arquivos/, particoes/ ou sisab.db)')
+    p.add_argument('-w', '--workers', type=int, default=4,
+                   help='sessões simultâneas (padrão: 4)')
+    p.add_argument('-b', '--batch-size', type=int, default=1, metavar='N',
+                   help='estados (nível uf) ou municípios (nível ibge) exportados '
+                   'juntos em cada requisição; 1 exporta um por vez (padrão: 1)')
+    p.add_argument('-p', '--processes', type=int, default=default_processes(),
+                   help='processos que convertem as fatias em linhas; 0 converte '
+                   'na thread do download (padrão: {})'.format(default_processes()))
+    p.add_argument('--derive', action='store_true',
+                   help='calcula os níveis uf, regiao e nacional a partir das '
+                   'exportações de municípios, sem pedi-los ao servidor (precisa do numpy)')
+    p.add_argument('--verify', type=int, default=0, metavar='N',
+                   help='com --derive, compara N exportações derivadas com as do servidor')
+    p.add_argument('--queue', metavar='ARQUIVO',
+                   help='fila compartilhada (SQLite) para dividir a extração entre '
+                   'processos ou máquinas; sem --enqueue nem --work, escreve a '
+                   'saída com as exportações já concluídas na fila')
+    p.add_argument('--enqueue', action='store_true',
+                   help='com --queue, só coloca as exportações filtradas na fila')
+    p.add_argument('--work', action='store_true',
+                   help='com --queue, baixa as exportações da fila com --workers '
+                   'sessões até ela esvaziar')
+    p.add_argument('--cache-dir', help='cache das exportações em disco')
+    p.add_argument('--catalog', default='catalog.json',
+                   help='catálogo de opções (padrão: catalog.json)')
+    p.add_argument('--update-catalog', action='store_true',
+                   help='busca o catálogo no servidor mesmo se estiver válido')
+    p.add_argument('--metrics', help='salva as métricas (.prom: Prometheus, senão JSON)')
+    p.add_argument('--url', help='endereço do painel (por exemplo o do fake_server.py)')
+    p.add_argument('-n', '--dry-run', action='store_true',
+                   help='só mostra quantas requisições seriam feitas')
+    p.add_argument('-q', '--quiet', action='store_true')
+    return p
+    # }}}
+
+
+def extract(
+    args: argparse.Namespace,
+    output: str,
+    results,
+    requested: List[Task],
+    derived: List[Tuple[Task, Task]],
+    sample: List[Task],
+    store: CatalogStore,
+    cache: Optional[ResponseCache],
+    log
+) -> int:  # {{{
+    """Extração com --derive: as exportações de municípios alimentam o
+    Rollup e vão para a saída se foram pedidas, e as tarefas derivadas saem
+    do Rollup no fim. Devolve 1 se a verificação encontrar diferenças. """
+    rollup = Rollup()
+    wanted = set(identity(t) for t in requested)
+
+    def run(output_rows):
+        def write(task, rows):
+            rollup.add_rows(rows)
+            if identity(task) in wanted:
+                output_rows(rows)
+        Pipeline(to_rows, args.processes).run(results, write)
+        for _, target in derived:
+            output_rows(rollup.rows(target))
+
+    if args.format == 'csv':
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(Row._fields)
+            run(writer.writerows)
+    else:
+        with SQLiteSink(output) as sink:
+            run(sink.insert)
+
+    mismatches = 0
+    if sample:
+        log('\nVerificando {} exportações derivadas...'.format(len(sample)))
+        for task, text in crawl([sample], store, cache, 1):
+            for m in rollup.check(task, text):
+                mismatches += 1
+                print('Diferença em {} {} {} {} {}: servidor {}, local {}'.format(
+                    task['area'], m.server.state, task['period'], task['index'], task['view'],
+                    m.server[-3:], m.local[-3:] if m.local else None), file=sys.stderr)
+        log('{} diferenças'.format(mismatches))
+    return 1 if mismatches else 0
+    # }}}
+
+
+def work(args: argparse.Namespace, store: CatalogStore, log) -> int:  # {{{
+    """Consome a fila com args.workers sessões neste processo. """
+    transport = Transport(pool_size=args.workers,
+                          limiter=AdaptiveLimiter(maximum=args.workers))
+    cache = ResponseCache(args.cache_dir) if args.cache_dir else None
+    stop = threading.Event()
+    with WorkQueue(args.queue) as work_queue:
+        workers = [Worker(work_queue, transport, store, cache, batch=max(8, args.batch_size),
+                          batch_size=args.batch_size) for _ in range(args.workers)]
+        try:
+            with ThreadPoolExecutor(args.workers) as executor:
+                futures = [executor.submit(w.run, stop) for w in workers]
+                done = sum(f.result() for f in futures)
+        finally:
+            stop.set()
+            transport.close()
+            if cache is not None:
+                cache.close()
+        counts = work_queue.counts()
+    log('{} exportações baixadas; na fila: {pending} pendentes, {leased} emprestadas, '
+        '{done} concluídas, {failed} com falha'.format(done, **counts))
+    return 1 if counts['failed'] else 0
+    # }}}
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:  # {{{
+    args = parser().parse_args(argv)
+    if args.workers < 1:
+        print('A quantidade de workers deve ser positiva', file=sys.stderr)
+        return 2
+    if args.batch_size < 1:
+        print('O tamanho do lote deve ser positivo', file=sys.stderr)
+        return 2
+    log = (lambda *a: None) if args.quiet else \
+        (lambda *a: print(*a, file=sys.stderr))
+    if args.url:
+        Sisab.URL = args.url
+    if (args.enqueue or args.work) and not args.queue:
+        print('--enqueue e --work precisam de --queue', file=sys.stderr)
+        return 2
+    if args.queue and args.derive:
+        print('--derive não funciona com --queue', file=sys.stderr)
+        return 2
+
+    store = CatalogStore(args.catalog)
+    data = None if args.update_catalog else store.load()
+    if data is None:
+        if args.dry_run and not args.update_catalog:
+            print('Catálogo {} inexistente ou vencido; rode sem --dry-run para '
+                  'buscá-lo no servidor'.format(args.catalog), file=sys.stderr)
+            return 2
+        log('Buscando o catálogo de opções...')
+        with Sisab() as s:
+            data = store.refresh(s)
+    if args.work:
+        return work(args, store, log)
+
+    try:
+        tasks = build(data, args)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    derived: List[Tuple[Task, Task]] = []
+    sample: List[Task] = []
+    fetch = tasks
+    if args.derive:
+        if args.format not in ('csv', 'sqlite') or args.municipality:
+            print('--derive só funciona com os formatos csv e sqlite e sem '
+                  '--municipality', file=sys.stderr)
+            return 2
+        try:
+            fetch, derived = derive(tasks, data)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        # A verificação pede ao servidor as tarefas como foram filtradas
+        sample = [task for task, _ in random.Random(0).sample(
+            derived, min(args.verify, len(derived)))]
+    parts = partition(fetch, args.workers, args.batch_size)
+    # A verificação usa uma sessão a mais, depois da extração, sem lotes
+    requests = cost(parts, args.batch_size)
+    if sample:
+        extra = cost([sample])
+        requests = {k: v + extra[k] for k, v in requests.items()}
+    log('{} exportações em {sessions} sessões: {total} requisições '
+        '({bootstrap} iniciais, {updates} atualizações, {exports} exportações)'
+        .format(len(tasks), **requests))
+    if args.dry_run:
+        print(requests['total'])
+        return 0
+
+    strip = None if args.format == 'files' else STRIP
+    for t in fetch + sample:
+        t['strip'] = strip
+    if args.queue and args.enqueue:
+        with WorkQueue(args.queue) as work_queue:
+            log('{} exportações novas na fila {}'.format(work_queue.put(fetch), args.queue))
+        return 0
+    output = args.output or {'csv': 'out.csv', 'files': 'arquivos',
+                             'partitioned': 'particoes', 'sqlite': 'sisab.db'}[args.format]
+    cache = ResponseCache(args.cache_dir) if args.cache_dir else None
+
+    total = len(tasks)
+    if args.queue:
+        # A saída sai das exportações concluídas na fila
+        work_queue = WorkQueue(args.queue)
+        counts = work_queue.counts()
+        total = counts[DONE]
+        if total < sum(counts.values()):
+            log('Atenção: {} de {} exportações da fila ainda não foram concluídas'
+                .format(sum(counts.values()) - total, sum(counts.values())))
+        results = track(work_queue.results())
+    else:
+        results = track(crawl(parts, store, cache, args.workers, args.batch_size))
+
+    if not args.quiet and sys.stderr.isatty():
+        def progress(event):
+            if event.name == 'task':
+                print('\033[2K\r{}/{}'.format(event.data['position'] + 1, total),
+                      end='', file=sys.stderr)
+        registry.subscribe(progress)
+    try:
+        if args.derive:
+            return extract(args, output, results, [t for t in tasks if t['area'] not in LEVELS],
+                           derived, sample, store, cache, log)
+        # Download, conversão (em outros processos) e escrita em paralelo
+        if args.format == 'csv':
+            with open(output, 'w', newline='') as f:
+                csv.writer(f, delimiter=';').writerow(Row._fields)
+                Pipeline(to_csv, args.processes).run(
+                    results, lambda task, text: f.write(text))
+        elif args.format == 'files':
+            os.makedirs(output, exist_ok=True)
+            for task, text in results:
+                with open(os.path.join(output, filename(task)), 'w') as f:
+                    f.write(text)
+        elif args.format == 'partitioned':
+            compression = None if args.compression == 'none' else args.compression
+            with PartitionedWriter(output, compression=compression) as writer:
+                for task, text in results:
+                    writer.write(task, text)
+        else:
+            with SQLiteSink(output) as sink:
+                Pipeline(to_rows, args.processes).run(
+                    results, lambda task, rows: sink.insert(rows))
+    finally:
+        if cache is not None:
+            cache.close()
+        if args.queue:
+            work_queue.close()
+        if args.metrics:
+            with open(args.metrics, 'w') as f:
+                f.write(registry.to_prometheus() if args.metrics.endswith('.prom')
+                        else registry.to_json())
+    log()
+    return 0
+    # }}}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from SISAB import Sisab, run_task
+from planner import selection
+from cache import ResponseCache
+from catalog import CatalogStore
+from metrics import Metrics
+from transport import AdaptiveLimiter, Transport
+
+
+Task = Dict[str, object]
+
+
+class Crawler:  # {{{
+    """Distribui as chamadas de Sisab.get_data entre várias sessões. {{{
+
+        O ViewState do JSF é um estado do servidor atrelado a uma sessão,
+        então cada worker usa a sua própria instância do Sisab (com cookies
+        e ViewState independentes). As sessões compartilham apenas o pool
+        de conexões e o controle de concorrência: workers é o máximo, mas
+        o transporte padrão começa com menos requisições simultâneas e vai
+        aumentando enquanto o servidor responde bem (veja AdaptiveLimiter).
+
+        @param workers
+                Quantidade máxima de requisições simultâneas (e de sessões)
+        @param transport
+                Transporte base cujo pool de conexões é compartilhado
+        @param sessions
+                Instâncias do Sisab já prontas para serem reaproveitadas
+        @param catalog
+                Catálogo de opções usado ao abrir novas sessões
+        @param cache
+                Cache das exportações compartilhado pelas sessões
+        @param metrics
+                Onde as sessões novas publicam os tempos das requisições
+                }}} """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        transport: Optional[Transport] = None,
+        sessions: Iterable[Sisab] = (),
+        catalog: Optional[CatalogStore] = None,
+        cache: Optional[ResponseCache] = None,
+        metrics: Optional[Metrics] = None
+    ):  # {{{
+        if workers < 1:
+            raise ValueError('A quantidade de workers deve ser positiva')
+        self.workers = workers
+        self.catalog = catalog
+        self.cache = cache
+        self.metrics = metrics
+        self.__transport__ = transport if transport is not None \
+            else Transport(pool_size=workers,
+                           limiter=AdaptiveLimiter(maximum=workers))
+
+        self.__lock__ = threading.Condition()
+        self.__idle__: List[Sisab] = []
+        self.__all_sessions__: List[Sisab] = []
+        for s in sessions:
+            self.__all_sessions__.append(s)
+            self.__idle__.append(s)
+        # }}}
+
+    def __acquire__(self, task: Task) -> Sisab:  # {{{
+        # Prefere uma sessão que já tenha a seleção da tarefa ativa no
+        # servidor, evitando refazer as atualizações AJAX
+        wanted = selection(task)
+        with self.__lock__:
+            while True:
+                for s in self.__idle__:
+                    if selection(s.active) == wanted:
+                        self.__idle__.remove(s)
+                        return s
+                if len(self.__all_sessions__) < self.workers:
+                    # Reserva a vaga antes de abrir a sessão fora do lock
+                    self.__all_sessions__.append(None)  # type: ignore
+                    break
+                if self.__idle__:
+                    return self.__idle__.pop(0)
+                self.__lock__.wait()
+        try:
+            s = Sisab(self.__transport__.fork(), self.catalog, self.cache, self.metrics)
+        except BaseException:
+            with self.__lock__:
+                self.__all_sessions__.remove(None)  # type: ignore
+                self.__lock__.notify()
+            raise
+        with self.__lock__:
+            self.__all_sessions__[self.__all_sessions__.index(None)] = s  # type: ignore
+        return s
+        # }}}
+
+    def __release__(self, s: Sisab):  # {{{
+        with self.__lock__:
+            self.__idle__.append(s)
+            self.__lock__.notify()
+        # }}}
+
+    def __discard__(self, s: Sisab):  # {{{
+        # Uma sessão que falhou pode ter ficado com o ViewState inválido
+        with self.__lock__:
+            self.__all_sessions__.remove(s)
+            self.__lock__.notify()
+        s.close()
+        # }}}
+
+    def __fetch__(self, task: Task) -> str:  # {{{
+        s = self.__acquire__(task)
+        try:
+            text = run_task(s, task)
+        except BaseException:
+            self.__discard__(s)
+            raise
+        self.__release__(s)
+        return text
+        # }}}
+
+    def map(self, tasks: Iterable[Task]) -> Iterator[Tuple[Task, str]]:  # {{{
+        """Executa as tarefas em paralelo e devolve os resultados em ordem. {{{
+
+            Cada tarefa é um dicionário com os argumentos de Sisab.get_data
+            (area, strip, state, period, index, view, ...). Os resultados
+            são devolvidos na mesma ordem das tarefas, de modo que a saída
+            é idêntica à de uma execução serial. No máximo 2 * workers
+            tarefas ficam pendentes ao mesmo tempo.
+            }}} """
+        pending: Deque[Tuple[Task, Future]] = deque()
+        with ThreadPoolExecutor(self.workers) as executor:
+            try:
+                for task in tasks:
+                    if len(pending) >= 2 * self.workers:
+                        t, f = pending.popleft()
+                        yield t, f.result()
+                    pending.append((task, executor.submit(self.__fetch__, task)))
+                while pending:
+                    t, f = pending.popleft()
+                    yield t, f.result()
+            finally:
+                for _, f in pending:
+                    f.cancel()
+        # }}}
+
+    def run(
+        self,
+        tasks: Iterable[Task],
+        output: Union[str, TextIO, None] = None
+    ) -> None:  # {{{
+        """Executa as tarefas e salva os resultados. {{{
+
+            @param output
+                    Arquivo onde os resultados são concatenados em ordem
+                    Tarefas com a chave 'file' são salvas no próprio arquivo
+                    }}} """
+        sink = open(output, 'w') if isinstance(output, str) else output
+        try:
+            for task, text in self.map(tasks):
+                if 'file' in task:
+                    with open(task['file'], 'w') as f:  # type: ignore
+                        f.write(text)
+                elif sink is not None:
+                    sink.write(text)
+        finally:
+            if isinstance(output, str) and sink is not None:
+                sink.close()
+        # }}}
+
+    def close(self):  # {{{
+        with self.__lock__:
+            sessions = [s for s in self.__all_sessions__ if s is not None]
+            self.__all_sessions__.clear()
+            self.__idle__.clear()
+        for s in sessions:
+            s.close()
+        self.__transport__.close()
+        # }}}
+
+    def __enter__(self): return self
+    def __exit__(self, *_): self.close()
+    # }}}
@@ -0,0 +1,431 @@
+from typing import Dict, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import html
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+
+# Códigos IBGE e siglas das unidades da federação
+STATES = {
+    '11': 'RO', '12': 'AC', '13': 'AM', '14': 'RR', '15': 'PA', '16': 'AP',
+    '17': 'TO', '21': 'MA', '22': 'PI', '23': 'CE', '24': 'RN', '25': 'PB',
+    '26': 'PE', '27': 'AL', '28': 'SE', '29': 'BA', '31': 'MG', '32': 'ES',
+    '33': 'RJ', '35': 'SP', '41': 'PR', '42': 'SC', '43': 'RS', '50': 'MS',
+    '51': 'MT', '52': 'GO', '53': 'DF',
+}
+REGIONS = {
+    '1': 'Norte', '2': 'Nordeste', '3': 'Sudeste', '4': 'Sul', '5': 'Centro-Oeste',
+}
+# Códigos próprios do select de regiões, sem relação com os do IBGE
+REGION_CODES = {'N': '1', 'NE': '2', 'SE': '3', 'S': '4', 'CO': '5'}
+AREAS = {
+    'nacional': 'Nacional', 'regiao': 'Região', 'uf': 'Estado', 'ibge': 'Município',
+}
+INDICATORS = {
+    '1': 'Pré-Natal (6 consultas)',
+    '2': 'Pré-Natal (Sífilis e HIV)',
+    '3': 'Gestantes Saúde Bucal',
+    '4': 'Cobertura Citopatológico',
+    '5': 'Cobertura Polio e Penta',
+    '6': 'Hipertensão (PA Aferida)',
+    '7': 'Diabetes (Hemoglobina Glicada)',
+}
+VIEWS = {'00': 'Todas as equipes', '01': 'Equipes homologadas'}
+
+
+def period_options(count: int) -> Dict[str, str]:  # {{{
+    """Os quadrimestres mais antigos primeiro, a partir de 2018. }}} """
+    result = dict()
+    for i in range(count):
+        year, q = 2018 + i // 3, i % 3 + 1
+        result['{}{:02d}'.format(year, q)] = '{} - Q{}'.format(year, q)
+    return result
+    # }}}
+
+
+class Server(ThreadingHTTPServer):  # {{{
+    def handle_error(self, request, client_address):  # {{{
+        # Um cliente que desiste da conexão (cancelado ou com timeout) não
+        # é um erro do servidor
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+        # }}}
+    # }}}
+
+
+def options(values: Dict[str, str], empty: bool = True) -> str:  # {{{
+    text = '<option value="">Selecione</option>' if empty else ''
+    return text + ''.join(
+        '<option value="{}">{}</option>'.format(k, html.escape(v))
+        for k, v in values.items())
+    # }}}
+
+
+class FakeSisab:  # {{{
+    """Servidor local que imita o indicadorPainel.xhtml do Sisab. {{{
+
+        Atende as mesmas requisições que o Sisab faz: o GET inicial (que
+        abre a sessão com um cookie JSESSIONID e traz o ViewState), as
+        atualizações AJAX de selectLinha e estadoMunicipio (partial-response
+        do JSF) e as exportações CSV em três seções, em ISO-8859-1. Um
+        ViewState diferente do da sessão recebe o erro ViewExpired, como no
+        servidor real.
+
+            with FakeSisab(latency=0.05, municipalities=200) as server:
+                Sisab.URL = server.url
+                ...
+
+        @param latency
+                Espera em segundos antes de cada resposta
+        @param export_latency
+                Espera das exportações (padrão: a mesma de latency)
+        @param municipalities
+                Quantidade de municípios de cada estado
+        @param periods
+                Quantidade de quadrimestres
+        @param columns
+                Colunas numéricas extras em cada linha dos CSVs
+        @param rotate
+                Gera um ViewState novo a cada atualização AJAX
+        @param error_rate
+                Fração das requisições respondidas com 503
+        @param seed
+                Semente dos valores dos CSVs e dos erros
+        @param ibge_codes
+                Os selects de estados do nível uf e de regiões usam os
+                códigos IBGE, como o de estados do nível ibge; com False
+                usam as siglas e abreviações (N, NE...), que não batem
+                com os códigos do nível ibge
+                }}} """
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        latency: float = 0.0,
+        export_latency: Optional[float] = None,
+        municipalities: int = 50,
+        periods: int = 3,
+        columns: int = 0,
+        rotate: bool = False,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        ibge_codes: bool = True
+    ):  # {{{
+        self.latency = latency
+        self.export_latency = latency if export_latency is None else export_latency
+        self.municipalities = municipalities
+        self.period_options = period_options(periods)
+        self.columns = columns
+        self.rotate = rotate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        # Código de cada opção dos selects dos níveis uf e regiao -> código IBGE
+        self.state_codes = {uf: uf for uf in STATES} if ibge_codes else \
+            {sigla: uf for uf, sigla in STATES.items()}
+        self.region_codes = {r: r for r in REGIONS} if ibge_codes else REGION_CODES
+
+        self.sessions: Dict[str, Dict[str, str]] = dict()
+        self.stats: Dict[str, int] = {
+            'page': 0, 'area': 0, 'state': 0, 'export': 0, 'expired': 0,
+            'error': 0, 'bytes': 0,
+        }
+        self.__lock__ = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Cabeçalhos e corpo saem em escritas separadas; com o Nagle
+            # cada resposta esperaria o ACK atrasado do cliente (~40 ms)
+            disable_nagle_algorithm = True
+
+            def log_message(self, *_): pass
+            def do_GET(self): server.__page_request__(self)
+            def do_POST(self): server.__form_request__(self)
+
+        self.server = Server((host, port), Handler)
+        self.server.daemon_threads = True
+        self.__thread__: Optional[threading.Thread] = None
+        # }}}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/paginas/acessoRestrito/relatorio/federal/' \
+            'indicadores/indicadorPainel.xhtml'.format(host, port)
+
+    def start(self) -> 'FakeSisab':  # {{{
+        self.__thread__ = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.__thread__.start()
+        return self
+        # }}}
+
+    def stop(self):  # {{{
+        self.server.shutdown()
+        self.server.server_close()
+        # }}}
+
+    def __enter__(self): return self.start()
+    def __exit__(self, *_): self.stop()
+
+    def municipality_options(self, uf: str) -> Dict[str, str]:  # {{{
+        return {
+            '{}{:04d}'.format(uf, i): 'Município {} {}'.format(STATES[uf], i)
+            for i in range(self.municipalities)
+        }
+        # }}}
+
+    def __count__(self, kind: str, size: int = 0):  # {{{
+        with self.__lock__:
+            self.stats[kind] += 1
+            self.stats['bytes'] += size
+        # }}}
+
+    def __send__(
+        self,
+        handler: BaseHTTPRequestHandler,
+        body: bytes,
+        content_type: str,
+        headers: List[Tuple[str, str]] = [],
+        status: int = 200
+    ):  # {{{
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.wfile.write(body)
+        # }}}
+
+    def __failed__(self, handler: BaseHTTPRequestHandler) -> bool:  # {{{
+        with self.__lock__:
+            failed = self.error_rate > 0 and self.random.random() < self.error_rate
+        if failed:
+            self.__count__('error')
+            self.__send__(handler, b'', 'text/html', [('Retry-After', '0')], 503)
+        return failed
+        # }}}
+
+    def __page_request__(self, handler: BaseHTTPRequestHandler):  # {{{
+        if urlparse(handler.path).path == '/stats':
+            with self.__lock__:
+                body = json.dumps(self.stats).encode('utf-8')
+            return self.__send__(handler, body, 'application/json')
+        time.sleep(self.latency)
+        if self.__failed__(handler):
+            return
+        session, view_state = uuid.uuid4().hex, uuid.uuid4().hex
+        with self.__lock__:
+            self.sessions[session] = {'view_state': view_state}
+        body = self.__page__(view_state).encode('utf-8')
+        self.__count__('page', len(body))
+        self.__send__(handler, body, 'text/html;charset=UTF-8',
+                      [('Set-Cookie', 'JSESSIONID={}; Path=/; HttpOnly'.format(session))])
+        # }}}
+
+    def __page__(self, view_state: str) -> str:  # {{{
+        return (
+            '<!DOCTYPE html><html><head><title>Painel de Indicadores</title></head><body>'
+            '<form id="j_idt50" name="j_idt50" method="post">'
+            '<select id="selectLinha" name="selectLinha" size="1">{}</select>'
+            '<select id="quadrimestre" name="quadrimestre" size="1">{}</select>'
+            '<select id="coIndicador" name="coIndicador" size="1">{}</select>'
+            '<select id="visaoEquipe" name="visaoEquipe" size="1">{}</select>'
+            '<div id="regioes"></div>'
+            '<input type="hidden" name="javax.faces.ViewState" '
+            'id="javax.faces.ViewState" value="{}" autocomplete="off" />'
+            '</form></body></html>'
+        ).format(options(AREAS), options(self.period_options), options(INDICATORS),
+                 options(VIEWS, False), view_state)
+        # }}}
+
+    def __form__(self, handler: BaseHTTPRequestHandler) -> Dict[str, List[str]]:  # {{{
+        form = parse_qs(urlparse(handler.path).query)
+        size = int(handler.headers.get('Content-Length') or 0)
+        if size:
+            for k, v in parse_qs(handler.rfile.read(size).decode('utf-8')).items():
+                form.setdefault(k, []).extend(v)
+        return form
+        # }}}
+
+    def __session__(self, handler: BaseHTTPRequestHandler) -> Optional[Dict[str, str]]:  # {{{
+        cookies = handler.headers.get('Cookie', '')
+        for cookie in cookies.split(';'):
+            k, _, v = cookie.strip().partition('=')
+            if k == 'JSESSIONID':
+                with self.__lock__:
+                    return self.sessions.get(v)
+        return None
+        # }}}
+
+    def __form_request__(self, handler: BaseHTTPRequestHandler):  # {{{
+        form = self.__form__(handler)
+
+        def field(name: str) -> str:
+            return form.get(name, [''])[0]
+
+        export = field('j_idt84') != ''
+        time.sleep(self.export_latency if export else self.latency)
+        if self.__failed__(handler):
+            return
+        session = self.__session__(handler)
+        if session is None or field('javax.faces.ViewState') != session['view_state']:
+            self.__count__('expired')
+            body = ('<?xml version="1.0" encoding="UTF-8"?><partial-response><error>'
+                    '<error-name>class javax.faces.application.ViewExpiredException</error-name>'
+                    '<error-message><![CDATA[viewId:/paginas/acessoRestrito/relatorio/federal/'
+                    'indicadores/indicadorPainel.xhtml]]></error-message>'
+                    '</error></partial-response>').encode('utf-8')
+            return self.__send__(handler, body, 'text/xml;charset=UTF-8')
+
+        if field('javax.faces.partial.ajax') == 'true':
+            return self.__update__(handler, session, field)
+        if export:
+            return self.__export__(handler, form, field)
+        body = self.__page__(session['view_state']).encode('utf-8')
+        self.__count__('page', len(body))
+        self.__send__(handler, body, 'text/html;charset=UTF-8')
+        # }}}
+
+    def __update__(self, handler, session, field):  # {{{
+        area = field('selectLinha')
+        if field('javax.faces.source') == 'estadoMunicipio':
+            uf = field('estadoMunicipio')
+            kind = 'state'
+            inner = '<select id="estadoMunicipio" name="estadoMunicipio">{}</select>' \
+                '<select id="municipios" name="municipios" multiple="multiple">{}</select>' \
+                .format(options(STATES), options(self.municipality_options(uf)
+                                                 if uf in STATES else dict()))
+        else:
+            kind = 'area'
+            inner = {
+                'regiao': '<select id="regiao" name="regiao" multiple="multiple">{}</select>'
+                .format(options({c: REGIONS[r] for c, r in self.region_codes.items()})),
+                'uf': '<select id="estados" name="estados" multiple="multiple">{}</select>'
+                .format(options({c: STATES[uf] for c, uf in self.state_codes.items()})),
+                'ibge': '<select id="estadoMunicipio" name="estadoMunicipio">{}</select>'
+                .format(options(STATES)),
+            }.get(area, '')
+        if self.rotate:
+            with self.__lock__:
+                session['view_state'] = uuid.uuid4().hex
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?><partial-response id="j_id1"><changes>'
+            '<update id="regioes"><![CDATA[<div id="regioes">{}</div>]]></update>'
+            '<update id="script"><![CDATA[<script>PrimeFaces.cw();</script>]]></update>'
+            '<update id="javax.faces.ViewState"><![CDATA[{}]]></update>'
+            '</changes></partial-response>'
+        ).format(inner, session['view_state']).encode('utf-8')
+        self.__count__(kind, len(body))
+        self.__send__(handler, body, 'text/xml;charset=UTF-8')
+        # }}}
+
+    def __values__(self, key: str, municipality: str) -> Tuple[int, int]:  # {{{
+        """Numerador e denominador do município, que dependem só da fatia. }}} """
+        rnd = random.Random('{}|{}'.format(key, municipality))
+        numerator = rnd.randint(0, 5000)
+        return numerator, numerator + rnd.randint(1, 5000)
+        # }}}
+
+    def __totals__(self, key: str, states: List[str]) -> Tuple[int, int]:  # {{{
+        """Soma dos municípios dos estados, como nos níveis acima no Sisab. }}} """
+        numerator = denominator = 0
+        for uf in states:
+            for m in self.municipality_options(uf):
+                n, d = self.__values__(key, m)
+                numerator += n
+                denominator += d
+        return numerator, denominator
+        # }}}
+
+    def __row__(self, rnd: random.Random, keys: List[str], values: Tuple[int, int]) -> str:  # {{{
+        numerator, denominator = values
+        fields = [str(numerator), str(denominator),
+                  '{:.0f}'.format(100 * numerator / denominator)]
+        fields += [str(rnd.randint(0, 100000)) for _ in range(self.columns)]
+        return ';'.join(keys + fields)
+        # }}}
+
+    def __export__(self, handler, form, field):  # {{{
+        area = field('selectLinha')
+        key = '{}|{}|{}'.format(field('quadrimestre'), field('coIndicador'), field('visaoEquipe'))
+        # As colunas extras dependem só da fatia, como no servidor real
+        rnd = random.Random('{}|{}'.format(area, key))
+        extra = ''.join(';Coluna {}'.format(i + 1) for i in range(self.columns))
+        tail = ';Numerador;Denominador;Resultado(%)' + extra
+        if area == 'ibge':
+            uf = field('estadoMunicipio')
+            municipalities = self.municipality_options(uf) if uf in STATES else dict()
+            selected = form.get('municipios') or list(municipalities)
+            header = 'Uf;IBGE;Municipio' + tail
+            rows = [self.__row__(rnd, [STATES[uf], m, municipalities[m]], self.__values__(key, m))
+                    for m in selected if m in municipalities]
+        elif area == 'uf':
+            selected = [self.state_codes[c] for c in form.get('estados') or self.state_codes
+                        if c in self.state_codes]
+            header = 'Uf' + tail
+            rows = [self.__row__(rnd, [STATES[uf]], self.__totals__(key, [uf]))
+                    for uf in selected]
+        elif area == 'regiao':
+            selected = [self.region_codes[c] for c in form.get('regiao') or self.region_codes
+                        if c in self.region_codes]
+            header = 'Região' + tail
+            # O primeiro dígito do código IBGE do estado é o da região
+            rows = [self.__row__(rnd, [REGIONS[r]], self.__totals__(
+                key, [uf for uf in STATES if uf[0] == r])) for r in selected]
+        else:
+            header = 'Brasil' + tail
+            rows = [self.__row__(rnd, ['Brasil'], self.__totals__(key, list(STATES)))]
+
+        text = '\n'.join([
+            'Ministério da Saúde',
+            'Secretaria de Atenção Primária à Saúde',
+            'Indicador: {}'.format(INDICATORS.get(field('coIndicador'), '')),
+            'Quadrimestre: {}'.format(self.period_options.get(field('quadrimestre'), '')),
+            'Visão de equipe: {}'.format(VIEWS.get(field('visaoEquipe'), '')),
+        ]) + '\n\n\n' + '\n'.join([header] + rows) + \
+            '\n\n\nFonte: SISAB. Dados gerados em {}'.format(time.strftime('%d/%m/%Y'))
+        body = text.encode('ISO-8859-1')
+        self.__count__('export', len(body))
+        self.__send__(handler, body, 'text/csv;charset=ISO-8859-1', [
+            ('Content-Disposition', 'attachment; filename="painel.csv"')])
+        # }}}
+    # }}}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Servidor local que imita o Sisab')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--export-latency', type=float, default=None)
+    parser.add_argument('--municipalities', type=int, default=50)
+    parser.add_argument('--periods', type=int, default=3)
+    parser.add_argument('--columns', type=int, default=0)
+    parser.add_argument('--rotate', action='store_true')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--no-ibge-codes', dest='ibge_codes', action='store_false',
+                        help='siglas e abreviações nos selects de estados (uf) e regiões')
+    args = parser.parse_args()
+
+    server = FakeSisab(args.host, args.port, args.latency, args.export_latency,
+                       args.municipalities, args.periods, args.columns,
+                       args.rotate, args.error_rate, ibge_codes=args.ibge_codes)
+    # A primeira linha é lida pelo benchmark para descobrir a porta
+    print(server.url, flush=True)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
@@ -0,0 +1,51 @@
+from typing import Dict, Iterable, List, Set, Tuple
+from manifest import Manifest
+
+
+Task = Dict[str, object]
+
+
+def stored(manifest: Manifest) -> Set[Tuple[str, str]]:  # {{{
+    """Pares (período, indicador) já salvos no manifesto. }}} """
+    return set((str(t.get('period', '')), str(t.get('index', '')))
+               for t in manifest.tasks())
+    # }}}
+
+
+def revised(periods: Iterable[str], window: int = 1) -> Set[str]:  # {{{
+    """Os quadrimestres mais recentes, que ainda podem ser revisados. {{{
+
+        Os códigos dos quadrimestres crescem com o tempo (ano seguido do
+        quadrimestre), então os mais recentes são os maiores.
+        }}} """
+    if window <= 0:
+        return set()
+    return set(sorted(periods, reverse=True)[:window])
+    # }}}
+
+
+def select(
+    tasks: Iterable[Task],
+    manifest: Manifest,
+    window: int = 1
+) -> List[Task]:  # {{{
+    """Tarefas de uma atualização incremental que são baixadas de novo. {{{
+
+        As tarefas novas ou que faltam o Manifest.map já baixa sozinho;
+        aqui ficam as que já estão salvas e são dos `window` quadrimestres
+        mais recentes (vindos das opções atuais do Sisab), que ainda podem
+        ter mudado no servidor. O resultado é o refresh de Manifest.map:
+
+            refresh = select(tasks, manifest, window)
+            for task, text in manifest.map(crawler, tasks, refresh):
+                ...
+
+        @param window
+                Quantidade de quadrimestres recentes baixados de novo
+                }}} """
+    tasks = list(tasks)
+    done = stored(manifest)
+    recent = revised(set(str(t['period']) for t in tasks), window)
+    return [t for t in tasks
+            if str(t['period']) in recent and (str(t['period']), str(t['index'])) in done]
+    # }}}
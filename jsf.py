@@ -0,0 +1,83 @@
+from typing import Dict, NamedTuple, Optional, Set
+from html import unescape
+import re
+
+
+# Um único tokenizador para a página inicial (HTML) e para as respostas
+# parciais do JSF (XML com o HTML dentro de CDATA). Só interessam os
+# selects com suas opções e o ViewState, então o resto do documento é
+# ignorado sem montar uma árvore.
+TOKEN = re.compile(
+    r'<update\s+id="(?P<update>[^"]*)"\s*>\s*(?:<!\[CDATA\[)?(?P<content>[^<\]]*)'
+    r'|<(?P<tag>select|option|input)\b(?P<attrs>[^>]*)>(?P<text>[^<]*)'
+    r'|(?P<close></select\s*>)',
+    re.IGNORECASE
+)
+ATTR = re.compile(r'([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+VIEW_STATE = 'javax.faces.ViewState'
+
+
+class Page(NamedTuple):
+    view_state: Optional[str]
+    selects: Dict[str, Dict[str, str]]
+    updates: Set[str]
+
+
+def attributes(attrs: str) -> Dict[str, str]:  # {{{
+    return {
+        k.lower(): unescape(v if v else w)
+        for k, v, w in ATTR.findall(attrs)
+    }
+    # }}}
+
+
+def parse(text: str) -> Page:  # {{{
+    """Extrai o ViewState e as opções de todos os selects em uma só passada. {{{
+
+        Funciona tanto para a página completa (input hidden do ViewState)
+        quanto para a resposta parcial do JSF (<update> do ViewState).
+        As opções são devolvidas na ordem do documento, inclusive as de
+        valor vazio, por select:
+
+            Page(view_state, {'estadoMunicipio': {'12': 'AC', ...}, ...},
+                 {'regioes', 'javax.faces.ViewState'})
+            }}} """
+    view_state = None
+    selects: Dict[str, Dict[str, str]] = dict()
+    updates: Set[str] = set()
+    current: Optional[Dict[str, str]] = None
+
+    for m in TOKEN.finditer(text):
+        tag = m.group('tag')
+        if tag is None:
+            if m.group('close') is not None:
+                current = None
+                continue
+            updates.add(m.group('update'))
+            if m.group('update').endswith(VIEW_STATE):
+                view_state = unescape(m.group('content').strip())
+            continue
+
+        tag = tag.lower()
+        if tag == 'option':
+            if current is not None:
+                value = attributes(m.group('attrs')).get('value', '')
+                current[value] = unescape(m.group('text'))
+        elif tag == 'select':
+            current = selects.setdefault(
+                attributes(m.group('attrs')).get('id', ''), dict())
+        elif view_state is None:
+            attrs = attributes(m.group('attrs'))
+            if attrs.get('id') == VIEW_STATE:
+                view_state = attrs.get('value', '')
+
+    return Page(view_state, selects, updates)
+    # }}}
+
+
+def options(page: Page, select: str) -> Dict[str, str]:  # {{{
+    """Opções do select sem a opção vazia ("Selecione"). }}} """
+    if select not in page.selects:
+        raise TypeError('Não foi possível encontrar a Tag de id', select)
+    return {k: v for k, v in page.selects[select].items() if k != ''}
+    # }}}
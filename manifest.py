@@ -0,0 +1,218 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import hashlib
+import json
+import os
+
+
+Task = Dict[str, object]
+
+
+class Manifest:  # {{{
+    """Registro das fatias já baixadas, para retomar uma extração. {{{
+
+        O texto de cada fatia (uma chamada de get_data) é acrescentado a um
+        único arquivo de dados e o manifesto (JSON, uma linha por fatia)
+        guarda a posição, o tamanho e o SHA-256 dela. Uma fatia só entra
+        no manifesto depois que os dados estão no disco, então uma extração
+        interrompida (timeout, ViewState vencido, Ctrl-C) perde no máximo
+        as fatias em andamento. Na próxima execução as fatias completas e
+        íntegras são lidas do disco e somente as que faltam (ou estão
+        corrompidas) são baixadas de novo.
+
+            manifest = Manifest('out.manifest')
+            with open('out.csv', 'w') as f:
+                for task, text in manifest.map(crawler, tasks):
+                    f.write(text)
+
+        Uma fatia baixada de novo (refresh) é acrescentada de novo, e a
+        cópia antiga fica sem uso no arquivo de dados. Quando as cópias sem
+        uso passam de compact_at do arquivo, ele é reescrito só com as
+        fatias atuais (veja compact), então uma atualização incremental
+        diária não faz os arquivos crescerem sem limite.
+
+        @param path
+                Caminho do manifesto; os dados ficam em path + '.data'
+        @param compact_at
+                Fração do arquivo de dados ocupada por cópias sem uso a
+                partir da qual ele é compactado
+                }}} """
+
+    def __init__(self, path: str = 'crawl.manifest', compact_at: float = 0.5):  # {{{
+        self.path = path
+        self.data_path = path + '.data'
+        self.compact_at = compact_at
+        self.__entries__: Dict[str, dict] = dict()
+        self.__torn__ = False  # A última linha do arquivo ficou sem o '\n'
+        self.__garbage__ = 0  # Bytes de cópias substituídas no arquivo de dados
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.__torn__ = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Linha incompleta de uma execução interrompida
+                    self.__add__(entry)
+        self.__check__()
+        # }}}
+
+    def __add__(self, entry: dict):  # {{{
+        old = self.__entries__.get(entry['key'])
+        if old is not None:
+            self.__garbage__ += old['size']
+        self.__entries__[entry['key']] = entry
+        # }}}
+
+    def __check__(self):  # {{{
+        live = sum(e['size'] for e in self.__entries__.values())
+        if self.__garbage__ > 0 and self.__garbage__ >= self.compact_at * (live + self.__garbage__):
+            self.compact()
+        # }}}
+
+    @staticmethod
+    def key(task: Task) -> str:  # {{{
+        """Identificação da fatia: nível, estado, municípios, período,
+        indicador, visão e seções pedidas. }}} """
+        return json.dumps(task, sort_keys=True, ensure_ascii=False, default=list)
+        # }}}
+
+    def __len__(self): return len(self.__entries__)
+
+    def tasks(self) -> List[Task]:  # {{{
+        """Tarefas registradas no manifesto. }}} """
+        return [json.loads(k) for k in self.__entries__]
+        # }}}
+
+    def read(self, task: Task) -> Optional[str]:  # {{{
+        """Texto da fatia, ou None se ela não existe ou está corrompida. }}} """
+        entry = self.__entries__.get(Manifest.key(task))
+        if entry is None:
+            return None
+        try:
+            with open(self.data_path, 'rb') as f:
+                data = Manifest.__load__(f, entry)
+        except OSError:
+            return None
+        return data.decode('utf-8') if data is not None else None
+        # }}}
+
+    @staticmethod
+    def __load__(f, entry: dict) -> Optional[bytes]:  # {{{
+        f.seek(entry['offset'])
+        data = f.read(entry['size'])
+        if len(data) != entry['size'] or \
+                hashlib.sha256(data).hexdigest() != entry['sha256']:
+            return None
+        return data
+        # }}}
+
+    def done(self, task: Task) -> bool:  # {{{
+        return self.read(task) is not None
+        # }}}
+
+    def pending(self, tasks: Iterable[Task]) -> List[Task]:  # {{{
+        """Tarefas que ainda não foram baixadas ou estão corrompidas. }}} """
+        return [t for t in tasks if not self.done(t)]
+        # }}}
+
+    def record(self, task: Task, text: str):  # {{{
+        data = text.encode('utf-8')
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        entry = {
+            'key': Manifest.key(task),
+            'offset': offset,
+            'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        if self.__torn__:
+            # Termina a linha cortada, senão a entrada nova se junta a ela
+            line, self.__torn__ = '\n' + line, False
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.__add__(entry)
+        # }}}
+
+    def map(
+        self,
+        crawler,
+        tasks: Iterable[Task],
+        refresh: Iterable[Task] = ()
+    ) -> Iterator[Tuple[Task, str]]:  # {{{
+        """Como crawler.map, mas lendo do disco as fatias já completas. {{{
+
+            Somente as tarefas pendentes são passadas para o crawler (ou
+            qualquer objeto com map(tasks) -> (tarefa, texto)). Cada fatia
+            baixada é registrada antes de ser devolvida, e o resultado
+            sai na ordem das tarefas.
+
+            @param refresh
+                    Tarefas baixadas de novo mesmo se já estiverem completas
+                    }}} """
+        tasks = list(tasks)
+        keys = set(Manifest.key(t) for t in refresh)
+        missing = [t for t in tasks
+                   if Manifest.key(t) in keys or not self.done(t)]
+        keys = set(Manifest.key(t) for t in missing)
+        fetched = iter(crawler.map(missing))
+        for task in tasks:
+            if Manifest.key(task) in keys:
+                t, text = next(fetched)
+                self.record(t, text)
+                yield t, text
+            else:
+                yield task, self.read(task)  # type: ignore
+        self.__check__()
+        # }}}
+
+    def compact(self):  # {{{
+        """Reescreve o arquivo de dados e o manifesto só com as fatias atuais
+        e íntegras (as corrompidas saem e voltam a ser pendentes). {{{
+
+            Os dois arquivos novos são escritos ao lado dos antigos e
+            trocados com os.replace. Se a execução parar entre as duas
+            trocas, o SHA-256 não confere e as fatias são baixadas de novo.
+            }}} """
+        if not os.path.exists(self.data_path):
+            self.clear()
+            return
+        entries: Dict[str, dict] = dict()
+        with open(self.data_path, 'rb') as source, \
+                open(self.data_path + '.tmp', 'wb') as f:
+            for key, entry in self.__entries__.items():
+                data = Manifest.__load__(source, entry)
+                if data is None:
+                    continue
+                entries[key] = dict(entry, offset=f.tell())
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.data_path + '.tmp', self.data_path)
+        os.replace(self.path + '.tmp', self.path)
+        self.__entries__ = entries
+        self.__garbage__ = 0
+        self.__torn__ = False
+        # }}}
+
+    def clear(self):  # {{{
+        for path in (self.path, self.data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.__entries__.clear()
+        self.__torn__ = False
+        self.__garbage__ = 0
+        # }}}
+    # }}}
@@ -0,0 +1,174 @@
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from contextlib import contextmanager
+import bisect
+import json
+import threading
+import time
+
+
+# Fases de uma requisição do Sisab, na ordem em que acontecem
+PHASES = ('connect', 'wait', 'transfer', 'parse', 'view_state', 'write')
+# Limites (em segundos) dos baldes dos histogramas
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Event(NamedTuple):
+    name: str  # Fase (veja PHASES), 'request', 'update' ou 'task'
+    kind: str  # Tipo da requisição: page, area, state, export ou form
+    state: str  # Estado selecionado (código), se houver
+    seconds: float
+    size: int = 0  # Bytes lidos ou escritos
+    data: Optional[dict] = None  # Informações extras (tarefa, posição...)
+
+
+Key = Tuple[str, str, str]
+
+
+class Histogram:  # {{{
+    def __init__(self):  # {{{
+        self.buckets = [0] * (len(BUCKETS) + 1)  # O último é +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.size = 0
+        # }}}
+
+    def observe(self, seconds: float, size: int = 0):  # {{{
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.size += size
+        # }}}
+
+    def cumulative(self) -> List[int]:  # {{{
+        result, total = [], 0
+        for n in self.buckets:
+            total += n
+            result.append(total)
+        return result
+        # }}}
+    # }}}
+
+
+class Metrics:  # {{{
+    """Eventos e estatísticas das requisições do Sisab. {{{
+
+        O Sisab publica um Event para cada fase de cada requisição (conexão,
+        espera pelo servidor, transferência, parse, atualização do ViewState
+        e escrita da saída), um 'request' com o tempo total e um 'update'
+        para cada atualização AJAX. Os eventos vão para os assinantes e são
+        agregados em histogramas por (fase, tipo da requisição, estado),
+        exportados em JSON ou no formato texto do Prometheus.
+
+            registry.subscribe(lambda e: print(e.name, e.seconds))
+            s = Sisab()  # usa o registry do módulo
+            ...
+            print(registry.to_prometheus())
+            }}} """
+
+    def __init__(self):  # {{{
+        self.__lock__ = threading.Lock()
+        self.__subscribers__: List[Callable[[Event], None]] = []
+        self.histograms: Dict[Key, Histogram] = dict()
+        # }}}
+
+    def subscribe(self, callback: Callable[[Event], None]):  # {{{
+        with self.__lock__:
+            self.__subscribers__.append(callback)
+        # }}}
+
+    def unsubscribe(self, callback: Callable[[Event], None]):  # {{{
+        with self.__lock__:
+            self.__subscribers__.remove(callback)
+        # }}}
+
+    def emit(self, event: Event):  # {{{
+        key = (event.name, event.kind, event.state)
+        with self.__lock__:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(event.seconds, event.size)
+            subscribers = list(self.__subscribers__)
+        # Os assinantes rodam na thread que publicou o evento
+        for callback in subscribers:
+            callback(event)
+        # }}}
+
+    @contextmanager
+    def timer(self, name: str, kind: str, state: str = '', data: Optional[dict] = None) -> Iterator[dict]:  # {{{
+        """Publica o tempo do bloco; 'size' pode ser preenchido dentro dele:
+
+            with metrics.timer('write', 'export', '12') as t:
+                t['size'] = output.write(text)
+                }}} """
+        extra = {'size': 0}
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            self.emit(Event(name, kind, state, time.perf_counter() - start,
+                            extra['size'], data))
+        # }}}
+
+    def clear(self):  # {{{
+        with self.__lock__:
+            self.histograms.clear()
+        # }}}
+
+    def snapshot(self) -> List[dict]:  # {{{
+        with self.__lock__:
+            items = sorted(self.histograms.items())
+            return [{
+                'name': name, 'kind': kind, 'state': state,
+                'count': h.count, 'seconds': h.sum, 'bytes': h.size,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], h.cumulative())),
+            } for (name, kind, state), h in items]
+        # }}}
+
+    def to_json(self) -> str:  # {{{
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        # }}}
+
+    def to_prometheus(self, prefix: str = 'sisab') -> str:  # {{{
+        lines = [
+            '# HELP {}_seconds Tempo gasto em cada fase das requisições'.format(prefix),
+            '# TYPE {}_seconds histogram'.format(prefix),
+        ]
+        sizes = [
+            '# HELP {}_bytes_total Bytes lidos ou escritos em cada fase'.format(prefix),
+            '# TYPE {}_bytes_total counter'.format(prefix),
+        ]
+        for entry in self.snapshot():
+            labels = 'phase="{name}",kind="{kind}",state="{state}"'.format(**entry)
+            for le, n in entry['buckets'].items():
+                lines.append('{}_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, le, n))
+            lines.append('{}_seconds_sum{{{}}} {}'.format(prefix, labels, entry['seconds']))
+            lines.append('{}_seconds_count{{{}}} {}'.format(prefix, labels, entry['count']))
+            sizes.append('{}_bytes_total{{{}}} {}'.format(prefix, labels, entry['bytes']))
+        return '\n'.join(lines + sizes) + '\n'
+        # }}}
+    # }}}
+
+
+# Registro padrão, compartilhado pelas sessões que não recebem um próprio
+registry = Metrics()
+
+
+def track(
+    results: Iterable[Tuple[dict, str]],
+    metrics: Metrics = registry
+) -> Iterator[Tuple[dict, str]]:  # {{{
+    """Publica um evento 'task' para cada (tarefa, texto) de um crawler. {{{
+
+        O evento traz o tempo esperando pela fatia, o tamanho do texto e,
+        em data, a tarefa e a posição dela, para barras de progresso e
+        outros assinantes.
+        }}} """
+    start = time.perf_counter()
+    for position, (task, text) in enumerate(results):
+        metrics.emit(Event('task', 'export', str(task.get('state', '')),
+                           time.perf_counter() - start, len(text),
+                           {'task': task, 'position': position}))
+        yield task, text
+        start = time.perf_counter()
+    # }}}
@@ -0,0 +1,130 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor
+import csv
+import io
+import os
+import queue
+import threading
+from storage import parse
+
+
+Task = Dict[str, object]
+
+
+def to_rows(task: Task, text: str) -> List[tuple]:  # {{{
+    """Linhas tipadas da fatia, como tuplas (mais baratas de serializar
+    entre processos que Row). }}} """
+    return [tuple(r) for r in parse(text, task)]
+    # }}}
+
+
+def to_csv(task: Task, text: str) -> str:  # {{{
+    """Linhas tipadas da fatia já formatadas como CSV (veja storage.Row). }}} """
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=';').writerows(parse(text, task))
+    return buffer.getvalue()
+    # }}}
+
+
+def default_processes() -> int:  # {{{
+    """Processos padrão: um núcleo fica com a rede e a escrita. }}} """
+    return max(0, (os.cpu_count() or 1) - 1)
+    # }}}
+
+
+class Pipeline:  # {{{
+    """Download, transformação e escrita das fatias em estágios paralelos. {{{
+
+        As fatias baixadas (pares (tarefa, texto) de um crawler) passam por
+        transform em um pool de processos e o resultado é entregue a write
+        na ordem em que as fatias chegaram. Entre os estágios há uma fila
+        de no máximo depth fatias: quando a escrita ou o parse atrasam, a
+        fila enche e o download para de pedir fatias ao crawler, que por
+        sua vez para de baixar (back-pressure), então a memória não cresce.
+
+            pipeline = Pipeline(to_csv)
+            with open('out.csv', 'w') as f:
+                pipeline.run(crawler.map(tasks), lambda task, text: f.write(text))
+
+        @param transform
+                Função (tarefa, texto) -> resultado; precisa ser de nível de
+                módulo para ir para os outros processos
+        @param processes
+                Processos do pool (padrão: veja default_processes())
+                Com 0, transform roda na thread do download
+        @param depth
+                Fatias em andamento entre o download e a escrita
+                (padrão: 2 por processo, no mínimo 2)
+                }}} """
+
+    def __init__(
+        self,
+        transform: Callable[[Task, str], Any],
+        processes: Optional[int] = None,
+        depth: Optional[int] = None
+    ):  # {{{
+        self.transform = transform
+        self.processes = default_processes() if processes is None else processes
+        self.depth = depth if depth is not None else 2 * max(1, self.processes)
+        # }}}
+
+    def run(
+        self,
+        results: Iterable[Tuple[Task, str]],
+        write: Callable[[Task, Any], None]
+    ) -> None:  # {{{
+        pool = ProcessPoolExecutor(self.processes) if self.processes > 0 else None
+        pending: 'queue.Queue' = queue.Queue(self.depth)
+        stop = threading.Event()
+        done = object()
+        errors: List[BaseException] = []
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def download():
+            iterator = iter(results)
+            try:
+                for task, text in iterator:
+                    if stop.is_set():
+                        break
+                    if pool is not None:
+                        future = pool.submit(self.transform, task, text)
+                    else:
+                        future = Future()
+                        try:
+                            future.set_result(self.transform(task, text))
+                        except Exception as e:
+                            future.set_exception(e)
+                    put((task, future))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                close = getattr(iterator, 'close', None)
+                if close is not None:
+                    close()
+                put(done)
+
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                task, future = item
+                write(task, future.result())
+        finally:
+            stop.set()
+            thread.join()
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        if errors:
+            raise errors[0]
+        # }}}
+    # }}}
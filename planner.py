@@ -0,0 +1,82 @@
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+from SISAB import Sisab, run_task, transitions
+
+
+Task = Dict[str, object]
+Step = Tuple[str, object]
+
+
+def selection(task: Task) -> Tuple[Hashable, ...]:  # {{{
+    """Seleção do servidor (nível e, para municípios, estado) que a tarefa
+    precisa ter ativa no ViewState. Também aceita o Sisab.active. }}} """
+    area = task.get('area')
+    if area == 'ibge':
+        return (area, task.get('state'))
+    return (area,)
+    # }}}
+
+
+class Planner:  # {{{
+    """Planeja um lote de exportações com o mínimo de requisições. {{{
+
+        As exportações são agrupadas pela seleção que precisam no servidor
+        (o nível e, no caso dos municípios, o estado), começando pela que
+        já está ativa no ViewState. Assim cada atualização AJAX é feita
+        uma única vez por grupo em vez de uma vez por exportação.
+
+        @param tasks
+                Argumentos de Sisab.get_data (area, state, period, ...)
+        @param reorder
+                Agrupa as tarefas; quando falso, mantém a ordem original
+                }}} """
+
+    def __init__(self, tasks: Iterable[Task], reorder: bool = True):  # {{{
+        self.tasks: List[Task] = list(tasks)
+        self.reorder = reorder
+        # }}}
+
+    def order(self, active: Optional[Dict[str, str]] = None) -> List[Task]:  # {{{
+        if not self.reorder:
+            return list(self.tasks)
+        active = active or dict()
+        groups: Dict[Tuple[Hashable, ...], List[Task]] = dict()
+        groups[selection(active)] = []
+        for task in self.tasks:
+            groups.setdefault(selection(task), []).append(task)
+        return [t for group in groups.values() for t in group]
+        # }}}
+
+    def plan(self, active: Optional[Dict[str, str]] = None) -> List[Step]:  # {{{
+        """Sequência de requisições: atualizações e exportações. {{{
+
+            Cada passo é um par (nome, argumento), por exemplo
+            ('update_state', 'ibge'), ('update_municipality', '12') ou
+            ('export', tarefa).
+            }}} """
+        active = dict(active or dict())
+        steps: List[Step] = []
+        for task in self.order(active):
+            area = str(task['area'])
+            for step in transitions(active, area, task.get('state')):
+                if step == 'update_municipality':
+                    active = {'area': area, 'state': task['state']}  # type: ignore
+                    steps.append((step, task['state']))
+                else:
+                    active = {'area': area}
+                    steps.append((step, area))
+            steps.append(('export', task))
+        return steps
+        # }}}
+
+    def cost(self, active: Optional[Dict[str, str]] = None) -> int:  # {{{
+        """Quantidade de requisições HTTP do plano. }}} """
+        return len(self.plan(active))
+        # }}}
+
+    def run(self, sisab: Sisab) -> Iterator[Tuple[Task, str]]:  # {{{
+        """Executa o plano na sessão e devolve (tarefa, texto) na ordem
+        do plano. }}} """
+        for task in self.order(sisab.active):
+            yield task, run_task(sisab, task)
+        # }}}
+    # }}}
@@ -0,0 +1,225 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+from storage import Row, parse
+
+
+# Regiões pelo primeiro dígito do código IBGE do estado
+REGIONS = {1: 'Norte', 2: 'Nordeste', 3: 'Sudeste', 4: 'Sul', 5: 'Centro-Oeste'}
+# Níveis que podem ser derivados das exportações por município
+LEVELS = ('uf', 'regiao', 'nacional')
+
+Slice = Tuple[str, str, str]  # (período, indicador, visão)
+
+
+class Mismatch(NamedTuple):
+    server: Row
+    local: Optional[Row]  # None se o nível local não tem a entidade
+
+
+class Rollup:  # {{{
+    """Níveis estadual, regional e nacional calculados a partir dos municípios. {{{
+
+        As exportações no nível ibge são guardadas em colunas (arrays do
+        NumPy): fatia, código IBGE, numerador e denominador. O estado e a
+        região de cada linha saem do próprio código IBGE (os dois primeiros
+        dígitos são o estado e o primeiro é a região), então cada nível é
+        um group-by por (fatia, código) com np.bincount, sem pedir ao
+        servidor as exportações uf, regiao e nacional. O resultado de cada
+        grupo é 100 * soma dos numeradores / soma dos denominadores.
+
+            rollup = Rollup()
+            for task, text in crawler.map(tasks):  # area='ibge', strip=STRIP
+                rollup.add(task, text)
+            rows = rollup.aggregate('uf')
+
+        Os níveis só estão completos se todos os municípios de cada fatia
+        foram carregados; check compara uma exportação do servidor com o
+        cálculo local.
+        }}} """
+
+    def __init__(self):  # {{{
+        if np is None:
+            raise ImportError('O Rollup precisa do pacote numpy')
+        self.slices: List[Slice] = []
+        self.__slice_ids__: Dict[Slice, int] = dict()
+        self.__siglas__: Dict[int, str] = dict()  # Código do estado -> sigla
+        self.__pending__: List[Tuple[List[int], List[int], List[float], List[float]]] = []
+        self.__columns__: Optional[Tuple] = None
+        self.__aggregates__: Dict[str, List[Row]] = dict()
+        # }}}
+
+    def __len__(self) -> int:
+        return len(self.__arrays__()[0])
+
+    def add(self, task: dict, text: str):  # {{{
+        """Carrega uma exportação no nível ibge (com a linha das colunas). }}} """
+        if task.get('area') != 'ibge':
+            raise ValueError('Somente exportações no nível ibge podem ser agregadas')
+        self.add_rows(parse(text, task))
+        # }}}
+
+    def add_rows(self, rows: Iterable[Row]):  # {{{
+        """Carrega linhas no nível ibge (Row ou tuplas na mesma ordem, como
+        as do SQLiteSink). }}} """
+        ids, codes, numerators, denominators = [], [], [], []
+        siglas = self.__siglas__
+        # Pelas posições de Row, que aqui custa mais que o resto do laço
+        for _, state, ibge, _, period, index, view, numerator, denominator, _ in rows:
+            if not ibge.isdigit():
+                continue
+            key = (period, index, view)
+            slice_id = self.__slice_ids__.get(key)
+            if slice_id is None:
+                slice_id = self.__slice_ids__[key] = len(self.slices)
+                self.slices.append(key)
+            ids.append(slice_id)
+            codes.append(int(ibge))
+            numerators.append(numerator)
+            denominators.append(denominator)
+            if state and int(ibge[:2]) not in siglas:
+                siglas[int(ibge[:2])] = state
+        if ids:
+            self.__pending__.append((ids, codes, numerators, denominators))
+            self.__columns__ = None
+            self.__aggregates__.clear()
+        # }}}
+
+    def __arrays__(self) -> Tuple:  # {{{
+        # Junta os lotes carregados em colunas só quando alguém precisa delas
+        if self.__columns__ is None:
+            ids, codes, numerators, denominators = [], [], [], []
+            for i, c, n, d in self.__pending__:
+                ids += i
+                codes += c
+                numerators += n
+                denominators += d
+            code = np.array(codes, dtype=np.int64)
+            # Códigos com 7 dígitos têm o verificador no fim
+            state = np.where(code >= 1000000, code // 100000, code // 10000)
+            self.__pending__ = [(ids, codes, numerators, denominators)] if ids else []
+            self.__columns__ = (
+                np.array(ids, dtype=np.int64), state,
+                np.array(numerators, dtype=np.float64),  # None vira NaN
+                np.array(denominators, dtype=np.float64))
+        return self.__columns__
+        # }}}
+
+    def aggregate(self, area: str) -> List[Row]:  # {{{
+        """Linhas do nível (uf, regiao ou nacional) de cada fatia carregada. {{{
+
+            Como nas exportações do servidor, state tem a sigla do estado,
+            o nome da região ou "Brasil". Municípios sem numerador ou
+            denominador ficam de fora das somas.
+            }}} """
+        if area in self.__aggregates__:
+            return self.__aggregates__[area]
+        ids, state, numerator, denominator = self.__arrays__()
+        if area == 'uf':
+            group = state
+        elif area == 'regiao':
+            group = state // 10
+        elif area == 'nacional':
+            group = np.zeros_like(state)
+        else:
+            raise ValueError('Nível desconhecido: {} (use {})'.format(area, ', '.join(LEVELS)))
+        valid = ~(np.isnan(numerator) | np.isnan(denominator))
+        keys, inverse = np.unique((ids * 100 + group)[valid], return_inverse=True)
+        numerators = np.bincount(inverse, weights=numerator[valid], minlength=len(keys))
+        denominators = np.bincount(inverse, weights=denominator[valid], minlength=len(keys))
+
+        rows = []
+        for key, n, d in zip(keys.tolist(), numerators.tolist(), denominators.tolist()):
+            period, index, view = self.slices[key // 100]
+            code = key % 100
+            name = self.__siglas__.get(code, str(code)) if area == 'uf' else \
+                REGIONS.get(code, str(code)) if area == 'regiao' else 'Brasil'
+            rows.append(Row(area, name, '', '', period, index, view,
+                            n, d, 100 * n / d if d else None))
+        self.__aggregates__[area] = rows
+        return rows
+        # }}}
+
+    def rows(self, task: dict) -> List[Row]:  # {{{
+        """Linhas que a exportação da tarefa (argumentos de get_data no nível
+        uf, regiao ou nacional) traria do servidor. {{{
+
+            O estado e a região da tarefa são códigos IBGE (os dois dígitos
+            do estado e o primeiro deles para a região), não os códigos dos
+            selects do nível uf e de regiões, que podem ser outros (veja
+            cli.derive). Levanta ValueError para outros códigos.
+            }}} """
+        key = (str(task['period']), str(task['index']), str(task['view']))
+        rows = [r for r in self.aggregate(str(task['area']))
+                if (r.period, r.indicator, r.view) == key]
+        if task['area'] == 'uf' and task.get('state'):
+            name = self.__siglas__.get(ibge_code(task['state'], 2, 'estado'))
+            rows = [r for r in rows if r.state == name]
+        elif task['area'] == 'regiao' and task.get('region'):
+            name = REGIONS.get(ibge_code(task['region'], 1, 'região'))
+            rows = [r for r in rows if r.state == name]
+        return rows
+        # }}}
+
+    def check(self, task: dict, text: str, tolerance: float = 0.5) -> List[Mismatch]:  # {{{
+        """Compara uma exportação uf, regiao ou nacional do servidor com o
+        cálculo local. {{{
+
+            Numerador e denominador precisam ser iguais; o resultado pode
+            diferir até tolerance, já que o servidor arredonda.
+            }}} """
+        local = {(r.state, r.period, r.indicator, r.view): r
+                 for r in self.aggregate(str(task['area']))}
+        mismatches = []
+        for row in parse(text, task):
+            mine = local.get((row.state, row.period, row.indicator, row.view))
+            if mine is None or not (
+                    same(row.numerator, mine.numerator, 1e-6) and
+                    same(row.denominator, mine.denominator, 1e-6) and
+                    same(row.value, mine.value, tolerance + 1e-9)):
+                mismatches.append(Mismatch(row, mine))
+        return mismatches
+        # }}}
+    # }}}
+
+
+def same(a: Optional[float], b: Optional[float], tolerance: float) -> bool:  # {{{
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) <= tolerance
+    # }}}
+
+
+def ibge_code(code: object, digits: int, name: str) -> int:  # {{{
+    text = str(code)
+    if len(text) != digits or not text.isdigit() or \
+            (digits == 1 and int(text) not in REGIONS):
+        raise ValueError('{} não é um código IBGE de {}'.format(code, name))
+    return int(text)
+    # }}}
+
+
+def sources(task: dict, states: Iterable[str]) -> List[dict]:  # {{{
+    """Exportações no nível ibge necessárias para derivar a tarefa. {{{
+
+        @param task
+                Argumentos de get_data no nível uf, regiao ou nacional, com
+                o estado e a região em códigos IBGE (veja Rollup.rows)
+        @param states
+                Códigos IBGE de todos os estados (veja state_options)
+                }}} """
+    area = task['area']
+    if area == 'uf':
+        chosen = [str(task['state'])]
+    elif area == 'regiao':
+        region = str(ibge_code(task['region'], 1, 'região'))
+        chosen = [uf for uf in states if uf[:1] == region]
+    elif area == 'nacional':
+        chosen = list(states)
+    else:
+        raise ValueError('Nível desconhecido: {} (use {})'.format(area, ', '.join(LEVELS)))
+    return [{'area': 'ibge', 'state': uf, 'period': task['period'],
+             'index': task['index'], 'view': task['view']} for uf in chosen]
+    # }}}
@@ -0,0 +1,348 @@
+from typing import Iterable, List, Optional, TextIO, Union
+import asyncio
+import io
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+from SISAB import SectionWriter, Sisab, ViewStateError, arguments, charset, decode, \
+    must_set, transitions, request_kind, request_state
+from cache import ResponseCache
+from metrics import Metrics, registry
+from transport import Transport
+
+
+def pairs(form: dict) -> list:  # {{{
+    """Converte o formulário em pares chave-valor, repetindo a chave para
+    valores múltiplos (como o requests faz com tuplas). }}} """
+    items = []
+    for k, v in form.items():
+        if isinstance(v, (tuple, list)):
+            items.extend((k, i) for i in v)
+        else:
+            items.append((k, v))
+    return items
+    # }}}
+
+
+class AsyncSisab(Sisab):  # {{{
+    """Versão asyncio do Sisab, com a mesma API em forma de corrotinas. {{{
+
+        Cada instância tem sua própria sessão aiohttp (cookies e ViewState),
+        então várias instâncias podem rodar ao mesmo tempo no mesmo event
+        loop. O construtor não faz I/O: use `await AsyncSisab.create()` ou
+        `async with AsyncSisab() as s`.
+
+        @param semaphore
+                Semáforo global que limita as requisições em andamento
+                Deve ser compartilhado entre as instâncias
+        @param connector
+                Pool de conexões aiohttp compartilhado entre as instâncias
+                Quando não é passado, cada instância cria o seu
+        @param timeout
+                Tempo limite total de cada requisição em segundos
+        @param cache
+                Cache das exportações CSV
+        @param metrics
+                Onde os tempos de parse e escrita são publicados
+                }}} """
+
+    def __init__(
+        self,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        connector: Optional['aiohttp.BaseConnector'] = None,
+        timeout: float = 120,
+        cache: Optional[ResponseCache] = None,
+        metrics: Optional[Metrics] = None
+    ):  # {{{
+        if aiohttp is None:
+            raise ImportError('O AsyncSisab precisa do pacote aiohttp')
+        # Não chama Sisab.__init__ para não fazer requisições bloqueantes
+        self.__semaphore__ = semaphore if semaphore is not None \
+            else asyncio.Semaphore(1)
+        self.__connector__ = connector
+        self.__timeout__ = timeout
+        self.__cache__ = cache
+        self.__metrics__ = metrics if metrics is not None else registry
+        self.__session__: Optional['aiohttp.ClientSession'] = None
+        self.__init_state__()
+        # }}}
+
+    @classmethod
+    async def create(cls, *args, **kwargs) -> 'AsyncSisab':  # {{{
+        s = cls(*args, **kwargs)
+        await s.start()
+        return s
+        # }}}
+
+    async def start(self):  # {{{
+        """Abre a sessão e carrega as opções iniciais (GET + POST). }}} """
+        self.__session__ = aiohttp.ClientSession(
+            connector=self.__connector__,
+            connector_owner=self.__connector__ is None,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            headers=Transport.HEADERS,
+            timeout=aiohttp.ClientTimeout(total=self.__timeout__)
+        )
+        await self.__get_cookies__()
+        await self.post()
+        self.__parse_area_options__()
+        # }}}
+
+    async def __get_cookies__(self):  # {{{
+        # Os cookies da resposta ficam guardados no cookie jar da sessão
+        async with self.__semaphore__:
+            async with self.__session__.get(Sisab.URL) as res:  # type: ignore
+                text = decode(await res.read(), res.headers.get('Content-Type', ''))
+        self.__parse_page__(text)
+        self.__ready__ = True
+        self.__active__ = dict()
+        # }}}
+
+    async def __recover__(self):  # {{{
+        # Abre uma nova sessão e refaz a cadeia de seleções ativas
+        active = self.__active__
+        self.__recovering__ = True
+        try:
+            self.__session__.cookie_jar.clear()  # type: ignore
+            await self.__get_cookies__()
+            if 'area' in active:
+                await self.post({'selectLinha': active['area'], **Sisab.AREA_CHANGE})
+                self.__active__ = {'area': active['area']}
+            if 'state' in active:
+                await self.post({
+                    'selectLinha': active['area'],
+                    'estadoMunicipio': active['state'],
+                    **Sisab.STATE_CHANGE
+                })
+                self.__active__ = dict(active)
+        finally:
+            self.__recovering__ = False
+        # }}}
+
+    async def close(self):  # {{{
+        if self.__session__ is not None:
+            await self.__session__.close()
+            self.__session__ = None
+        # }}}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_): await self.close()
+
+    # {{{ Membros do Sisab que dependem do requests
+    # A sessão do AsyncSisab é do aiohttp, então estes não funcionam aqui
+    @property
+    def transport(self):
+        raise TypeError('O AsyncSisab usa uma sessão aiohttp, não um Transport')
+
+    def save_session(self, path: str):
+        raise TypeError('O AsyncSisab usa uma sessão aiohttp, que não pode ser salva')
+
+    def load_session(self, path: str):
+        raise TypeError('O AsyncSisab usa uma sessão aiohttp, que não pode ser restaurada')
+
+    def __enter__(self):
+        raise TypeError('Use "async with" com o AsyncSisab')
+
+    def __exit__(self, *_): pass
+    # }}}
+
+    async def post(  # {{{
+        self,
+        params: dict = dict(),
+        output: Union[str, TextIO] = None,
+        strip: bool = False
+    ) -> None:
+        # Um ViewState perdido (inclusive uma exportação que volta como
+        # página) abre uma nova sessão no servidor e refaz as seleções
+        # ativas antes de repetir, como em Sisab.post
+        if self.__session__ is None:
+            raise AssertionError('A sessão não foi iniciada')
+        try:
+            return await self.__post__(params, output, strip)
+        except ViewStateError:
+            if self.__recovering__:
+                raise
+        await self.__recover__()
+        await self.__post__(params, output, strip)
+        # }}}
+
+    async def __post__(self, params, output, strip):  # {{{
+        form = self.__form__(params)
+        key = ResponseCache.key(form) if self.__cache__ is not None else None
+        if key is not None:
+            cached = self.__cache__.get(key)  # type: ignore
+            if cached is not None:
+                try:
+                    self.__write_csv__(cached[0], cached[1], output, strip,
+                                       'cache', request_state(form))
+                except Exception:
+                    # Uma resposta ruim no cache não pode falhar para sempre
+                    self.__cache__.remove(key)  # type: ignore
+                    raise
+                return
+
+        async with self.__semaphore__:
+            async with self.__session__.post(  # type: ignore
+                    Sisab.URL, headers=Sisab.HEADERS, params=pairs(form)) as res:
+                content_type = res.headers['Content-Type']
+                if Sisab.is_csv(content_type):
+                    writer = SectionWriter(
+                        output, strip, charset(content_type, Sisab.CSV_ENCODING))
+                    entry = self.__cache__.begin(key, content_type) \
+                        if key is not None else None  # type: ignore
+                    try:
+                        try:
+                            async for chunk in res.content.iter_chunked(Sisab.CHUNK_SIZE):
+                                if entry is not None:
+                                    entry.write(chunk)
+                                writer.feed(chunk)
+                        finally:
+                            writer.close()
+                    except BaseException:
+                        # Só entra no cache o que o SectionWriter aceitou
+                        if entry is not None:
+                            entry.abort()
+                        raise
+                    if entry is not None:
+                        entry.commit()
+                    return
+                if 'j_idt84' in form:
+                    # A exportação volta como página quando a visão venceu
+                    raise ViewStateError('A exportação não devolveu um CSV')
+                text = decode(await res.read(), content_type)
+        self.__handle_response__(content_type, text, output, strip,
+                                 request_kind(form), request_state(form))
+        # }}}
+
+    @must_set('area')
+    async def update_area(self):  # {{{
+        await self.post(self.__area_params__())
+        self.__active__ = {'area': self.area}
+        # }}}
+
+    @must_set('area')
+    async def get_area(self, file: str, strip: bool = False):  # {{{
+        await self.post(self.__export_params__('nacional'), file, strip)
+        # }}}
+
+    @must_set('area')
+    async def update_region(self):  # {{{
+        await self.post(self.__area_params__())
+        self.__parse_regions__()
+        # }}}
+
+    @must_set('area', 'region')
+    async def get_region(self, file: str, strip: bool = False):  # {{{
+        await self.post(self.__export_params__('regiao'), file, strip)
+        # }}}
+
+    @must_set('area')
+    async def update_state(self, look_into='estados'):  # {{{
+        await self.post(self.__area_params__())
+        self.__parse_states__(look_into)
+        # }}}
+
+    @must_set('area')
+    async def get_state(self, file: str, strip: bool = False):  # {{{
+        await self.post(self.__export_params__('uf'), file, strip)
+        # }}}
+
+    @must_set('area', 'state')
+    async def update_municipality(self):  # {{{
+        await self.post(self.__municipality_params__())
+        self.__parse_municipalities__()
+        # }}}
+
+    @must_set('area', 'state')
+    async def get_municipality(self, file: str, strip: bool = False):  # {{{
+        await self.post(self.__export_params__('ibge'), file, strip=strip)
+        # }}}
+
+    async def get_data(self, area, file, strip=True, **options):  # {{{
+        # Faz as requisições desde o começo até o fim, pulando as
+        # atualizações cujas seleções já estão ativas no servidor
+        self.__configure__(area, options)
+        steps = transitions(self.__active__, self.area, options.get('state'),
+                            self.__state_options__)
+        if self.area == 'nacional':
+            await self.get_area(file, strip=strip)
+        elif self.area == 'regiao':
+            if 'update_region' in steps:
+                await self.update_region()
+            self.region = options['region']
+            await self.get_region(file, strip=strip)
+        elif self.area == 'uf':
+            if 'update_state' in steps:
+                await self.update_state()
+            if 'state' in options:
+                self.state = options['state']
+            await self.get_state(file, strip=strip)
+        elif self.area == 'ibge':
+            if 'update_state' in steps:
+                await self.update_state(look_into='estadoMunicipio')
+            self.state = options['state']
+            if 'update_municipality' in steps:
+                await self.update_municipality()
+            if 'municipality' in options:
+                self.municipality = options['municipality']
+            await self.get_municipality(file, strip=strip)
+        # }}}
+    # }}}
+
+
+async def run_task(sisab: AsyncSisab, task: dict) -> str:  # {{{
+    """Texto da exportação de uma tarefa, como SISAB.run_task. }}} """
+    area, options = arguments(task)
+    buffer = io.StringIO()
+    await sisab.get_data(area, buffer, **options)
+    return buffer.getvalue()
+    # }}}
+
+
+async def crawl(
+    tasks: Iterable[dict],
+    sessions: int = 8,
+    concurrency: Optional[int] = None
+) -> List[str]:  # {{{
+    """Executa as tarefas de get_data em várias sessões no mesmo event loop. {{{
+
+        @param tasks
+                Argumentos de get_data (area, state, period, ...) de cada tarefa
+        @param sessions
+                Quantidade de sessões (cadeias de ViewState) independentes
+        @param concurrency
+                Limite global de requisições simultâneas (padrão: sessions)
+
+        Devolve o texto de cada tarefa na mesma ordem da entrada.
+        }}} """
+    tasks = list(tasks)
+    semaphore = asyncio.Semaphore(concurrency or sessions)
+    connector = aiohttp.TCPConnector(limit=concurrency or sessions)
+    results: List[str] = [''] * len(tasks)
+    pending: 'asyncio.Queue[int]' = asyncio.Queue()
+    for i in range(len(tasks)):
+        pending.put_nowait(i)
+
+    async def worker():
+        async with AsyncSisab(semaphore, connector) as s:
+            while not pending.empty():
+                i = pending.get_nowait()
+                results[i] = await run_task(s, tasks[i])
+
+    workers = [asyncio.ensure_future(worker())
+               for _ in range(min(sessions, len(tasks)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # Se um worker falhar, os outros são cancelados (e terminam)
+        # antes de o pool de conexões que eles usam ser fechado
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await connector.close()
+    return results
+    # }}}
@@ -0,0 +1,424 @@
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+import gzip
+import io
+import os
+import queue
+import re
+import sqlite3
+import threading
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+from catalog import normalize
+
+
+# Seções pedidas ao exportar para um destino estruturado: somente os
+# dados, mas com a linha das colunas
+STRIP = [False, True, False]
+
+
+class Row(NamedTuple):
+    area: str
+    state: str
+    ibge: str
+    municipality: str
+    period: str
+    indicator: str
+    view: str
+    numerator: Optional[float]
+    denominator: Optional[float]
+    value: Optional[float]
+
+
+# Nomes (normalizados) aceitos para cada coluna do CSV
+COLUMNS = {
+    # Nos níveis acima do estado, a região ou o país ficam em state
+    'state': ('uf', 'estado', 'sigla', 'regiao', 'brasil'),
+    'ibge': ('ibge', 'cod ibge', 'codigo ibge', 'cod. ibge'),
+    'municipality': ('municipio', 'nome', 'no municipio'),
+    'numerator': ('numerador',),
+    'denominator': ('denominador',),
+    'value': ('resultado', 'resultado(%)', 'resultado (%)', 'indicador',
+              'valor', '%'),
+}
+
+
+# Inteiro com separador de milhar e sem vírgula ("1.234", "12.345.678")
+THOUSANDS = re.compile(r'^[-+]?\d{1,3}(\.\d{3})+$')
+
+
+def number(text: str) -> Optional[float]:  # {{{
+    """Converte números no formato brasileiro ("1.234,5", "1.234") ou não. {{{
+
+        O ponto é separador de milhar quando há vírgula ou quando separa
+        grupos de três dígitos, como nas contagens do Sisab: "1.234" é
+        1234, mas "1.5" continua 1.5.
+        }}} """
+    text = text.strip().rstrip('%').strip()
+    if text == '' or text == '-':
+        return None
+    if ',' in text:
+        text = text.replace('.', '').replace(',', '.')
+    elif THOUSANDS.match(text):
+        text = text.replace('.', '')
+    try:
+        return float(text)
+    except ValueError:
+        return None
+    # }}}
+
+
+def columns(header: List[str]) -> Dict[str, int]:  # {{{
+    """Posição de cada campo conhecido na linha das colunas do CSV. }}} """
+    names = [normalize(c) for c in header]
+    found: Dict[str, int] = dict()
+    for field, accepted in COLUMNS.items():
+        for i, name in enumerate(names):
+            if name in accepted or (field == 'value' and name.startswith('resultado')):
+                found[field] = i
+                break
+    return found
+    # }}}
+
+
+def parse(text: str, task: dict) -> List[Row]:  # {{{
+    """Converte o CSV de uma exportação em linhas tipadas. {{{
+
+        @param text
+                Seção de dados do CSV, com a linha das colunas (veja STRIP)
+                Se vier com cabeçalho e rodapé, somente os dados são lidos
+        @param task
+                Argumentos de get_data da exportação (area, period, index,
+                view); os códigos do período, do indicador e da visão vêm
+                daqui
+                }}} """
+    if '\n\n\n' in text:
+        text = text.split('\n\n\n')[1]
+    lines = [line for line in text.split('\n') if line.strip() != '']
+    if not lines:
+        return []
+    header, *lines = lines
+    found = columns(header.split(';'))
+    if not found:
+        raise ValueError('O CSV não tem a linha das colunas (use strip={})'.format(STRIP))
+
+    def field(values: List[str], name: str) -> str:
+        i = found.get(name)
+        return values[i].strip() if i is not None and i < len(values) else ''
+
+    rows = []
+    for line in lines:
+        values = line.split(';')
+        rows.append(Row(
+            str(task['area']),
+            field(values, 'state'),
+            field(values, 'ibge'),
+            field(values, 'municipality'),
+            str(task.get('period', '')),
+            str(task.get('index', '')),
+            str(task.get('view', '')),
+            number(field(values, 'numerator')),
+            number(field(values, 'denominator')),
+            number(field(values, 'value')),
+        ))
+    return rows
+    # }}}
+
+
+class SQLiteSink:  # {{{
+    """Destino SQLite para as exportações, no lugar de arquivos CSV. {{{
+
+        Cada exportação é convertida em linhas tipadas (veja Row) que são
+        inseridas em lotes com executemany dentro de uma transação. A tabela
+        tem índices na chave natural (nível, estado, município, período,
+        indicador, visão), então reexportar a mesma fatia substitui as
+        linhas antigas.
+
+            with SQLiteSink('sisab.db') as sink:
+                for task, text in crawler.map(tasks):  # strip=STRIP
+                    sink.write(task, text)
+
+        @param path
+                Caminho do banco de dados
+        @param batch_size
+                Quantidade de linhas acumuladas antes de cada inserção
+                }}} """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS indicator (
+            area TEXT NOT NULL,
+            state TEXT NOT NULL,
+            ibge TEXT NOT NULL,
+            municipality TEXT NOT NULL,
+            period TEXT NOT NULL,
+            indicator TEXT NOT NULL,
+            view TEXT NOT NULL,
+            numerator REAL,
+            denominator REAL,
+            value REAL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS indicator_key ON indicator
+            (area, state, ibge, municipality, period, indicator, view);
+        CREATE INDEX IF NOT EXISTS indicator_ibge ON indicator (ibge, period);
+        CREATE INDEX IF NOT EXISTS indicator_state ON indicator (state, period);
+        CREATE INDEX IF NOT EXISTS indicator_slice ON indicator
+            (period, indicator, view);
+    '''
+    INSERT = 'INSERT OR REPLACE INTO indicator VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+    def __init__(self, path: str = 'sisab.db', batch_size: int = 5000):  # {{{
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SQLiteSink.SCHEMA)
+        self.__rows__: List[Tuple] = []
+        # }}}
+
+    def write(self, task: dict, text: str):  # {{{
+        self.insert(parse(text, task))
+        # }}}
+
+    def insert(self, rows: Iterable[Tuple]):  # {{{
+        """Insere linhas já convertidas (Row ou tuplas na mesma ordem). }}} """
+        self.__rows__.extend(rows)
+        if len(self.__rows__) >= self.batch_size:
+            self.flush()
+        # }}}
+
+    def flush(self):  # {{{
+        if not self.__rows__:
+            return
+        with self.connection:
+            self.connection.executemany(SQLiteSink.INSERT, self.__rows__)
+        self.__rows__ = []
+        # }}}
+
+    def query(self, sql: str, params: Iterable = ()) -> List[Tuple]:  # {{{
+        self.flush()
+        return self.connection.execute(sql, tuple(params)).fetchall()
+        # }}}
+
+    def close(self):  # {{{
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+        # }}}
+
+    def __enter__(self): return self
+    def __exit__(self, *_): self.close()
+    # }}}
+
+
+# Extensão dos arquivos de cada compressão aceita pelo PartitionedWriter
+EXTENSIONS = {'gzip': '.csv.gz', 'zstd': '.csv.zst', None: '.csv'}
+# Campos da tarefa que formam as partições e o nome de cada um no diretório
+PARTITIONS = {'period': 'period', 'index': 'indicator', 'view': 'view'}
+
+
+def compressor(compression: Optional[str], level: Optional[int] = None):  # {{{
+    """Função bytes -> bytes que comprime um bloco como um membro (gzip) ou
+    quadro (zstd) independente; blocos concatenados formam um arquivo
+    válido. }}} """
+    if compression == 'gzip':
+        return lambda data: gzip.compress(data, 6 if level is None else level)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('A compressão zstd precisa do pacote zstandard')
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    if compression is None:
+        return lambda data: data
+    raise ValueError('Compressão desconhecida: {}'.format(compression))
+    # }}}
+
+
+def partition_path(task: dict, keys: Iterable[str] = tuple(PARTITIONS)) -> str:  # {{{
+    """Diretório relativo da partição da tarefa, no formato chave=valor
+    ("period=201801/indicator=1/view=0"). }}} """
+    return os.path.join('', *('{}={}'.format(PARTITIONS.get(k, k), task.get(k, ''))
+                              for k in keys))
+    # }}}
+
+
+class PartitionedWriter:  # {{{
+    """Saída em CSV comprimido, com um arquivo por partição. {{{
+
+        As fatias (pares (tarefa, texto) de um crawler, com strip=STRIP)
+        são agrupadas por período, indicador e visão em diretórios no
+        formato chave=valor, com um arquivo por nível:
+
+            saida/period=201801/indicator=1/view=0/ibge.csv.gz
+
+        Cada partição começa com a linha das colunas da primeira fatia que
+        chega nela; as outras fatias entram só com os dados. O texto de cada
+        partição fica em memória até somar buffer_size bytes, e então é
+        comprimido e acrescentado ao arquivo por uma thread separada, que
+        recebe no máximo depth blocos de cada vez (back-pressure). Blocos
+        gzip (ou zstd) concatenados formam um arquivo válido, que zcat e
+        gzip.open leem normalmente.
+
+        Arquivos que já existiam são sobrescritos na primeira escrita. Com
+        keys=() tudo vai para um arquivo só (root + extensão).
+
+            with PartitionedWriter('saida') as writer:
+                for task, text in crawler.map(tasks):
+                    writer.write(task, text)
+
+        @param root
+                Diretório de saída
+        @param keys
+                Campos da tarefa que definem as partições (veja PARTITIONS)
+        @param compression
+                'gzip', 'zstd' (precisa do pacote zstandard) ou None
+        @param level
+                Nível de compressão (padrão: 6 no gzip, 3 no zstd)
+        @param buffer_size
+                Bytes acumulados por partição antes de cada compressão
+        @param depth
+                Blocos esperando pela thread de compressão
+                }}} """
+
+    def __init__(
+        self,
+        root: str,
+        keys: Iterable[str] = tuple(PARTITIONS),
+        compression: Optional[str] = 'gzip',
+        level: Optional[int] = None,
+        buffer_size: int = 1 << 20,
+        depth: int = 8
+    ):  # {{{
+        self.root = root
+        self.keys = tuple(keys)
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.__compress__ = compressor(compression, level)
+        self.__buffers__: Dict[str, List[str]] = dict()
+        self.__sizes__: Dict[str, int] = dict()
+        self.__headers__: Set[str] = set()  # Partições com a linha das colunas
+        self.__blocks__: 'queue.Queue' = queue.Queue(depth)
+        self.__errors__: List[BaseException] = []
+        self.__thread__ = threading.Thread(target=self.__run__, daemon=True)
+        self.__thread__.start()
+        # }}}
+
+    def path(self, task: dict) -> str:  # {{{
+        """Arquivo da partição da tarefa. }}} """
+        extension = EXTENSIONS[self.compression]
+        if not self.keys:
+            return self.root + extension
+        return os.path.join(
+            self.root, partition_path(task, self.keys), str(task['area']) + extension)
+        # }}}
+
+    def write(self, task: dict, text: str):  # {{{
+        self.__check__()
+        path = self.path(task)
+        header, _, data = text.lstrip('\n').partition('\n')
+        if path not in self.__headers__:
+            self.__headers__.add(path)
+            data = header + '\n' + data
+        if data.strip() == '':
+            return
+        if not data.endswith('\n'):
+            data += '\n'
+        self.__buffers__.setdefault(path, []).append(data)
+        self.__sizes__[path] = self.__sizes__.get(path, 0) + len(data)
+        if self.__sizes__[path] >= self.buffer_size:
+            self.__flush__(path)
+        # }}}
+
+    def flush(self):  # {{{
+        for path in list(self.__buffers__):
+            self.__flush__(path)
+        # }}}
+
+    def close(self):  # {{{
+        try:
+            self.flush()
+        finally:
+            self.__blocks__.put(None)
+            self.__thread__.join()
+        self.__check__()
+        # }}}
+
+    def __flush__(self, path: str):  # {{{
+        data = ''.join(self.__buffers__.pop(path, ()))
+        self.__sizes__.pop(path, None)
+        if data:
+            self.__blocks__.put((path, data))
+        # }}}
+
+    def __run__(self):  # {{{
+        # Abre cada arquivo somente enquanto escreve um bloco, para não
+        # esbarrar no limite de arquivos abertos com muitas partições
+        created: Set[str] = set()
+        while True:
+            block = self.__blocks__.get()
+            if block is None:
+                return
+            if self.__errors__:
+                continue  # Descarta o resto, o erro sobe no próximo write
+            path, data = block
+            try:
+                compressed = self.__compress__(data.encode('utf-8'))
+                if path not in created:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path, 'ab' if path in created else 'wb') as f:
+                    f.write(compressed)
+                created.add(path)
+            except BaseException as e:
+                self.__errors__.append(e)
+        # }}}
+
+    def __check__(self):  # {{{
+        if self.__errors__:
+            raise self.__errors__[0]
+        # }}}
+
+    def __enter__(self): return self
+    def __exit__(self, *_): self.close()
+    # }}}
+
+
+def partitions(root: str, area: Optional[str] = None, **filters: Iterable[str]) -> List[str]:  # {{{
+    """Arquivos do PartitionedWriter em root que passam pelos filtros. {{{
+
+        Somente os diretórios das partições escolhidas são percorridos:
+
+            partitions('saida', area='ibge', period=['201801'], indicator=['1'])
+
+        @param area
+                Nível dos arquivos (padrão: todos)
+        @param filters
+                Valores aceitos em cada partição (period, indicator, view)
+                Partições sem filtro aceitam todos os valores
+                }}} """
+    accepted = {k: set(str(v) for v in values) for k, values in filters.items()}
+    found = []
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        name, equals, value = entry.name.partition('=')
+        if entry.is_dir() and equals:
+            if name not in accepted or value in accepted[name]:
+                found += partitions(entry.path, area, **filters)
+        elif entry.is_file() and (area is None or entry.name.split('.')[0] == area):
+            found.append(entry.path)
+    return found
+    # }}}
+
+
+def read(path: str) -> Iterator[str]:  # {{{
+    """Linhas de um arquivo do PartitionedWriter, descomprimido conforme a
+    extensão. }}} """
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('A leitura de arquivos zstd precisa do pacote zstandard')
+        f = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True), encoding='utf-8')
+    else:
+        f = open(path, encoding='utf-8')
+    with f:
+        yield from f
+    # }}}
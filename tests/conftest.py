@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# Os módulos ficam na raiz do repositório, sem pacote
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_server import FakeSisab  # noqa: E402
+from SISAB import Sisab  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    """Servidor local pequeno, com Sisab.URL apontando para ele. """
+    url = Sisab.URL
+    with FakeSisab(municipalities=5, periods=2) as s:
+        Sisab.URL = s.url
+        try:
+            yield s
+        finally:
+            Sisab.URL = url
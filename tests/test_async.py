@@ -0,0 +1,44 @@
+import asyncio
+import io
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from sisab_async import AsyncSisab, crawl  # noqa: E402
+
+OPTIONS = dict(period=0, index=0, view=0)
+
+
+def test_export_recovers_expired_view_state(server):
+    async def run():
+        async with AsyncSisab() as s:
+            before = io.StringIO()
+            await s.get_data('ibge', before, state='12', **OPTIONS)
+            server.sessions.clear()  # A sessão vence no servidor
+            after = io.StringIO()
+            await s.get_data('ibge', after, state='12', **OPTIONS)
+            return before.getvalue(), after.getvalue()
+
+    before, after = asyncio.run(run())
+    assert after == before
+    assert 'Município AC 0' in after
+    assert server.stats['expired'] == 1
+
+
+def test_sync_members_raise_clear_errors():
+    s = AsyncSisab()
+    with pytest.raises(TypeError):
+        s.transport
+    with pytest.raises(TypeError):
+        s.save_session('sessao.json')
+    with pytest.raises(TypeError):
+        s.load_session('sessao.json')
+    with pytest.raises(TypeError):
+        with s:
+            pass
+
+
+def test_crawl_cancels_workers_on_failure(server):
+    tasks = [dict(area='ibge', state=uf, **OPTIONS) for uf in ('12', '13', 'XX', '14')]
+    with pytest.raises(ValueError, match='estado'):
+        asyncio.run(crawl(tasks, sessions=4))
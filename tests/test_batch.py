@@ -0,0 +1,41 @@
+import io
+from SISAB import Sisab
+from batch import Batcher, batches
+from cli import main
+from storage import STRIP
+
+OPTIONS = dict(period='201801', index='1', view='00')
+
+
+def run(server, tmp_path, *args) -> str:
+    output = str(tmp_path / 'out.csv')
+    assert main(['--url', server.url, '--catalog', str(tmp_path / 'catalog.json'),
+                 '-o', output, '-p', '0', '-q', *args]) == 0
+    with open(output) as f:
+        return f.read()
+
+
+def test_cli_batches_state_exports(server, tmp_path):
+    filters = ['--area', 'uf', '--period', '201801', '--index', '1', '-w', '2']
+    single = run(server, tmp_path, *filters)
+    before = server.stats['export']
+    batched = run(server, tmp_path, *filters, '--batch-size', '10')
+    # 27 estados x 2 visões: uma exportação por estado ou 3 lotes por visão
+    assert before == 54
+    assert server.stats['export'] - before == 6
+    assert sorted(batched.splitlines()) == sorted(single.splitlines())
+
+
+def test_batcher_matches_single_exports(server):
+    tasks = [dict(area='uf', state=uf, strip=STRIP, **OPTIONS) for uf in ('11', '12', '13')]
+    tasks.append(dict(area='ibge', state='12', strip=STRIP, **OPTIONS))
+    with Sisab() as s:
+        single = []
+        for t in tasks:
+            options = dict(t)
+            buffer = io.StringIO()
+            s.get_data(options.pop('area'), buffer, **options)
+            single.append(buffer.getvalue())
+        batched = dict((id(t), text) for t, text in Batcher(s, 2).run(tasks))
+    assert [batched[id(t)] for t in tasks] == single
+    assert [len(b) for b in batches(tasks, 2)] == [1, 2, 1]
@@ -0,0 +1,85 @@
+import asyncio
+import io
+import os
+import pytest
+from SISAB import Sisab
+from cache import ResponseCache
+
+OPTIONS = dict(period=0, index=0, view=0, strip=True)
+BROKEN = 'Uf;IBGE;Municipio\nAC;120001;Acrelândia\n'.encode('ISO-8859-1')
+
+
+def break_exports(server):
+    # O CSV volta sem as seções do cabeçalho e do rodapé
+    server.__export__ = lambda handler, form, field: server.__send__(
+        handler, BROKEN, 'text/csv;charset=ISO-8859-1')
+
+
+def objects(cache: ResponseCache):
+    return os.listdir(os.path.join(cache.directory, 'objects'))
+
+
+def temporary(cache: ResponseCache):
+    return [f for f in os.listdir(cache.directory) if f.endswith('.tmp')]
+
+
+def test_bad_exports_do_not_stay_in_the_cache(server, tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    export = server.__export__
+    with Sisab(cache=cache) as s:
+        break_exports(server)
+        with pytest.raises(ValueError):
+            s.get_data('ibge', io.StringIO(), state='12', **OPTIONS)
+        assert cache.size() == 0 and objects(cache) == []
+        assert temporary(cache) == []
+
+        server.__export__ = export
+        first, second = io.StringIO(), io.StringIO()
+        s.get_data('ibge', first, state='12', **OPTIONS)
+        s.get_data('ibge', second, state='12', **OPTIONS)
+        assert first.getvalue() == second.getvalue()
+        assert server.stats['export'] == 1
+
+        # Uma resposta ruim gravada antes da correção sai do cache no erro
+        (key,), = cache.connection.execute('SELECT key FROM entries').fetchall()
+        entry = cache.begin(key, 'text/csv;charset=ISO-8859-1')
+        entry.write(BROKEN)
+        entry.commit()
+        with pytest.raises(ValueError):
+            s.get_data('ibge', io.StringIO(), state='12', **OPTIONS)
+        third = io.StringIO()
+        s.get_data('ibge', third, state='12', **OPTIONS)
+        assert third.getvalue() == first.getvalue()
+        assert server.stats['export'] == 2
+    cache.close()
+
+
+def test_async_bad_exports_do_not_stay_in_the_cache(server, tmp_path):
+    pytest.importorskip('aiohttp')
+    from sisab_async import AsyncSisab
+
+    async def run(cache):
+        async with AsyncSisab(cache=cache) as s:
+            with pytest.raises(ValueError):
+                await s.get_data('ibge', io.StringIO(), state='12', **OPTIONS)
+
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    break_exports(server)
+    asyncio.run(run(cache))
+    assert cache.size() == 0 and objects(cache) == [] and temporary(cache) == []
+    cache.close()
+
+
+def test_get_treats_a_removed_object_as_a_miss(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    entry = cache.begin('chave', 'text/csv')
+    entry.write(b'a;b\n')
+    entry.commit()
+    content_type, chunks = cache.get('chave')
+    # Removido por outra thread depois do get: o arquivo já está aberto
+    for name in objects(cache):
+        os.remove(os.path.join(cache.directory, 'objects', name))
+    assert b''.join(chunks) == b'a;b\n'
+    assert cache.get('chave') is None
+    assert cache.get('chave') is None
+    cache.close()
@@ -0,0 +1,67 @@
+import argparse
+import pytest
+from SISAB import Sisab
+from catalog import CatalogStore, OptionIndex
+from cli import build, derive
+
+
+def test_refresh_keeps_both_state_selects(server, tmp_path):
+    store = CatalogStore(str(tmp_path / 'catalog.json'))
+    with Sisab() as s:
+        data = store.refresh(s)
+    assert set(data['municipality']) == set(data['municipality_state'])
+    assert data['state'] and data['municipality_state']
+    assert store.load() == data
+
+
+def catalog() -> dict:
+    # Códigos diferentes para o mesmo estado nos selects dos níveis uf e ibge
+    return {
+        'period': {'201801': '2018 - Q1'}, 'index': {'1': 'Pré-Natal'},
+        'view': {'00': 'Todas'}, 'region': {'1': 'Norte'},
+        'state': {'AC': 'AC'}, 'municipality_state': {'12': 'AC'},
+        'municipality': {'12': {'120001': 'Acrelândia'}},
+    }
+
+
+def args(**kwargs) -> argparse.Namespace:
+    defaults = dict(area=['ibge'], region=None, state=None, municipality=None,
+                    period=None, index=None, view=None)
+    return argparse.Namespace(**dict(defaults, **kwargs))
+
+
+def test_build_uses_the_state_select_of_each_area():
+    tasks = build(catalog(), args(area=['uf', 'ibge']))
+    assert [(t['area'], t['state']) for t in tasks] == [('uf', 'AC'), ('ibge', '12')]
+
+
+def test_derive_fetches_municipalities_with_ibge_state_codes():
+    fetch, derived = derive(build(catalog(), args(area=['uf'])), catalog())
+    assert [(t['area'], t['state']) for t, _ in derived] == [('uf', 'AC')]
+    assert [(t['area'], t['state']) for _, t in derived] == [('uf', '12')]
+    assert [(t['area'], t['state']) for t in fetch] == [('ibge', '12')]
+
+
+def test_derive_resolves_regions_by_name():
+    data = dict(catalog(), region={'N': 'Norte', 'X': 'Amazônia Legal'})
+    fetch, derived = derive(build(data, args(area=['regiao'], region=['N'])), data)
+    assert [(t['region'], target['region']) for t, target in derived] == [('N', '1')]
+    assert [t['state'] for t in fetch] == ['12']
+    with pytest.raises(ValueError):
+        derive(build(data, args(area=['regiao'], region=['X'])), data)
+
+
+def test_option_index_find_and_select():
+    options = OptionIndex({'120001': 'Acrelândia', '120005': 'Assis Brasil',
+                           '120010': 'Brasiléia'})
+    assert options.find('120005') == '120005'
+    assert options.find('1200050') == '120005'  # IBGE com o dígito verificador
+    assert options.find('ACRELANDIA') == '120001'
+    assert options.find(' assis brasil ') == '120005'
+    assert options.find('999999') is None and options.find('Rio Branco') is None
+    assert options.select([2, 0, 2]) == ('120001', '120010')
+    assert options.select(['brasileia', '1200050']) == ('120010', '120005')
+    with pytest.raises(IndexError):
+        options.select([0, 3])
+    with pytest.raises(KeyError):
+        options.select(['Rio Branco'])
@@ -0,0 +1,71 @@
+import csv
+import pytest
+from SISAB import Sisab
+from cli import main
+from fake_server import FakeSisab
+
+KINDS = ('page', 'area', 'state', 'export')
+
+
+def requests(server) -> int:
+    return sum(server.stats[k] for k in KINDS)
+
+
+@pytest.mark.parametrize('options', [
+    ['--area', 'uf', 'ibge', '-w', '3'],
+    ['--area', 'uf', 'ibge', '-w', '2', '--batch-size', '4'],
+    ['--area', 'ibge', '--state', 'AC', 'AM', 'RO', '--municipality', 'Mun*1', '-w', '2'],
+    ['--area', 'regiao', 'nacional', '--state', 'AC', 'AM', '--derive', '--verify', '2'],
+])
+def test_dry_run_cost_matches_requests(server, tmp_path, capsys, options):
+    if '--derive' in options:
+        pytest.importorskip('numpy')
+    common = ['--url', server.url, '--catalog', str(tmp_path / 'catalog.json'),
+              '-o', str(tmp_path / 'out.csv'), '-q', '--period', '201801', *options]
+    assert main(['--update-catalog', '-n', *common]) == 0
+    capsys.readouterr()
+    assert main(['-n', *common]) == 0
+    expected = int(capsys.readouterr().out)
+
+    before = requests(server)
+    assert main(common) == 0
+    assert requests(server) - before == expected
+    assert server.stats['expired'] == server.stats['error'] == 0
+
+
+def test_queue_output_matches_direct_crawl(server, tmp_path):
+    common = ['--url', server.url, '--catalog', str(tmp_path / 'catalog.json'), '-q',
+              '--area', 'uf', 'ibge', '--state', 'AC', 'AM', '--period', '201801']
+    fila = ['--queue', str(tmp_path / 'fila.db')]
+    assert main([*common, '-o', str(tmp_path / 'direto.csv')]) == 0
+    assert main([*common, *fila, '--enqueue']) == 0
+    assert main([*common, *fila, '--work', '-w', '2']) == 0
+    assert main([*common, *fila, '-o', str(tmp_path / 'fila.csv')]) == 0
+    with open(tmp_path / 'direto.csv') as a, open(tmp_path / 'fila.csv') as b:
+        assert sorted(a) == sorted(b)
+
+
+def rows(path) -> dict:
+    with open(path) as f:
+        reader = csv.DictReader(f, delimiter=';')
+        return {(r['area'], r['state'], r['period'], r['indicator'], r['view']):
+                (float(r['numerator']), float(r['denominator'])) for r in reader}
+
+
+def test_derive_with_own_uf_and_region_codes(tmp_path):
+    pytest.importorskip('numpy')
+    url = Sisab.URL
+    # Siglas no select de estados do nível uf e N, NE... no de regiões
+    with FakeSisab(municipalities=3, periods=1, ibge_codes=False) as server:
+        Sisab.URL = server.url
+        try:
+            common = ['--url', server.url, '--catalog', str(tmp_path / 'catalog.json'), '-q',
+                      '--area', 'uf', 'regiao', 'nacional', '--index', '1', '--view', '00']
+            assert main([*common, '-o', str(tmp_path / 'servidor.csv')]) == 0
+            assert main([*common, '--derive', '--verify', '40',
+                         '-o', str(tmp_path / 'derivado.csv')]) == 0
+        finally:
+            Sisab.URL = url
+    server_rows, derived_rows = rows(tmp_path / 'servidor.csv'), rows(tmp_path / 'derivado.csv')
+    assert len(server_rows) == 27 + 5 + 1
+    assert derived_rows == server_rows
@@ -0,0 +1,71 @@
+import pytest
+import requests
+import jsf
+from SISAB import Sisab
+
+bs4 = pytest.importorskip('bs4')
+# As respostas parciais são XML, como o código antigo as lia
+pytestmark = pytest.mark.filterwarnings('ignore:It looks like you.re using an HTML parser')
+
+AJAX = {
+    'javax.faces.partial.event': 'change',
+    'javax.faces.partial.render': 'regioes script',
+    'javax.faces.behavior.event': 'valueChange',
+    'javax.faces.partial.ajax': 'true',
+}
+
+
+def soup_options(text: str, select: str, update: str = ''):
+    # A extração com o BeautifulSoup que o jsf.parse substituiu
+    soup = bs4.BeautifulSoup(text, 'html.parser')
+    if update:
+        soup = bs4.BeautifulSoup(soup.find('update', id=update).text, 'html.parser')
+    return {o.get('value'): o.text for o in soup.find('select', id=select).find_all('option')
+            if o.get('value') != ''}
+
+
+def soup_view_state(text: str) -> str:
+    soup = bs4.BeautifulSoup(text, 'html.parser')
+    el = soup.find('input', id=jsf.VIEW_STATE)
+    if el is not None:
+        return el.get('value')
+    return soup.find('update', id=lambda i: i and i.endswith(jsf.VIEW_STATE)).text
+
+
+def test_parse_matches_beautiful_soup(server):
+    session = requests.Session()
+    page = session.get(Sisab.URL).text
+    parsed = jsf.parse(page)
+    assert parsed.view_state == soup_view_state(page)
+    for select in ('selectLinha', 'quadrimestre', 'coIndicador', 'visaoEquipe'):
+        assert jsf.options(parsed, select) == soup_options(page, select)
+
+    for area, select in (('regiao', 'regiao'), ('uf', 'estados'), ('ibge', 'estadoMunicipio')):
+        text = session.post(Sisab.URL, dict(AJAX, **{
+            'selectLinha': area, 'javax.faces.source': 'selectLinha',
+            'javax.faces.partial.execute': 'selectLinha selectLinha',
+            'javax.faces.ViewState': parsed.view_state})).text
+        parsed = jsf.parse(text)
+        assert 'regioes' in parsed.updates
+        assert parsed.view_state == soup_view_state(text)
+        assert jsf.options(parsed, select) == soup_options(text, select, 'regioes')
+
+    text = session.post(Sisab.URL, dict(AJAX, **{
+        'selectLinha': 'ibge', 'estadoMunicipio': '12', 'javax.faces.source': 'estadoMunicipio',
+        'javax.faces.partial.execute': 'estadoMunicipio estadoMunicipio',
+        'javax.faces.ViewState': parsed.view_state})).text
+    parsed = jsf.parse(text)
+    assert jsf.options(parsed, 'municipios') == soup_options(text, 'municipios', 'regioes')
+    assert len(jsf.options(parsed, 'municipios')) == 5
+
+
+def test_parse_unescapes_like_beautiful_soup():
+    text = ('<select id="s"><option value="">Selecione</option>'
+            '<option value="a&amp;b">Pau D&#39;Arco &amp; Cia</option>'
+            "<option value='2' selected>São João</option></select>"
+            '<input type="hidden" id="javax.faces.ViewState" value="1:2&amp;3">')
+    parsed = jsf.parse(text)
+    assert jsf.options(parsed, 's') == soup_options(text, 's')
+    assert parsed.view_state == soup_view_state(text)
+    with pytest.raises(TypeError):
+        jsf.options(parsed, 'outro')
@@ -0,0 +1,100 @@
+import os
+from incremental import select
+from manifest import Manifest
+
+TASKS = [{'area': 'ibge', 'state': uf, 'period': '0', 'index': '0', 'view': '0'}
+         for uf in ('11', '12', '13')]
+
+
+class Counter:
+    """Crawler que devolve um texto por tarefa e conta as tarefas pedidas. """
+
+    def __init__(self):
+        self.asked = []
+
+    def map(self, tasks):
+        for task in tasks:
+            self.asked.append(task['state'])
+            yield task, 'texto de {}\n'.format(task['state'])
+
+
+def test_manifest_resumes_and_refetches_corrupted_slices(tmp_path):
+    path = str(tmp_path / 'out.manifest')
+    crawler = Counter()
+    first = list(Manifest(path).map(crawler, TASKS))
+    assert crawler.asked == ['11', '12', '13']
+
+    # Uma execução nova lê tudo do disco
+    manifest = Manifest(path)
+    assert manifest.pending(TASKS) == [] and len(manifest) == 3
+    assert list(manifest.map(crawler, TASKS)) == first
+    assert crawler.asked == ['11', '12', '13']
+
+    # Bytes trocados nos dados da segunda fatia e uma linha cortada no fim
+    # do manifesto (execução interrompida)
+    with open(path + '.data', 'r+b') as f:
+        f.seek(len('texto de 11\n'))
+        f.write(b'X')
+    with open(path, 'a') as f:
+        f.write('{"key": "incompl')
+    manifest = Manifest(path)
+    assert manifest.read(TASKS[1]) is None
+    assert manifest.pending(TASKS) == [TASKS[1]]
+    assert list(manifest.map(crawler, TASKS)) == first
+    assert crawler.asked == ['11', '12', '13', '12']
+    assert Manifest(path).pending(TASKS) == []
+
+
+def test_manifest_refresh_and_missing_data(tmp_path):
+    path = str(tmp_path / 'out.manifest')
+    crawler = Counter()
+    list(Manifest(path).map(crawler, TASKS))
+    list(Manifest(path).map(crawler, TASKS, refresh=TASKS[2:]))
+    assert crawler.asked == ['11', '12', '13', '13']
+    (tmp_path / 'out.manifest.data').unlink()
+    assert Manifest(path).pending(TASKS) == TASKS
+
+
+def test_refreshes_do_not_grow_the_files_without_bound(tmp_path):
+    path = str(tmp_path / 'out.manifest')
+    tasks = [dict(TASKS[0], period=p, state=uf) for p in ('0', '1', '2', '3')
+             for uf in ('11', '12', '13')]
+    list(Manifest(path).map(Counter(), tasks))
+    first = os.path.getsize(path + '.data')
+
+    sizes, lines = [], []
+    for _ in range(8):
+        # Uma atualização diária com window=1: o último quadrimestre de novo
+        manifest = Manifest(path)
+        list(manifest.map(Counter(), tasks, refresh=[t for t in tasks if t['period'] == '3']))
+        sizes.append(os.path.getsize(path + '.data'))
+        with open(path) as f:
+            lines.append(len(f.readlines()))
+    assert max(sizes) < 2 * first
+    assert max(lines) < 2 * len(tasks)
+    assert min(sizes) == first  # Compactado pelo menos uma vez
+    manifest = Manifest(path)
+    assert manifest.pending(tasks) == []
+    assert [text for _, text in manifest.map(Counter(), tasks)] == \
+        ['texto de {}\n'.format(t['state']) for t in tasks]
+
+
+def test_compact_drops_corrupted_slices(tmp_path):
+    path = str(tmp_path / 'out.manifest')
+    list(Manifest(path).map(Counter(), TASKS))
+    with open(path + '.data', 'r+b') as f:
+        f.write(b'X')
+    manifest = Manifest(path)
+    manifest.compact()
+    assert len(manifest) == 2
+    assert Manifest(path).pending(TASKS) == TASKS[:1]
+
+
+def test_select_refreshes_only_stored_recent_periods(tmp_path):
+    manifest = Manifest(str(tmp_path / 'out.manifest'))
+    old = [dict(TASKS[0], period=p) for p in ('0', '1')]
+    list(manifest.map(Counter(), old))
+    new = dict(TASKS[0], period='2')
+    assert select(old + [new], manifest, window=1) == []
+    assert select(old + [new], manifest, window=2) == old[1:]
+    assert select(old, manifest, window=0) == []
@@ -0,0 +1,34 @@
+import io
+import pytest
+from SISAB import SectionWriter, strip_sections
+
+CSV = ('Ministério da Saúde\nIndicador: Pré-Natal\n\n\n'
+       'Uf;Ibge;Município;Numerador;Denominador;Resultado\n'
+       'AC;120001;Acrelândia;12;34;35%\nAC;120005;Assis Brasil;1.234;2.000;61,7%\n\n\n'
+       'Fonte: SISAB\nConsulta às 10:00\n')
+STRIPS = [True, [True, True, True], [False, True, False], [True, False, True], None]
+
+
+def chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('strip', STRIPS)
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 64, 4096])
+def test_section_writer_matches_strip_sections(strip, size):
+    expected = (CSV if strip is None else strip_sections(CSV.split('\n\n\n'), strip)) + '\n'
+    text, binary = io.StringIO(), io.BytesIO()
+    for output in (text, binary):
+        writer = SectionWriter(output, strip)
+        for chunk in chunks(CSV.encode('ISO-8859-1'), size):
+            writer.feed(chunk)
+        writer.close()
+    assert text.getvalue() == expected
+    assert binary.getvalue() == expected.encode('utf-8')
+
+
+def test_section_writer_needs_three_sections():
+    writer = SectionWriter(io.StringIO(), True)
+    writer.feed(b'Uf;Ibge\nAC;120001\n')
+    with pytest.raises(ValueError):
+        writer.close()
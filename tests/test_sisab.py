@@ -0,0 +1,35 @@
+import io
+from SISAB import Sisab, run_task, transitions
+from catalog import OptionIndex
+
+OPTIONS = dict(period=0, index=0, view=0)
+
+
+def test_transitions_normalize_the_state():
+    states = OptionIndex({'11': 'Rondônia', '12': 'Acre'})
+    active = {'area': 'ibge', 'state': '12'}
+    for same in ('12', 'acre', 'ACRE', 1):
+        assert transitions(active, 'ibge', same, states) == ()
+    assert transitions(active, 'ibge', 'Rondonia', states) == ('update_municipality',)
+    assert transitions(active, 'ibge', 'AC') == ('update_municipality',)  # Sem as opções
+
+
+def test_get_data_skips_update_for_same_state_spelled_differently(server):
+    with Sisab() as s:
+        texts = []
+        for state in ('12', 'AC', 'ac'):
+            buffer = io.StringIO()
+            s.get_data('ibge', buffer, state=state, **OPTIONS)
+            texts.append(buffer.getvalue())
+    assert texts[0] == texts[1] == texts[2]
+    assert server.stats['state'] == 1
+    assert server.stats['export'] == 3
+
+
+def test_run_task_matches_get_data(server):
+    task = dict(area='ibge', state='12', file='ignorado.csv', **OPTIONS)
+    with Sisab() as s:
+        buffer = io.StringIO()
+        s.get_data('ibge', buffer, state='12', **OPTIONS)
+        assert run_task(s, task) == buffer.getvalue()
+    assert task['file'] == 'ignorado.csv' and task['area'] == 'ibge'
@@ -0,0 +1,27 @@
+import pytest
+from storage import number, parse
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('1.234', 1234.0),
+    ('12.345.678', 12345678.0),
+    ('-1.234', -1234.0),
+    ('1.234,5', 1234.5),
+    ('12,5%', 12.5),
+    ('12,5 %', 12.5),
+    ('43', 43.0),
+    ('1.5', 1.5),
+    ('-', None),
+    ('', None),
+    ('n/a', None),
+])
+def test_number(text, expected):
+    assert number(text) == expected
+
+
+def test_parse_reads_brazilian_counts():
+    text = 'Uf;IBGE;Municipio;Numerador;Denominador;Resultado(%)\n' \
+        'SP;355030;São Paulo;1.234;12.345;9,99%\n'
+    row, = parse(text, {'area': 'ibge', 'period': '201801', 'index': '1', 'view': '00'})
+    assert (row.state, row.ibge, row.municipality) == ('SP', '355030', 'São Paulo')
+    assert (row.numerator, row.denominator, row.value) == (1234.0, 12345.0, 9.99)
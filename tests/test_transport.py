@@ -0,0 +1,89 @@
+import io
+import socket
+import threading
+import pytest
+import requests as req
+from SISAB import Sisab
+from transport import AdaptiveLimiter, RetryPolicy, Transport, unsent
+
+OPTIONS = dict(period=0, index=0, view=0)
+
+
+def test_streamed_response_holds_the_limiter_slot(server):
+    limiter = AdaptiveLimiter(initial=1, maximum=1)
+    with Transport(limiter=limiter) as t:
+        t.get(Sisab.URL)
+        assert limiter.__in_flight__ == 0
+        res = t.get(Sisab.URL, stream=True)
+        assert limiter.__in_flight__ == 1
+        with res:
+            res.content
+        assert limiter.__in_flight__ == 0
+        res.close()  # Fechar de novo não libera outra vaga
+        assert limiter.__in_flight__ == 0
+
+
+@pytest.fixture
+def dropping():
+    """Servidor que fecha cada conexão sem responder; conta as conexões. """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            conn.recv(65536)
+            accepted.append(conn)
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield 'http://127.0.0.1:{}/'.format(listener.getsockname()[1]), accepted
+    listener.close()
+
+
+def test_post_is_not_retried_after_it_was_sent(dropping):
+    url, accepted = dropping
+    with Transport(retry=RetryPolicy(attempts=3, base=0)) as t:
+        with pytest.raises(req.ConnectionError):
+            t.post(url)
+        assert len(accepted) == 1
+        with pytest.raises(req.ConnectionError):
+            t.get(url)
+        assert len(accepted) == 4
+
+
+def test_connection_refused_is_unsent():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    with pytest.raises(req.ConnectionError) as error:
+        req.post('http://127.0.0.1:{}/'.format(port))
+    assert unsent(error.value)
+
+
+def test_sisab_resyncs_before_repeating_a_failed_post(server):
+    with Sisab(Transport(retry=RetryPolicy(attempts=3, base=0))) as s:
+        expected = io.StringIO()
+        s.get_data('ibge', expected, state='12', **OPTIONS)
+        request = s.transport.session.request
+        failed = []
+
+        def flaky(method, url, **kwargs):
+            if method == 'POST' and not failed:
+                failed.append(True)
+                raise req.ConnectionError('Conexão perdida depois do envio')
+            return request(method, url, **kwargs)
+
+        s.transport.session.request = flaky
+        pages = server.stats['page']
+        buffer = io.StringIO()
+        s.get_data('ibge', buffer, state='12', **OPTIONS)
+    assert buffer.getvalue() == expected.getvalue()
+    assert failed
+    assert server.stats['page'] == pages + 1  # Sessão nova antes de repetir
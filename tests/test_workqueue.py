@@ -0,0 +1,68 @@
+import threading
+import time
+from storage import STRIP
+from workqueue import DONE, FAILED, LEASED, PENDING, WorkQueue, Worker
+
+# A mesma seleção (nível e estado), então são emprestadas juntas
+TASKS = [{'area': 'ibge', 'state': '12', 'period': '0', 'index': '0', 'view': v}
+         for v in ('0', '1')]
+
+
+def test_expired_leases_go_back_to_the_queue(tmp_path):
+    with WorkQueue(str(tmp_path / 'fila.db'), lease=0.5, max_attempts=2) as queue:
+        assert queue.put(TASKS) == 2
+        assert queue.put(TASKS) == 0
+        leases = queue.lease_tasks('a')
+        assert [lease.task for lease in leases] == TASKS
+        assert queue.lease_tasks('b') == []
+        assert queue.counts()[LEASED] == 2
+
+        # O heartbeat segura o empréstimo; sem ele, o worker b pega as tarefas
+        time.sleep(0.3)
+        assert queue.heartbeat('a', [lease.id for lease in leases]) == 2
+        time.sleep(0.3)
+        assert queue.lease_tasks('b') == []
+        time.sleep(0.3)
+        again = queue.lease_tasks('b')
+        assert [lease.id for lease in again] == [lease.id for lease in leases]
+
+        # O worker a perdeu o empréstimo e não pode mais concluir a tarefa
+        assert queue.complete('a', leases[0].id, 'a') is False
+        assert queue.complete('b', again[0].id, 'b') is True
+        assert queue.heartbeat('a', [leases[1].id]) == 0
+
+        # Segundo empréstimo vencido com max_attempts=2: falha
+        time.sleep(0.6)
+        assert queue.lease_tasks('c') == []
+        assert queue.counts() == {PENDING: 0, LEASED: 0, DONE: 1, FAILED: 1}
+        assert [task for task, _ in queue.errors()] == TASKS[1:]
+        assert list(queue.results()) == [(TASKS[0], 'b')]
+
+        assert queue.retry_failed() == 1
+        assert [lease.task for lease in queue.lease_tasks('c')] == TASKS[1:]
+
+
+def test_release_counts_attempts(tmp_path):
+    with WorkQueue(str(tmp_path / 'fila.db'), max_attempts=2) as queue:
+        queue.put(TASKS[:1])
+        (lease,) = queue.lease_tasks('a')
+        queue.release('a', [lease.id], 'Timeout: lento')
+        assert queue.counts()[PENDING] == 1
+        (lease,) = queue.lease_tasks('a')
+        queue.release('a', [lease.id], 'Timeout: lento')
+        assert queue.counts()[FAILED] == 1
+        assert queue.errors() == [(TASKS[0], 'Timeout: lento')]
+
+
+def test_worker_heartbeat_while_completing(server, tmp_path, monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', errors.append)
+    server.latency = 0.01
+    tasks = [dict(area='ibge', state='12', period=p, index=i, view='00', strip=STRIP)
+             for p in server.period_options for i in ('1', '2', '3')]
+    # Empréstimos curtos: o heartbeat roda a cada 20 ms, durante as exportações
+    with WorkQueue(str(tmp_path / 'fila.db'), lease=0.06) as queue:
+        queue.put(tasks)
+        assert Worker(queue, batch=len(tasks)).run() == len(tasks)
+        assert queue.counts()[DONE] == len(tasks)
+    assert errors == []
@@ -0,0 +1,351 @@
+from typing import Callable, Optional, Tuple, Union
+import random
+import threading
+import time
+import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+
+Timeout = Union[float, Tuple[float, float]]
+
+# Tempo gasto abrindo conexões (TCP e TLS) em cada thread
+__timing__ = threading.local()
+
+
+def connect_time() -> float:  # {{{
+    """Tempo abrindo conexões na thread atual desde a última chamada. }}} """
+    seconds = getattr(__timing__, 'connect', 0.0)
+    __timing__.connect = 0.0
+    return seconds
+    # }}}
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):  # {{{
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            __timing__.connect = getattr(__timing__, 'connect', 0.0) + \
+                time.perf_counter() - start
+        # }}}
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):  # {{{
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            __timing__.connect = getattr(__timing__, 'connect', 0.0) + \
+                time.perf_counter() - start
+        # }}}
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):  # {{{
+    """HTTPAdapter que mede o tempo de abertura das conexões (veja connect_time). }}} """
+
+    def init_poolmanager(self, *args, **kwargs):  # {{{
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+        # }}}
+    # }}}
+
+
+# Métodos que podem ser repetidos mesmo sem saber se o servidor os recebeu
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS')
+
+
+def unsent(error: Exception) -> bool:  # {{{
+    """Se a falha aconteceu ao abrir a conexão, antes de a requisição ser
+    enviada, de modo que repeti-la não pode duplicar o efeito dela. }}} """
+    if isinstance(error, req.ConnectTimeout):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+    # }}}
+
+
+def hold(res: req.Response, release: Callable[[], None]) -> req.Response:  # {{{
+    """Libera a vaga do limitador só quando a resposta for fechada (no fim
+    do with ou em close), depois da leitura do corpo. }}} """
+    close = res.close
+    released = []
+
+    def wrapper():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                release()
+    res.close = wrapper  # type: ignore
+    return res
+    # }}}
+
+
+class RetryPolicy:  # {{{
+    """Quantas vezes e com que espera uma requisição é repetida. {{{
+
+        Falhas de conexão, timeouts e as respostas em STATUS são repetidas
+        com espera exponencial e jitter completo (um valor aleatório entre
+        0 e min(cap, base * 2 ** tentativa)), para que várias sessões não
+        voltem a bater no servidor ao mesmo tempo. Requisições que mudam o
+        estado do servidor (POST) só são repetidas se a falha foi antes do
+        envio (veja unsent) ou se o servidor as recusou (REFUSED); nas
+        demais o erro sobe, e o Sisab refaz as seleções antes de repetir.
+
+        @param attempts
+                Quantidade máxima de tentativas de cada requisição
+        @param base
+                Espera em segundos da primeira repetição
+        @param cap
+                Espera máxima em segundos
+                }}} """
+
+    STATUS = (429, 500, 502, 503, 504)
+    # Respostas em que o servidor não processou a requisição
+    REFUSED = (429, 503)
+
+    def __init__(self, attempts: int = 5, base: float = 0.5, cap: float = 30.0):  # {{{
+        if attempts < 1:
+            raise ValueError('A quantidade de tentativas deve ser positiva')
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        # }}}
+
+    def delay(self, attempt: int, response: Optional[req.Response] = None) -> float:  # {{{
+        """Espera antes da repetição de número attempt (começando em 0). }}} """
+        if response is not None:
+            # 429 e 503 podem dizer quanto tempo esperar
+            try:
+                return min(self.cap, float(response.headers['Retry-After']))
+            except (KeyError, ValueError):
+                pass
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        # }}}
+    # }}}
+
+
+class AdaptiveLimiter:  # {{{
+    """Controle AIMD da quantidade de requisições simultâneas. {{{
+
+        Compartilhado pelas sessões de um crawler. Cada requisição bem
+        sucedida aumenta o limite em 1 / limite (cerca de +1 a cada rodada
+        de requisições); um erro, ou uma resposta mais lenta que `slow`
+        vezes a latência de referência, corta o limite pela metade, no
+        máximo uma vez a cada latência de referência. Assim a vazão sobe
+        até o servidor começar a falhar ou demorar, e recua logo em seguida.
+
+        @param initial
+                Limite inicial
+        @param minimum
+                Limite mínimo
+        @param maximum
+                Limite máximo (normalmente a quantidade de sessões)
+        @param slow
+                Quantas vezes a latência de referência conta como lentidão
+                }}} """
+
+    def __init__(
+        self,
+        initial: float = 2,
+        minimum: float = 1,
+        maximum: float = 16,
+        slow: float = 3.0
+    ):  # {{{
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slow = slow
+        self.limit = float(max(minimum, min(maximum, initial)))
+        self.baseline: Optional[float] = None  # Latência de referência
+        self.__in_flight__ = 0
+        self.__decreased__ = 0.0
+        self.__lock__ = threading.Condition()
+        # }}}
+
+    def acquire(self):  # {{{
+        with self.__lock__:
+            while self.__in_flight__ >= int(self.limit):
+                self.__lock__.wait()
+            self.__in_flight__ += 1
+        # }}}
+
+    def release(self, ok: bool, latency: float):  # {{{
+        with self.__lock__:
+            self.__in_flight__ -= 1
+            slow = self.baseline is not None and latency > self.slow * self.baseline
+            if not ok or slow:
+                now = time.monotonic()
+                if now - self.__decreased__ >= (self.baseline or 0):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.__decreased__ = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if ok:
+                # A referência acompanha a menor latência, subindo devagar
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline = 0.95 * self.baseline + 0.05 * latency
+            self.__lock__.notify_all()
+        # }}}
+    # }}}
+
+
+class Transport:  # {{{
+    """Sessão HTTP persistente (keep-alive) usada pelo Sisab. {{{
+
+        Mantém um pool de conexões e um cookie jar próprios, de modo que
+        todas as requisições de uma mesma instância do Sisab reaproveitam
+        a conexão TCP/TLS e enviam os cookies da sessão JSF automaticamente.
+
+        @param pool_size
+                Quantidade máxima de conexões mantidas abertas por host
+        @param timeout
+                Tempo limite (conexão, leitura) em segundos de cada requisição
+        @param adapter
+                Adaptador (pool de conexões) já existente para ser compartilhado
+                Quando não é passado, um novo adaptador é criado
+        @param retry
+                Política de repetição das requisições que falharem
+                None faz cada requisição uma vez só
+        @param limiter
+                Controle de concorrência compartilhado pelas sessões
+                }}} """
+
+    HEADERS = {
+        "User-Agent":
+            "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:91.0)" +
+            " Gecko/20100101 Firefox/91.0",
+        "Accept":
+            "text/html,application/xhtml+xml,application/xml;" +
+            "q=0.9,image/webp,*/*;q=0.8",
+        "Accept-Language": "pt-BR,en-US;q=0.8,en;q=0.5,pt;q=0.3",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Connection": "keep-alive",
+    }
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: Optional[Timeout] = (10, 120),
+        adapter: Optional[HTTPAdapter] = None,
+        retry: Optional[RetryPolicy] = RetryPolicy(),
+        limiter: Optional[AdaptiveLimiter] = None
+    ):  # {{{
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry = retry
+        self.limiter = limiter
+        # (conexão, espera) em segundos da última requisição
+        self.timing: Tuple[float, float] = (0.0, 0.0)
+        # Somente quem criou o adaptador pode fechá-lo
+        self.__owner__ = adapter is None
+        if adapter is None:
+            adapter = TimedAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+        self.adapter = adapter
+
+        self.session = req.Session()
+        self.session.headers.update(Transport.HEADERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # }}}
+
+    @property
+    def cookies(self): return self.session.cookies
+
+    def fork(self) -> 'Transport':  # {{{
+        """Cria uma nova sessão (cookie jar vazio) que compartilha o mesmo
+        pool de conexões desta. }}} """
+        return Transport(self.pool_size, self.timeout, self.adapter,
+                         self.retry, self.limiter)
+        # }}}
+
+    def request(self, method: str, url: str, **kwargs) -> req.Response:  # {{{
+        """Faz a requisição, repetindo-a conforme a política de repetição. {{{
+
+            Somente a parte até o recebimento dos cabeçalhos é repetida;
+            falhas durante a leitura de um corpo com stream=True ficam
+            para quem lê a resposta. Com stream=True a vaga do limitador
+            fica com a resposta até ela ser fechada, então o limite vale
+            também para a leitura do corpo.
+            }}} """
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = self.retry.attempts if self.retry is not None else 1
+        idempotent = method.upper() in IDEMPOTENT
+        stream = kwargs.get('stream', False)
+        attempt = 0
+        connect_time()
+        begin = time.perf_counter()
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            start = time.monotonic()
+            ok = False
+            res = None
+            try:
+                res = self.session.request(method, url, **kwargs)
+                ok = res.status_code not in RetryPolicy.STATUS
+            except (req.ConnectionError, req.Timeout) as e:
+                if attempt + 1 >= attempts or not (idempotent or unsent(e)):
+                    raise
+            finally:
+                if self.limiter is not None:
+                    latency = time.monotonic() - start
+                    if ok and stream:
+                        # A latência é a dos cabeçalhos; a vaga, até o fim
+                        limiter = self.limiter
+                        hold(res, lambda: limiter.release(True, latency))  # type: ignore
+                    else:
+                        self.limiter.release(ok, latency)
+            if ok:
+                # A espera inclui as repetições, até chegarem os cabeçalhos
+                connect = connect_time()
+                self.timing = (connect, time.perf_counter() - begin - connect)
+                return res  # type: ignore
+            if res is not None and (attempt + 1 >= attempts or not (
+                    idempotent or res.status_code in RetryPolicy.REFUSED)):
+                res.close()
+                res.raise_for_status()
+            delay = self.retry.delay(attempt, res)  # type: ignore
+            if res is not None:
+                res.close()
+            time.sleep(delay)
+            attempt += 1
+        # }}}
+
+    def get(self, url: str, **kwargs) -> req.Response:  # {{{
+        return self.request('GET', url, **kwargs)
+        # }}}
+
+    def post(self, url: str, **kwargs) -> req.Response:  # {{{
+        return self.request('POST', url, **kwargs)
+        # }}}
+
+    def close(self):  # {{{
+        if self.__owner__:
+            self.session.close()
+        else:
+            self.session.cookies.clear()
+        # }}}
+
+    def __enter__(self): return self
+    def __exit__(self, *_): self.close()
+    # }}}
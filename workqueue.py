@@ -0,0 +1,378 @@
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import gzip
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from SISAB import Sisab
+from batch import Batcher
+from cache import ResponseCache
+from catalog import CatalogStore
+from metrics import Metrics
+from planner import Planner, selection
+from transport import Transport
+
+
+Task = Dict[str, object]
+
+# Estados de uma tarefa na fila
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+
+
+class Lease(NamedTuple):
+    id: int
+    task: Task
+
+
+class WorkQueue:  # {{{
+    """Fila de exportações em um arquivo SQLite, compartilhada por processos. {{{
+
+        Cada tarefa (argumentos de get_data) é emprestada a um worker por
+        lease segundos. O worker renova o empréstimo enquanto trabalha
+        (heartbeat) e devolve o texto da exportação, que fica guardado
+        comprimido na fila. Se o worker morrer, o empréstimo vence e a
+        tarefa volta para os outros; depois de max_attempts empréstimos ela
+        é marcada como falha.
+
+        As tarefas são emprestadas em lotes da mesma seleção do servidor
+        (veja planner.selection), de preferência a que a sessão do worker
+        já tem ativa, para que cada lote custe poucas atualizações AJAX.
+
+            queue = WorkQueue('fila.db')
+            queue.put(tasks)
+            # Em cada processo ou máquina (com o arquivo compartilhado):
+            Worker(queue).run()
+            # No fim, em qualquer um deles:
+            for task, text in queue.results():
+                ...
+
+        O SQLite coordena os processos pelos locks do arquivo, então a fila
+        funciona entre máquinas só em sistemas de arquivos com locks
+        confiáveis.
+
+        @param path
+                Arquivo da fila
+        @param lease
+                Duração de cada empréstimo, em segundos
+        @param max_attempts
+                Empréstimos de uma tarefa antes de ela ser marcada como falha
+                }}} """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            grp TEXT NOT NULL,
+            task TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            result BLOB
+        );
+        CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, grp, id);
+    '''
+
+    def __init__(self, path: str = 'fila.db', lease: float = 60.0, max_attempts: int = 5):  # {{{
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # Os workers de um processo usam a mesma conexão em threads diferentes
+        self.__lock__ = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(WorkQueue.SCHEMA)
+        # }}}
+
+    def __transaction__(self):  # {{{
+        # BEGIN IMMEDIATE pega o lock de escrita antes de ler, então dois
+        # processos não emprestam a mesma tarefa
+        self.connection.execute('BEGIN IMMEDIATE')
+        # }}}
+
+    def put(self, tasks: Iterable[Task]) -> int:  # {{{
+        """Acrescenta as tarefas que ainda não estão na fila. Devolve
+        quantas entraram. }}} """
+        rows = []
+        for task in tasks:
+            text = json.dumps(task, sort_keys=True, ensure_ascii=False)
+            rows.append((text, json.dumps(selection(task)), text))
+        with self.__lock__:
+            before = self.connection.total_changes
+            self.__transaction__()
+            try:
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO tasks (key, grp, task) VALUES (?, ?, ?)', rows)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            return self.connection.total_changes - before
+        # }}}
+
+    def lease_tasks(
+        self,
+        worker: str,
+        count: int = 8,
+        prefer: Optional[Task] = None
+    ) -> List[Lease]:  # {{{
+        """Empresta ao worker até count tarefas da mesma seleção. {{{
+
+            @param prefer
+                    Seleção ativa na sessão do worker (Sisab.active); as
+                    tarefas dela vêm primeiro
+                    }}} """
+        now = time.time()
+        available = "(state = 'pending' OR (state = 'leased' AND expires < ?))"
+        with self.__lock__:
+            self.__transaction__()
+            try:
+                # Empréstimos vencidos demais viram falha
+                self.connection.execute(
+                    "UPDATE tasks SET state = 'failed', worker = NULL WHERE state = 'leased' "
+                    'AND expires < ? AND attempts >= ?', (now, self.max_attempts))
+                row = None
+                if prefer:
+                    row = self.connection.execute(
+                        'SELECT grp FROM tasks WHERE grp = ? AND {} LIMIT 1'.format(available),
+                        (json.dumps(selection(prefer)), now)).fetchone()
+                if row is None:
+                    row = self.connection.execute(
+                        'SELECT grp FROM tasks WHERE {} ORDER BY id LIMIT 1'.format(available),
+                        (now,)).fetchone()
+                if row is None:
+                    self.connection.execute('COMMIT')
+                    return []
+                rows = self.connection.execute(
+                    'SELECT id, task FROM tasks WHERE grp = ? AND {} ORDER BY id LIMIT ?'
+                    .format(available), (row[0], now, count)).fetchall()
+                self.connection.executemany(
+                    "UPDATE tasks SET state = 'leased', worker = ?, expires = ?, "
+                    'attempts = attempts + 1 WHERE id = ?',
+                    [(worker, now + self.lease, i) for i, _ in rows])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return [Lease(i, json.loads(task)) for i, task in rows]
+        # }}}
+
+    def heartbeat(self, worker: str, ids: Iterable[int]) -> int:  # {{{
+        """Renova os empréstimos do worker. Devolve quantos ainda são dele. }}} """
+        ids = list(ids)
+        if not ids:
+            return 0
+        with self.__lock__:
+            cursor = self.connection.execute(
+                "UPDATE tasks SET expires = ? WHERE state = 'leased' AND worker = ? "
+                'AND id IN ({})'.format(','.join('?' * len(ids))),
+                [time.time() + self.lease, worker, *ids])
+            return cursor.rowcount
+        # }}}
+
+    def complete(self, worker: str, id: int, text: str) -> bool:  # {{{
+        """Guarda o resultado da tarefa. Devolve False se o empréstimo já
+        não era do worker (venceu e outro worker pegou a tarefa). }}} """
+        blob = gzip.compress(text.encode('utf-8'), 6)
+        with self.__lock__:
+            cursor = self.connection.execute(
+                "UPDATE tasks SET state = 'done', result = ?, error = NULL, expires = NULL "
+                "WHERE id = ? AND state = 'leased' AND worker = ?", (blob, id, worker))
+            return cursor.rowcount == 1
+        # }}}
+
+    def release(self, worker: str, ids: Iterable[int], error: Optional[str] = None):  # {{{
+        """Devolve as tarefas para a fila (ou marca como falha, se já foram
+        tentadas max_attempts vezes). }}} """
+        with self.__lock__:
+            self.connection.executemany(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END, worker = NULL, expires = NULL, error = ? "
+                "WHERE id = ? AND state = 'leased' AND worker = ?",
+                [(self.max_attempts, error, i, worker) for i in ids])
+        # }}}
+
+    def retry_failed(self) -> int:  # {{{
+        """Volta as tarefas que falharam para a fila, com as tentativas zeradas. }}} """
+        with self.__lock__:
+            return self.connection.execute(
+                "UPDATE tasks SET state = 'pending', attempts = 0 WHERE state = 'failed'"
+            ).rowcount
+        # }}}
+
+    def counts(self) -> Dict[str, int]:  # {{{
+        """Tarefas em cada estado (pending, leased, done e failed). }}} """
+        with self.__lock__:
+            rows = self.connection.execute(
+                'SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall()
+        result = dict.fromkeys((PENDING, LEASED, DONE, FAILED), 0)
+        result.update(rows)
+        return result
+        # }}}
+
+    def errors(self) -> List[Tuple[Task, str]]:  # {{{
+        with self.__lock__:
+            rows = self.connection.execute(
+                "SELECT task, error FROM tasks WHERE state = 'failed' ORDER BY id").fetchall()
+        return [(json.loads(task), error) for task, error in rows]
+        # }}}
+
+    def results(self) -> Iterator[Tuple[Task, str]]:  # {{{
+        """(tarefa, texto) das tarefas concluídas, na ordem em que entraram
+        na fila, como no Crawler.map. }}} """
+        last = 0
+        while True:
+            with self.__lock__:
+                rows = self.connection.execute(
+                    "SELECT id, task, result FROM tasks WHERE state = 'done' AND id > ? "
+                    'ORDER BY id LIMIT 100', (last,)).fetchall()
+            if not rows:
+                return
+            for id, task, blob in rows:
+                last = id
+                yield json.loads(task), gzip.decompress(blob).decode('utf-8')
+        # }}}
+
+    def close(self):  # {{{
+        self.connection.close()
+        # }}}
+
+    def __enter__(self): return self
+    def __exit__(self, *_): self.close()
+    # }}}
+
+
+class Worker:  # {{{
+    """Consome a fila com uma sessão própria do Sisab. {{{
+
+        Um Sisab está preso a um ViewState, então cada worker abre a sua
+        sessão e a reaproveita entre os lotes. Enquanto um lote é baixado,
+        uma thread renova os empréstimos a cada lease / 3 segundos. Se a
+        sessão falhar, as tarefas que faltam no lote voltam para a fila e
+        uma sessão nova é aberta no próximo lote.
+
+            with WorkQueue('fila.db') as queue:
+                Worker(queue, catalog=CatalogStore('catalog.json')).run()
+
+        @param queue
+                Fila de onde as tarefas são emprestadas
+        @param transport
+                Transporte da sessão (veja Transport.fork)
+        @param name
+                Identificação do worker na fila (padrão: máquina, processo e
+                um sufixo aleatório)
+        @param batch
+                Tarefas emprestadas de cada vez
+        @param batch_size
+                Entidades exportadas juntas em cada requisição (veja
+                batch.Batcher); 1 exporta uma por vez
+                }}} """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        transport: Optional[Transport] = None,
+        catalog: Optional[CatalogStore] = None,
+        cache: Optional[ResponseCache] = None,
+        name: Optional[str] = None,
+        batch: int = 8,
+        metrics: Optional[Metrics] = None,
+        batch_size: int = 1
+    ):  # {{{
+        self.queue = queue
+        self.name = name or '{}:{}:{}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.batch = batch
+        self.batch_size = batch_size
+        self.__transport__ = transport
+        self.__catalog__ = catalog
+        self.__cache__ = cache
+        self.__metrics__ = metrics
+        self.__sisab__: Optional[Sisab] = None
+        # }}}
+
+    def __session__(self) -> Sisab:  # {{{
+        if self.__sisab__ is None:
+            transport = self.__transport__.fork() if self.__transport__ is not None else None
+            self.__sisab__ = Sisab(transport, self.__catalog__, self.__cache__, self.__metrics__)
+        return self.__sisab__
+        # }}}
+
+    def run(self, stop: Optional[threading.Event] = None, wait: bool = True) -> int:  # {{{
+        """Trabalha até a fila esvaziar (ou até stop). Devolve quantas
+        tarefas o worker concluiu. {{{
+
+            @param wait
+                    Espera pelas tarefas emprestadas a outros workers, que
+                    podem voltar para a fila se eles morrerem
+                    }}} """
+        stop = stop or threading.Event()
+        done = 0
+        try:
+            while not stop.is_set():
+                active = self.__sisab__.active if self.__sisab__ is not None else None
+                leases = self.queue.lease_tasks(self.name, self.batch, active)
+                if not leases:
+                    if not wait or self.queue.counts()[LEASED] == 0:
+                        break
+                    stop.wait(min(5.0, self.queue.lease / 3))
+                    continue
+                done += self.__work__(leases, stop)
+        finally:
+            if self.__sisab__ is not None:
+                self.__sisab__.close()
+                self.__sisab__ = None
+        return done
+        # }}}
+
+    def __work__(self, leases: List[Lease], stop: threading.Event) -> int:  # {{{
+        held = {id(lease.task): lease.id for lease in leases}
+        # O heartbeat lê held enquanto esta thread tira as tarefas concluídas
+        lock = threading.Lock()
+        finished = threading.Event()
+
+        def beat():
+            while not finished.wait(self.queue.lease / 3):
+                with lock:
+                    ids = list(held.values())
+                self.queue.heartbeat(self.name, ids)
+
+        def take() -> List[int]:
+            with lock:
+                ids = list(held.values())
+                held.clear()
+            return ids
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        done = 0
+        try:
+            session = self.__session__()
+            planner = Planner([lease.task for lease in leases])
+            items = Batcher(session, self.batch_size).run(planner.order(session.active)) \
+                if self.batch_size > 1 else planner.run(session)
+            for task, text in items:
+                with lock:
+                    lease_id = held.pop(id(task))
+                if self.queue.complete(self.name, lease_id, text):
+                    done += 1
+                if stop.is_set():
+                    break
+        except Exception as e:
+            # A sessão pode ter ficado num estado ruim; a próxima é nova
+            if self.__sisab__ is not None:
+                self.__sisab__.close()
+                self.__sisab__ = None
+            self.queue.release(self.name, take(), '{}: {}'.format(type(e).__name__, e))
+        finally:
+            finished.set()
+            thread.join()
+            self.queue.release(self.name, take())
+        return done
+        # }}}
+    # }}}